@@ -0,0 +1,458 @@
+import os
+import re
+import shutil
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from database import (
+    TRANSACTIONS_FIELD_PATHS,
+    get_statement_analyses,
+    get_statements_transactions,
+    list_statement_ids,
+)
+from metrics import stage_timer
+from training_index import FEATURE_FIELDS
+
+
+# Columnar mirror of the statements for the portfolio analytics: the statement
+# summaries, their monthly summary rows and their transactions are exported to
+# parquet datasets partitioned by statement_year/country_code. The export is
+# incremental, only the statements not exported yet are read from Firestore, and
+# the reports are computed on the parquet files without touching Firestore.
+# Each export batch writes its files, then a marker committing them: the files of
+# a batch without a marker (an interrupted export) are removed by the next export,
+# before the batch is exported again.
+# The stored decisions can change after the export (see rescore_loan_decisions),
+# a full export (full=True) mirrors them again, into a new directory that replaces
+# the current one once complete.
+
+ANALYTICS_EXPORT_DIR = os.environ.get(
+    "ANALYTICS_EXPORT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analytics_export"),
+)
+ANALYTICS_EXPORT_BATCH_SIZE = int(os.environ.get("ANALYTICS_EXPORT_BATCH_SIZE", 200))
+
+PARTITION_SCHEMA = pa.schema(
+    [("statement_year", pa.int64()), ("country_code", pa.string())]
+)
+
+MONTHLY_SUMMARY_FIELDS = [
+    "total_deposits",
+    "total_withdrawals",
+    "average_balance",
+    "net_savings",
+    "rent_mortgage_payments",
+    "utility_payments",
+    "loan_payments",
+    "rent_mortgage_to_income_ratio",
+    "utilities_to_income_ratio",
+    "loan_to_income_ratio",
+]
+STATEMENT_FIELDS = (
+    ["country_code", "bank_name", "statement_year", "statement_pdf_blob"]
+    + FEATURE_FIELDS
+    + ["loan_decision", "transactions_count"]
+)
+
+# the schemas are explicit, so that every file of a dataset has the same types
+# even when a batch only has missing values in a column
+DATASET_SCHEMAS = {
+    "statements": pa.schema(
+        [
+            ("statement_id", pa.string()),
+            ("bank_name", pa.string()),
+            ("statement_pdf_blob", pa.string()),
+        ]
+        + [(field, pa.float64()) for field in FEATURE_FIELDS]
+        + [
+            ("loan_decision", pa.int64()),
+            ("transactions_count", pa.int64()),
+            ("exported_at", pa.float64()),
+        ]
+        + list(PARTITION_SCHEMA)
+    ),
+    "monthly_summaries": pa.schema(
+        [
+            ("statement_id", pa.string()),
+            ("bank_name", pa.string()),
+            ("loan_decision", pa.int64()),
+            # position of the month in the statement, the months are saved in order
+            ("month_num", pa.int64()),
+        ]
+        + [(field, pa.float64()) for field in MONTHLY_SUMMARY_FIELDS]
+        + list(PARTITION_SCHEMA)
+    ),
+    "transactions": pa.schema(
+        [
+            ("statement_id", pa.string()),
+            ("bank_name", pa.string()),
+            ("date", pa.string()),
+            ("description", pa.string()),
+            ("amount", pa.float64()),
+            ("deposit", pa.bool_()),
+            ("category", pa.string()),
+        ]
+        + list(PARTITION_SCHEMA)
+    ),
+}
+# the statements are written last, so they are the list of the exported statements
+DATASET_WRITE_ORDER = ["transactions", "monthly_summaries", "statements"]
+# one empty file per committed batch, named by the batch id
+COMMITTED_BATCHES_DIR = "_committed_batches"
+BATCH_FILE_PATTERN = re.compile(r"^part-(?P<batch_id>[0-9a-f]+)-\d+\.parquet$")
+
+
+def get_partition_values(statement_analysis):
+    statement_year = statement_analysis.get("statement_year")
+
+    return {
+        "statement_year": int(statement_year) if statement_year else None,
+        "country_code": statement_analysis.get("country_code") or None,
+    }
+
+
+def build_export_columns(statement_id, statement_analysis, transactions, exported_at):
+    # Columns of the rows of each dataset for one statement
+    partition_values = get_partition_values(statement_analysis)
+    common_values = {
+        "statement_id": statement_id,
+        "bank_name": statement_analysis.get("bank_name"),
+        **partition_values,
+    }
+
+    monthly_summary = statement_analysis.get("monthly_summary") or []
+    transactions = transactions or []
+
+    return {
+        "statements": {
+            **{column: [value] for column, value in common_values.items()},
+            **{
+                field: [statement_analysis.get(field)]
+                for field in STATEMENT_FIELDS
+                if field not in common_values
+            },
+            "exported_at": [exported_at],
+        },
+        "monthly_summaries": {
+            **{
+                column: [value] * len(monthly_summary)
+                for column, value in common_values.items()
+            },
+            "loan_decision": [statement_analysis.get("loan_decision")]
+            * len(monthly_summary),
+            "month_num": list(range(len(monthly_summary))),
+            **{
+                field: [month_summary.get(field) for month_summary in monthly_summary]
+                for field in MONTHLY_SUMMARY_FIELDS
+            },
+        },
+        "transactions": {
+            **{
+                column: [value] * len(transactions)
+                for column, value in common_values.items()
+            },
+            "date": [transaction.get("Date") for transaction in transactions],
+            "description": [
+                transaction.get("Description") for transaction in transactions
+            ],
+            "amount": [transaction.get("Amount") for transaction in transactions],
+            "deposit": [
+                transaction.get("Deposit") == "YES" for transaction in transactions
+            ],
+            "category": [transaction.get("Category") for transaction in transactions],
+        },
+    }
+
+
+class AnalyticsStore:
+    """
+    Partitioned parquet datasets of the exported statements, and the vectorized
+    reports computed on them. Filters on the partition fields only read the
+    matching directories.
+    """
+
+    def __init__(self, export_dir=ANALYTICS_EXPORT_DIR):
+        self.export_dir = export_dir
+
+    def _dataset_dir(self, dataset_name):
+        return os.path.join(self.export_dir, dataset_name)
+
+    def has_dataset(self, dataset_name):
+        return os.path.isdir(self._dataset_dir(dataset_name))
+
+    def dataset(self, dataset_name):
+        return ds.dataset(
+            self._dataset_dir(dataset_name),
+            format="parquet",
+            schema=DATASET_SCHEMAS[dataset_name],
+            partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        )
+
+    def append(self, dataset_name, table, batch_id):
+        # new files next to the existing ones, named by the export batch
+        ds.write_dataset(
+            table,
+            self._dataset_dir(dataset_name),
+            format="parquet",
+            partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+            basename_template=f"part-{batch_id}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    def commit_batch(self, batch_id):
+        committed_batches_dir = os.path.join(self.export_dir, COMMITTED_BATCHES_DIR)
+        os.makedirs(committed_batches_dir, exist_ok=True)
+
+        open(os.path.join(committed_batches_dir, batch_id), "w").close()
+
+    def get_committed_batch_ids(self):
+        committed_batches_dir = os.path.join(self.export_dir, COMMITTED_BATCHES_DIR)
+        if not os.path.isdir(committed_batches_dir):
+            return set()
+
+        return set(os.listdir(committed_batches_dir))
+
+    def remove_uncommitted_batches(self):
+        # Deletes the files of the batches that were not committed, returns their count
+        committed_batch_ids = self.get_committed_batch_ids()
+        num_removed_files = 0
+
+        for dataset_name in DATASET_SCHEMAS:
+            for directory, _, file_names in os.walk(self._dataset_dir(dataset_name)):
+                for file_name in file_names:
+                    batch_file_match = BATCH_FILE_PATTERN.match(file_name)
+
+                    if (
+                        batch_file_match is not None
+                        and batch_file_match.group("batch_id")
+                        not in committed_batch_ids
+                    ):
+                        os.remove(os.path.join(directory, file_name))
+                        num_removed_files += 1
+
+        return num_removed_files
+
+    def get_exported_statement_ids(self):
+        if not self.has_dataset("statements"):
+            return set()
+
+        statement_ids = self.dataset("statements").to_table(columns=["statement_id"])
+        return set(statement_ids["statement_id"].to_pylist())
+
+    @staticmethod
+    def _filter_expression(filters):
+        # filters maps columns to a value or a list of values
+        expression = None
+
+        for column, value in (filters or {}).items():
+            if isinstance(value, (list, tuple, set)):
+                condition = pc.field(column).isin(list(value))
+            else:
+                condition = pc.field(column) == value
+
+            expression = condition if expression is None else expression & condition
+
+        return expression
+
+    def read(self, dataset_name, columns=None, filters=None):
+        if not self.has_dataset(dataset_name):
+            return (
+                DATASET_SCHEMAS[dataset_name]
+                .empty_table()
+                .select(columns or DATASET_SCHEMAS[dataset_name].names)
+            )
+
+        return self.dataset(dataset_name).to_table(
+            columns=columns, filter=self._filter_expression(filters)
+        )
+
+    def aggregate(self, dataset_name, group_by, aggregations, filters=None):
+        # aggregations is a list of (column, function) such as ("amount", "sum"),
+        # the result columns are named "<column>_<function>"
+        columns = list(dict.fromkeys(group_by + [column for column, _ in aggregations]))
+        table = self.read(dataset_name, columns, filters)
+
+        return (
+            table.group_by(group_by)
+            .aggregate(list(aggregations))
+            .to_pandas()
+            .sort_values(group_by, ignore_index=True)
+        )
+
+    def approval_rate_by_bank(self, filters=None):
+        report = self.aggregate(
+            "statements",
+            ["bank_name"],
+            [("loan_decision", "mean"), ("statement_id", "count")],
+            filters,
+        )
+
+        return report.rename(
+            columns={
+                "loan_decision_mean": "approval_rate",
+                "statement_id_count": "statements",
+            }
+        )
+
+    def rent_to_income_by_country(self, filters=None):
+        report = self.aggregate(
+            "monthly_summaries",
+            ["country_code"],
+            [
+                ("rent_mortgage_to_income_ratio", "mean"),
+                ("statement_id", "count_distinct"),
+            ],
+            filters,
+        )
+
+        return report.rename(
+            columns={
+                "rent_mortgage_to_income_ratio_mean": "average_rent_to_income_ratio",
+                "statement_id_count_distinct": "statements",
+            }
+        )
+
+    def category_totals(self, filters=None):
+        report = self.aggregate(
+            "transactions",
+            ["category"],
+            [("amount", "sum"), ("amount", "count")],
+            filters,
+        )
+
+        return report.rename(
+            columns={"amount_sum": "total_amount", "amount_count": "transactions"}
+        )
+
+
+def export_statements_batch(store, statement_ids):
+    # Reads a batch of statements from Firestore and appends their rows to each dataset
+    exported_at = time.time()
+    batch_columns = {dataset_name: [] for dataset_name in DATASET_SCHEMAS}
+
+    statement_analyses = get_statement_analyses(
+        statement_ids,
+        list(
+            dict.fromkeys(
+                STATEMENT_FIELDS + ["monthly_summary"] + TRANSACTIONS_FIELD_PATHS
+            )
+        ),
+    )
+    # the transaction pages of the whole batch, in batched reads
+    statements_transactions = get_statements_transactions(statement_analyses)
+
+    for statement_id, statement_analysis in statement_analyses.items():
+        export_columns = build_export_columns(
+            statement_id,
+            statement_analysis,
+            statements_transactions[statement_id],
+            exported_at,
+        )
+
+        for dataset_name, columns in export_columns.items():
+            batch_columns[dataset_name].append(columns)
+
+    batch_id = uuid.uuid4().hex
+    num_rows = {}
+
+    for dataset_name in DATASET_WRITE_ORDER:
+        schema = DATASET_SCHEMAS[dataset_name]
+        table = pa.Table.from_pydict(
+            {
+                field.name: [
+                    value
+                    for columns in batch_columns[dataset_name]
+                    for value in columns[field.name]
+                ]
+                for field in schema
+            },
+            schema=schema,
+        )
+
+        if table.num_rows:
+            store.append(dataset_name, table, batch_id)
+        num_rows[dataset_name] = table.num_rows
+
+    store.commit_batch(batch_id)
+
+    return num_rows
+
+
+def sync_analytics_export(
+    export_dir=ANALYTICS_EXPORT_DIR,
+    full=False,
+    batch_size=ANALYTICS_EXPORT_BATCH_SIZE,
+    log=False,
+):
+    # Exports the statements that are not in the datasets yet, or all of them again
+    # with full=True. Returns the number of exported statements and rows
+    if full:
+        return rebuild_analytics_export(export_dir, batch_size, log)
+
+    store = AnalyticsStore(export_dir)
+    removed_files = store.remove_uncommitted_batches()
+
+    if log and removed_files:
+        print(f"Removed {removed_files} files of uncommitted export batches")
+
+    exported_statement_ids = store.get_exported_statement_ids()
+
+    with stage_timer("analytics_list"):
+        statement_ids = [
+            statement_id
+            for statement_id in list_statement_ids()
+            if statement_id not in exported_statement_ids
+        ]
+
+    export_report = {
+        "statements": 0,
+        "already_exported": len(exported_statement_ids),
+        "rows": {dataset_name: 0 for dataset_name in DATASET_SCHEMAS},
+    }
+
+    for start in range(0, len(statement_ids), batch_size):
+        with stage_timer("analytics_export"):
+            num_rows = export_statements_batch(
+                store, statement_ids[start : start + batch_size]
+            )
+
+        export_report["statements"] += num_rows["statements"]
+        for dataset_name, dataset_rows in num_rows.items():
+            export_report["rows"][dataset_name] += dataset_rows
+
+        if log:
+            print("Exported Statements", export_report)
+
+    return export_report
+
+
+def rebuild_analytics_export(
+    export_dir=ANALYTICS_EXPORT_DIR,
+    batch_size=ANALYTICS_EXPORT_BATCH_SIZE,
+    log=False,
+):
+    # Full export into a new directory next to export_dir, which replaces it once
+    # complete: the current datasets stay readable, and are kept if the export fails
+    export_dir = os.path.abspath(export_dir)
+    build_dir = f"{export_dir}.build-{uuid.uuid4().hex}"
+    previous_dir = f"{export_dir}.previous-{uuid.uuid4().hex}"
+
+    try:
+        export_report = sync_analytics_export(build_dir, False, batch_size, log)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    # an empty export has no directory
+    os.makedirs(build_dir, exist_ok=True)
+
+    if os.path.isdir(export_dir):
+        os.rename(export_dir, previous_dir)
+    os.rename(build_dir, export_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+
+    return export_report
@@ -0,0 +1,9 @@
+from database import backfill_training_features
+
+
+# One-off command writing the training_features records for existing training docs
+# Usage: python backfill_training_features.py
+
+if __name__ == "__main__":
+    backfilled_count = backfill_training_features()
+    print(f"Backfilled {backfilled_count} training feature records")
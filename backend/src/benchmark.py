@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmark_fakes import (
+    FakeFirestoreClient,
+    FakeStorageClient,
+    make_replay_chains,
+    make_statement_lines,
+    make_statement_pdf,
+    make_synthetic_statement_template,
+    make_synthetic_training_statements,
+    make_synthetic_transactions,
+    make_transactions_csv,
+)
+from database import build_training_feature_record, set_firestore_client
+from executors import run_blocking
+from llm_cache import NullLLMCache, set_llm_cache
+from resources import resources
+from services import (
+    extract_analysis_from_statement_df,
+    predict_loan_decision,
+    preprocess_df,
+    read_transactions_csv,
+    rescore_loan_decisions,
+)
+from statement_templates import statement_template_registry
+
+
+# Offline benchmark of the prediction pipeline, with GCS, Firestore and the LLM chains
+# replaced by local stand-ins (see benchmark_fakes.py). The results are saved as json
+# so that they can be compared across commits.
+# Usage: python benchmark.py [--transactions 500] [--compare benchmark_results/<file>.json]
+
+BENCHMARK_RESULTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "benchmark_results"
+)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize_latencies(latencies, wall_seconds, errors=0):
+    latencies = np.asarray(latencies)
+
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput_per_second": len(latencies) / wall_seconds if wall_seconds else 0.0,
+        "mean_ms": float(latencies.mean() * 1000) if len(latencies) else None,
+        "p50_ms": (
+            float(np.percentile(latencies, 50) * 1000) if len(latencies) else None
+        ),
+        "p99_ms": (
+            float(np.percentile(latencies, 99) * 1000) if len(latencies) else None
+        ),
+    }
+
+
+def benchmark_sync(func, iterations, make_args=tuple, warmup=1):
+    # make_args builds fresh arguments for every call, outside of the timed section
+    for _ in range(warmup):
+        func(*make_args())
+
+    latencies = []
+    wall_start_time = time.perf_counter()
+
+    for _ in range(iterations):
+        args = make_args()
+        start_time = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start_time)
+
+    return summarize_latencies(latencies, time.perf_counter() - wall_start_time)
+
+
+async def benchmark_async(make_coroutine, num_calls, concurrency, warmup=1):
+    # make_coroutine(call_num) returns the awaitable of a call, run with at most
+    # `concurrency` calls in flight
+    for call_num in range(warmup):
+        await make_coroutine(call_num)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def timed_call(call_num):
+        nonlocal errors
+
+        async with semaphore:
+            start_time = time.perf_counter()
+
+            try:
+                await make_coroutine(call_num)
+            except Exception:
+                errors += 1
+                return
+
+            latencies.append(time.perf_counter() - start_time)
+
+    wall_start_time = time.perf_counter()
+    await asyncio.gather(*(timed_call(call_num) for call_num in range(num_calls)))
+
+    return summarize_latencies(latencies, time.perf_counter() - wall_start_time, errors)
+
+
+def install_fakes(args, num_statements):
+    # Synthetic statements in the fake bucket, a synthetic training set in the
+    # fake Firestore and replayed responses for the LLM chains
+    statement_pdfs = {}
+    for statement_num in range(num_statements):
+        transactions = make_synthetic_transactions(
+            args.transactions, seed=args.seed + statement_num
+        )
+        statement_pdfs[f"benchmark/statement_{statement_num}.pdf"] = make_statement_pdf(
+            make_statement_lines(transactions, "Synthetic Bank", 2023)
+        )
+
+    # seeded without latency, which only applies to the benchmarked calls
+    firestore_client = FakeFirestoreClient()
+    training_features_collection = firestore_client.collection("training_features")
+    for training_statement in make_synthetic_training_statements(
+        args.training_size, args.seed
+    ):
+        statement_ref = training_statement["statement_ref"]
+        training_features_collection.document(statement_ref).set(
+            build_training_feature_record(statement_ref, training_statement)
+        )
+
+    # stored statements for the bulk re-scoring, with their features and a decision
+    statements_collection = firestore_client.collection("statements")
+    for statement_num, statement_analysis in enumerate(
+        make_synthetic_training_statements(args.rescore_statements, args.seed + 1)
+    ):
+        statement_analysis.pop("statement_ref")
+        firestore_client.write(
+            statements_collection.document(f"rescore-{statement_num}"),
+            statement_analysis,
+        )
+    firestore_client.latency_seconds = args.firestore_latency
+
+    recorded_responses = None
+    if args.recorded_responses:
+        with open(args.recorded_responses) as recorded_responses_file:
+            recorded_responses = json.load(recorded_responses_file)
+
+    # the synthetic statements are then parsed without the LLM
+    if args.statement_template:
+        statement_template_registry.register(make_synthetic_statement_template())
+
+    set_firestore_client(firestore_client)
+    set_llm_cache(NullLLMCache())
+    resources.override(
+        storage_client=FakeStorageClient(statement_pdfs, args.storage_latency),
+        **make_replay_chains(args.llm_latency, recorded_responses),
+    )
+
+    return list(statement_pdfs)
+
+
+async def run_benchmarks(args):
+    results = {}
+
+    statement_pdf_blobs = install_fakes(args, args.statements)
+    await run_blocking(resources.startup)
+
+    # preprocess_df on the raw dataframe of a statement
+    raw_df = read_transactions_csv(
+        make_transactions_csv(
+            make_synthetic_transactions(args.transactions, seed=args.seed)
+        )
+    )
+    results["preprocess_df"] = benchmark_sync(
+        preprocess_df, args.iterations, lambda: (raw_df.copy(),)
+    )
+
+    # aggregation and for/against reasons of an extracted statement
+    transactions_df = preprocess_df(raw_df.copy())
+    statement_data = {
+        "country_code": "US",
+        "bank_name": "Synthetic Bank",
+        "statement_year": 2023,
+        "statement_pdf_blob": statement_pdf_blobs[0],
+        "transactions_df": transactions_df,
+    }
+    results["extract_analysis_from_statement_df"] = await benchmark_async(
+        lambda call_num: extract_analysis_from_statement_df(dict(statement_data)),
+        args.iterations,
+        concurrency=1,
+    )
+
+    # knn prediction against the synthetic training set
+    statement_analysis = await extract_analysis_from_statement_df(dict(statement_data))
+    results["predict_loan_decision"] = benchmark_sync(
+        predict_loan_decision,
+        args.iterations,
+        lambda: (statement_analysis, False),
+    )
+
+    # bulk re-scoring of the stored statements, without writing the decisions back
+    # so that every iteration has the same work
+    if args.rescore_statements:
+        results["rescore_loan_decisions"] = benchmark_sync(
+            rescore_loan_decisions,
+            args.iterations,
+            lambda: (False, True),
+        )
+
+    # the full endpoint, from the pdf download to the saved analysis
+    import httpx
+
+    from main import app
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://benchmark",
+        timeout=None,
+    ) as client:
+
+        async def call_endpoint(call_num):
+            response = await client.post(
+                "/get_loan_prediction_endpoint/",
+                params={
+                    "statement_pdf_blob": statement_pdf_blobs[
+                        call_num % len(statement_pdf_blobs)
+                    ]
+                },
+            )
+            response.raise_for_status()
+
+        results["get_loan_prediction_endpoint"] = await benchmark_async(
+            call_endpoint, args.requests, args.concurrency
+        )
+
+    await resources.shutdown()
+
+    return results
+
+
+def print_results(results, baseline_results=None):
+    print(
+        f"{'benchmark':<36} {'calls/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>7}"
+    )
+
+    for name, result in results.items():
+        print(
+            f"{name:<36} {result['throughput_per_second']:>10.2f} "
+            f"{result['p50_ms'] or 0:>10.2f} {result['p99_ms'] or 0:>10.2f} "
+            f"{result['errors']:>7}"
+        )
+
+        baseline_result = (baseline_results or {}).get(name)
+        if baseline_result and baseline_result["p50_ms"] and result["p50_ms"]:
+            print(
+                f"{'  vs baseline':<36} "
+                f"{result['throughput_per_second'] / baseline_result['throughput_per_second'] - 1:>+10.1%} "
+                f"{result['p50_ms'] / baseline_result['p50_ms'] - 1:>+10.1%} "
+                f"{result['p99_ms'] / baseline_result['p99_ms'] - 1:>+10.1%}"
+            )
+
+
+def save_results(results, config, output_dir):
+    commit = get_git_commit()
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+    os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, f"{timestamp}_{commit}.json")
+
+    with open(results_path, "w") as results_file:
+        json.dump(
+            {
+                "commit": commit,
+                "timestamp": timestamp,
+                "config": config,
+                "results": results,
+            },
+            results_file,
+            indent=2,
+        )
+
+    return results_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark")
+    parser.add_argument("--transactions", type=int, default=500)
+    parser.add_argument("--statements", type=int, default=8)
+    parser.add_argument("--training-size", type=int, default=1000)
+    parser.add_argument("--rescore-statements", type=int, default=100000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--storage-latency", type=float, default=0.05)
+    parser.add_argument("--firestore-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument(
+        "--recorded-responses",
+        help="json file of recorded responses per chain (transactions_chain, ...)",
+    )
+    parser.add_argument(
+        "--statement-template",
+        action="store_true",
+        help="register a template of the synthetic statement layout",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=BENCHMARK_RESULTS_DIR)
+    parser.add_argument("--compare", help="results file of a previous run")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run_benchmarks(args))
+
+    baseline_results = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline_results = json.load(baseline_file)["results"]
+
+    print_results(results, baseline_results)
+
+    config = {
+        name: value
+        for name, value in vars(args).items()
+        if name not in ("output_dir", "compare")
+    }
+    print(f"Results saved to {save_results(results, config, args.output_dir)}")
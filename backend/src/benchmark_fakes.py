@@ -0,0 +1,628 @@
+import asyncio
+import copy
+import random
+import re
+import threading
+import time
+import uuid
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import LLMResult
+
+from statement_templates import RegexStatementTemplate
+from training_index import FEATURE_FIELDS
+
+
+# Local stand-ins for GCS, Firestore and the LLM chains, and synthetic statements
+# and training sets, so that the pipeline can be profiled offline (see benchmark.py).
+# Every stand-in waits for a configurable latency before answering.
+
+
+class FakeBlob:
+    def __init__(self, storage_client, name):
+        self.storage_client = storage_client
+        self.name = name
+
+    def download_to_file(self, file_obj):
+        self.storage_client.wait()
+        file_obj.write(self.storage_client.blobs[self.name])
+
+
+class FakeBucket:
+    def __init__(self, storage_client):
+        self.storage_client = storage_client
+
+    def blob(self, blob_name, chunk_size=None):
+        return FakeBlob(self.storage_client, blob_name)
+
+
+class FakeStorageClient:
+    """
+    Storage client serving in-memory pdfs (blob name -> bytes) from a single bucket.
+    """
+
+    def __init__(self, blobs=None, latency_seconds=0.0):
+        self.blobs = dict(blobs or {})
+        self.latency_seconds = latency_seconds
+
+    def wait(self):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self)
+
+    def list_blobs(self, bucket_name, prefix=None):
+        self.wait()
+
+        return [
+            FakeBlob(self, blob_name)
+            for blob_name in sorted(self.blobs)
+            if blob_name.startswith(prefix or "")
+        ]
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, data, field_paths=None, reference=None):
+        self.id = doc_id
+        self.reference = reference
+        self.exists = data is not None
+        self._data = data
+        self._field_paths = field_paths
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+
+        if self._field_paths is None:
+            return copy.deepcopy(self._data)
+
+        return {
+            field: copy.deepcopy(self._data[field])
+            for field in self._field_paths
+            if field in self._data
+        }
+
+
+class FakeDocumentReference:
+    def __init__(self, firestore_client, collection_name, doc_id):
+        self.firestore_client = firestore_client
+        self.collection_name = collection_name
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self.collection_name}/{self.id}"
+
+    def set(self, data):
+        self.firestore_client.wait()
+        self.firestore_client.write(self, data)
+
+    def update(self, fields):
+        self.firestore_client.wait()
+        self.firestore_client.write(self, fields, merge=True)
+
+    def get(self, field_paths=None):
+        self.firestore_client.wait()
+        return self.firestore_client.read(self, field_paths)
+
+    def collection(self, collection_name):
+        # subcollections are kept as collections named by their full path
+        return FakeCollectionReference(
+            self.firestore_client,
+            f"{self.collection_name}/{self.id}/{collection_name}",
+        )
+
+
+class FakeQuery:
+    def __init__(
+        self,
+        firestore_client,
+        collection_name,
+        filters=(),
+        field_paths=None,
+        limit=None,
+    ):
+        self.firestore_client = firestore_client
+        self.collection_name = collection_name
+        self._filters = filters
+        self._field_paths = field_paths
+        self._limit = limit
+
+    def _copy(self, **kwargs):
+        query_args = {
+            "filters": self._filters,
+            "field_paths": self._field_paths,
+            "limit": self._limit,
+            **kwargs,
+        }
+        return FakeQuery(self.firestore_client, self.collection_name, **query_args)
+
+    def where(self, field_path, op_string, value):
+        # only equality filters are used by the database module
+        if op_string != "==":
+            raise ValueError(f"Unsupported filter operator: {op_string}")
+
+        return self._copy(filters=self._filters + ((field_path, value),))
+
+    def select(self, field_paths):
+        return self._copy(field_paths=list(field_paths))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def stream(self):
+        self.firestore_client.wait()
+
+        documents = self.firestore_client.collection_documents(self.collection_name)
+        matched = 0
+
+        for doc_id, data in documents:
+            if all(data.get(field) == value for field, value in self._filters):
+                yield FakeDocumentSnapshot(
+                    doc_id,
+                    data,
+                    self._field_paths,
+                    FakeDocumentReference(
+                        self.firestore_client, self.collection_name, doc_id
+                    ),
+                )
+
+                matched += 1
+                if self._limit is not None and matched >= self._limit:
+                    return
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    def document(self, doc_id=None):
+        return FakeDocumentReference(
+            self.firestore_client, self.collection_name, doc_id or uuid.uuid4().hex[:20]
+        )
+
+
+class FakeWriteBatch:
+    def __init__(self, firestore_client):
+        self.firestore_client = firestore_client
+        self._writes = []
+
+    def set(self, doc_ref, data):
+        self._writes.append((doc_ref, data, False))
+
+    def update(self, doc_ref, fields):
+        self._writes.append((doc_ref, fields, True))
+
+    def commit(self):
+        self.firestore_client.wait()
+
+        for doc_ref, data, merge in self._writes:
+            self.firestore_client.write(doc_ref, data, merge)
+
+        self._writes = []
+
+
+class FakeFirestoreClient:
+    """
+    In-memory Firestore client covering the calls made by the database module.
+    Every round trip (get, set, update, query, batch commit, get_all) waits once.
+    """
+
+    def __init__(self, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def write(self, doc_ref, data, merge=False):
+        # the data is copied, the same way it would be serialized by the client
+        data = copy.deepcopy(data)
+
+        with self._lock:
+            documents = self._collections.setdefault(doc_ref.collection_name, {})
+
+            if merge:
+                if doc_ref.id not in documents:
+                    raise KeyError(f"No document to update: {doc_ref.id}")
+                documents[doc_ref.id].update(data)
+            else:
+                documents[doc_ref.id] = data
+
+    def read(self, doc_ref, field_paths=None):
+        with self._lock:
+            data = self._collections.get(doc_ref.collection_name, {}).get(doc_ref.id)
+
+        return FakeDocumentSnapshot(doc_ref.id, data, field_paths, doc_ref)
+
+    def collection_documents(self, collection_name):
+        with self._lock:
+            return list(self._collections.get(collection_name, {}).items())
+
+    def collection(self, collection_name):
+        return FakeCollectionReference(self, collection_name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, doc_refs, field_paths=None):
+        self.wait()
+
+        for doc_ref in doc_refs:
+            yield self.read(doc_ref, field_paths)
+
+    def close(self):
+        pass
+
+
+class ReplayChatChain:
+    """
+    Stand-in for an LLM chain replaying recorded responses after a fixed latency,
+    or streaming them over that latency.
+    `responses` is either a list of responses, replayed in order and cycled, or a
+    function building the response from the chain input.
+    """
+
+    def __init__(self, responses, latency_seconds=0.0, chars_per_token=4):
+        self.responses = responses
+        self.latency_seconds = latency_seconds
+        self.chars_per_token = chars_per_token
+        self._response_num = 0
+
+    def _next_response(self, chain_input):
+        if callable(self.responses):
+            return self.responses(chain_input)
+
+        response = self.responses[self._response_num % len(self.responses)]
+        self._response_num += 1
+
+        return copy.deepcopy(response)
+
+    async def ainvoke(self, chain_input):
+        await asyncio.sleep(self.latency_seconds)
+        content = self._next_response(chain_input)
+
+        # token usage estimated from the sizes of the prompt and the response
+        return AIMessage(
+            content=content,
+            response_metadata={
+                "token_usage": {
+                    "prompt_tokens": len(str(chain_input)) // self.chars_per_token,
+                    "completion_tokens": len(content) // self.chars_per_token,
+                },
+                "finish_reason": "stop",
+            },
+        )
+
+    async def astream(self, chain_input, chunk_chars=64):
+        # the response in chunks, with the latency spread over them
+        content = self._next_response(chain_input)
+        content_chunks = [
+            content[start : start + chunk_chars]
+            for start in range(0, len(content), chunk_chars)
+        ] or [""]
+
+        for chunk_num, content_chunk in enumerate(content_chunks):
+            await asyncio.sleep(self.latency_seconds / len(content_chunks))
+
+            yield AIMessageChunk(
+                content=content_chunk,
+                response_metadata=(
+                    {"finish_reason": "stop"}
+                    if chunk_num == len(content_chunks) - 1
+                    else {}
+                ),
+            )
+
+    async def arun(self, chain_input, callbacks=None):
+        await asyncio.sleep(self.latency_seconds)
+        response = self._next_response(chain_input)
+
+        # the token usage is reported to the callbacks, like the llm of a chain does
+        for callback in callbacks or []:
+            callback.on_llm_end(
+                LLMResult(
+                    generations=[],
+                    llm_output={
+                        "token_usage": {
+                            "prompt_tokens": len(str(chain_input))
+                            // self.chars_per_token,
+                            "completion_tokens": len(str(response))
+                            // self.chars_per_token,
+                        }
+                    },
+                )
+            )
+
+        return response
+
+
+# Synthetic statements
+
+# description -> (category, deposit, min amount, max amount)
+SYNTHETIC_TRANSACTION_TYPES = {
+    "PAYROLL ACME CORP": ("Deposits - Salary Paycheck", True, 1500, 6000),
+    "TRANSFER FROM SAVINGS": ("Deposits - Transfers In", True, 50, 1500),
+    "ATM WITHDRAWAL": ("Withdrawals - Cash Withdrawals ATM", False, 20, 400),
+    "TRANSFER TO SAVINGS": ("Withdrawals - Transfers Out", False, 50, 1000),
+    "OAKWOOD APARTMENTS RENT": ("Payments - Rent", False, 700, 2500),
+    "CITY POWER AND WATER": ("Payments - Utility Bills", False, 40, 300),
+    "AUTO LOAN PAYMENT": ("Payments - Loan Payments", False, 150, 700),
+    "FRESH MARKET": ("Purchases - Groceries Food", False, 10, 250),
+    "CORNER BISTRO": ("Purchases - Dining Restaurants", False, 10, 150),
+    "FUEL STATION": ("Purchases - Gas Fuel", False, 20, 120),
+    "MONTHLY ACCOUNT FEE": ("Fees Charges - Account Maintenance Fees", False, 5, 25),
+}
+SYNTHETIC_DEPOSIT_SHARE = 0.15
+
+STATEMENT_LINE_PATTERN = re.compile(
+    r"^(\d{4}-\d{2})-\d{2} (.+) (\d+\.\d{2}) (CR|DR)$", re.MULTILINE
+)
+
+
+def make_synthetic_statement_template():
+    # Template of the synthetic statement layout, to benchmark the parsing without the LLM
+    return RegexStatementTemplate(
+        name="synthetic_bank",
+        detect_pattern=r"(?m)^Synthetic Bank$",
+        line_pattern=(
+            r"^(?P<date>\d{4}-\d{2}-\d{2}) (?P<description>.+) "
+            r"(?P<amount>\d+\.\d{2}) (?P<direction>CR|DR)$"
+        ),
+        date_format="%Y-%m-%d",
+        credit_markers=["CR"],
+        bank_name="Synthetic Bank",
+        country_code="US",
+    )
+
+
+def make_synthetic_transactions(num_transactions, statement_year=2023, seed=0):
+    # Transactions spread over the months of the statement year, sorted by date
+    rng = random.Random(seed)
+    deposit_descriptions = [
+        description
+        for description, (_, deposit, _, _) in SYNTHETIC_TRANSACTION_TYPES.items()
+        if deposit
+    ]
+    withdrawal_descriptions = [
+        description
+        for description, (_, deposit, _, _) in SYNTHETIC_TRANSACTION_TYPES.items()
+        if not deposit
+    ]
+
+    transactions = []
+    for _ in range(num_transactions):
+        if rng.random() < SYNTHETIC_DEPOSIT_SHARE:
+            description = rng.choice(deposit_descriptions)
+        else:
+            description = rng.choice(withdrawal_descriptions)
+
+        category, deposit, min_amount, max_amount = SYNTHETIC_TRANSACTION_TYPES[
+            description
+        ]
+        transactions.append(
+            {
+                "date": f"{statement_year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "description": description,
+                "amount": f"{rng.uniform(min_amount, max_amount):.2f}",
+                "deposit": deposit,
+                "category": category,
+            }
+        )
+
+    transactions.sort(key=lambda transaction: transaction["date"])
+
+    return transactions
+
+
+def make_transactions_csv(transactions):
+    # The csv the transaction extraction chain responds with
+    return "\n".join(
+        ",".join(
+            [
+                transaction["date"][:7],
+                transaction["description"],
+                transaction["amount"],
+                "YES" if transaction["deposit"] else "NO",
+                transaction["category"],
+            ]
+        )
+        for transaction in transactions
+    )
+
+
+def make_statement_lines(transactions, bank_name, statement_year):
+    return [
+        f"{bank_name}",
+        f"Account statement for the year {statement_year}",
+        "Date Description Amount CR/DR",
+    ] + [
+        f"{transaction['date']} {transaction['description']} {transaction['amount']} "
+        f"{'CR' if transaction['deposit'] else 'DR'}"
+        for transaction in transactions
+    ]
+
+
+def _escape_pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_statement_pdf(lines, lines_per_page=60):
+    # Minimal text-only pdf, one Helvetica line per statement line
+    pages = [
+        lines[start : start + lines_per_page]
+        for start in range(0, len(lines), lines_per_page)
+    ] or [[]]
+
+    num_pages = len(pages)
+    page_ids = [4 + 2 * page_num for page_num in range(num_pages)]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] "
+        f"/Count {num_pages} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+
+    for page_id, page_lines in zip(page_ids, pages):
+        content = "BT /F1 9 Tf 12 TL 40 800 Td " + " ".join(
+            f"({_escape_pdf_text(line)}) Tj T*" for line in page_lines
+        )
+        content += " ET"
+
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>".encode()
+        )
+        objects.append(
+            f"<< /Length {len(content)} >>\nstream\n{content}\nendstream".encode()
+        )
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for object_num, pdf_object in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{object_num} 0 obj\n".encode() + pdf_object + b"\nendobj\n"
+
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode()
+    pdf += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode()
+
+    return bytes(pdf)
+
+
+def replay_transactions_csv(chain_input, include_category=True):
+    # Transaction extraction response for a synthetic statement (or a chunk of it)
+    return "\n".join(
+        ",".join(
+            [
+                year_month,
+                description,
+                amount,
+                "YES" if direction == "CR" else "NO",
+            ]
+            + (
+                [SYNTHETIC_TRANSACTION_TYPES.get(description, ("Other",))[0]]
+                if include_category
+                else []
+            )
+        )
+        for year_month, description, amount, direction in STATEMENT_LINE_PATTERN.findall(
+            chain_input["bank_statement"]
+        )
+    )
+
+
+def replay_transaction_rows_csv(chain_input):
+    # Same rows without the categories, when they are predicted locally
+    return replay_transactions_csv(chain_input, include_category=False)
+
+
+CATEGORIZATION_LINE_PATTERN = re.compile(r"^(\d+),(.*) \((?:deposit|withdrawal)\)$")
+
+
+def replay_categorization(chain_input):
+    # "number,category" line for each transaction the local categorization is unsure of
+    category_lines = []
+
+    for line in chain_input["transactions"].splitlines():
+        match = CATEGORIZATION_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+
+        transaction_num, description = match.groups()
+        category = SYNTHETIC_TRANSACTION_TYPES.get(description.upper(), ("Other",))[0]
+        category_lines.append(f"{transaction_num},{category}")
+
+    return "\n".join(category_lines)
+
+
+def make_replay_chains(llm_latency_seconds=0.0, recorded_responses=None):
+    # recorded_responses (chain name -> list of responses) replaces the synthetic ones
+    recorded_responses = recorded_responses or {}
+
+    return {
+        "transactions_chain": ReplayChatChain(
+            recorded_responses.get("transactions_chain", replay_transactions_csv),
+            llm_latency_seconds,
+        ),
+        "transaction_rows_chain": ReplayChatChain(
+            recorded_responses.get(
+                "transaction_rows_chain", replay_transaction_rows_csv
+            ),
+            llm_latency_seconds,
+        ),
+        "categorization_chain": ReplayChatChain(
+            recorded_responses.get("categorization_chain", replay_categorization),
+            llm_latency_seconds,
+        ),
+        "metadata_chain": ReplayChatChain(
+            recorded_responses.get(
+                "metadata_chain",
+                [
+                    [
+                        {
+                            "country_code_iso_3166_standard": "US",
+                            "bank_name": "Synthetic Bank",
+                            "statement_year": 2023,
+                        }
+                    ]
+                ],
+            ),
+            llm_latency_seconds,
+        ),
+        "for_against_chain": ReplayChatChain(
+            recorded_responses.get(
+                "for_against_chain",
+                [
+                    "Reasons for:\n- Steady monthly salary deposits\n\n"
+                    "Reasons against:\n- Rent takes a large share of the income"
+                ],
+            ),
+            llm_latency_seconds,
+        ),
+    }
+
+
+# Synthetic training set
+
+
+def make_synthetic_training_statements(num_statements, seed=0):
+    # Training feature records, approved when the average month leaves savings
+    rng = random.Random(seed)
+    training_statements = []
+
+    for statement_num in range(num_statements):
+        deposit_mean = rng.uniform(1000, 9000)
+        feature_values = {
+            "monthly_deposit_mean": deposit_mean,
+            "monthly_withdrawal_mean": -rng.uniform(500, 9000),
+            "monthly_rent_mean": -rng.uniform(0, 0.5) * deposit_mean,
+            "monthly_utilities_mean": -rng.uniform(40, 400),
+            "monthly_loan_payment_mean": -rng.uniform(0, 0.3) * deposit_mean,
+            "monthly_balance_mean": rng.uniform(-2000, 20000),
+        }
+        monthly_savings = (
+            feature_values["monthly_deposit_mean"]
+            + feature_values["monthly_withdrawal_mean"]
+        )
+
+        training_statements.append(
+            {
+                **{field: feature_values[field] for field in FEATURE_FIELDS},
+                "loan_decision": 1 if monthly_savings > 0 else 0,
+                "country_code": "US",
+                "bank_name": "Synthetic Bank",
+                "statement_year": 2023,
+                "statement_ref": f"synthetic-{statement_num}",
+            }
+        )
+
+    return training_statements
@@ -0,0 +1,406 @@
+import os
+import re
+import threading
+
+from prompts import TRANSACTION_CATEGORIES
+
+
+# Local categorization of the transactions, so that the LLM is only asked about the
+# descriptions it can not settle: a memo of the categories confirmed on previous
+# statements, then keyword rules matched with a trie, then (optionally) a classifier
+# trained on the memo.
+
+LOCAL_CATEGORIZATION_ENABLED = os.environ.get("LOCAL_CATEGORIZATION", "1") == "1"
+CATEGORY_CLASSIFIER_ENABLED = os.environ.get("CATEGORY_CLASSIFIER", "0") == "1"
+CATEGORY_CLASSIFIER_MIN_SAMPLES = int(
+    os.environ.get("CATEGORY_CLASSIFIER_MIN_SAMPLES", 200)
+)
+CATEGORY_CLASSIFIER_MIN_PROBABILITY = float(
+    os.environ.get("CATEGORY_CLASSIFIER_MIN_PROBABILITY", 0.9)
+)
+
+DEPOSIT_CATEGORY_PREFIX = "Deposits - "
+OTHER_CATEGORY = "Other"
+
+# category -> keywords, a keyword is matched on whole words of the description.
+# Words that are common in other descriptions (eg. "power", "shell") are only
+# matched in a longer keyword
+CATEGORY_KEYWORDS = {
+    "Deposits - Salary Paycheck": [
+        "payroll",
+        "salary",
+        "paycheck",
+        "wages",
+        "direct deposit",
+        "dir dep",
+    ],
+    "Deposits - Transfers In": [
+        "transfer from",
+        "xfer from",
+        "incoming transfer",
+        "incoming wire",
+    ],
+    "Withdrawals - Cash Withdrawals ATM": ["atm", "cash withdrawal"],
+    "Withdrawals - Transfers Out": [
+        "transfer to",
+        "xfer to",
+        "outgoing transfer",
+        "outgoing wire",
+    ],
+    "Payments - Mortgage": ["mortgage"],
+    "Payments - Rent": ["rent", "rent payment", "landlord"],
+    "Payments - Utility Bills": [
+        "utility",
+        "utilities",
+        "electric",
+        "electricity",
+        "power company",
+        "power bill",
+        "water bill",
+        "water utility",
+        "water company",
+        "sewer",
+        "natural gas",
+        "internet",
+        "broadband",
+        "comcast",
+        "xfinity",
+    ],
+    "Payments - Loan Payments": [
+        "loan payment",
+        "loan pmt",
+        "loan repayment",
+        "student loan",
+        "auto loan",
+        "car loan",
+        "personal loan",
+        "navient",
+    ],
+    "Payments - Credit Card Payments": [
+        "credit card",
+        "card payment",
+        "amex",
+        "american express",
+    ],
+    "Payments - Insurance Premiums": [
+        "insurance",
+        "insurance premium",
+        "geico",
+        "allstate",
+        "state farm",
+    ],
+    "Purchases - Groceries Food": [
+        "grocery",
+        "groceries",
+        "supermarket",
+        "whole foods",
+        "safeway",
+        "kroger",
+        "aldi",
+        "lidl",
+        "tesco",
+        "trader joe",
+    ],
+    "Purchases - Dining Restaurants": [
+        "restaurant",
+        "cafe",
+        "coffee",
+        "bistro",
+        "diner",
+        "bar grill",
+        "bar and grill",
+        "pizza",
+        "starbucks",
+        "mcdonalds",
+        "doordash",
+        "uber eats",
+        "grubhub",
+    ],
+    "Purchases - Retail Clothing": [
+        "clothing",
+        "apparel",
+        "boutique",
+        "zara",
+        "uniqlo",
+        "old navy",
+        "nordstrom",
+    ],
+    "Purchases - Gas Fuel": [
+        "fuel",
+        "gasoline",
+        "petrol",
+        "gas station",
+        "shell oil",
+        "shell service station",
+        "exxon",
+        "chevron",
+    ],
+    "Investments - Stock Bond Purchases": [
+        "brokerage",
+        "stock purchase",
+        "bond purchase",
+        "robinhood",
+        "etrade",
+    ],
+    "Investments - Retirement Account Contributions": [
+        "401k",
+        "ira contribution",
+        "traditional ira",
+        "roth ira",
+        "retirement",
+        "pension",
+    ],
+    "Fees Charges - Account Maintenance Fees": [
+        "maintenance fee",
+        "monthly fee",
+        "account fee",
+        "service fee",
+        "service charge",
+    ],
+    "Fees Charges - Overdraft Fees": ["overdraft", "nsf", "insufficient funds"],
+}
+
+
+def normalize_description(description):
+    # lower case words, without the numbers (dates, references, card numbers)
+    return " ".join(
+        word
+        for word in re.findall(r"[a-z0-9]+", str(description).lower())
+        if not word.isdigit()
+    )
+
+
+def is_deposit(deposit):
+    # the Deposit field of the csv rows and of the saved transactions, "YES" or "NO"
+    return (deposit or "").strip() == "YES"
+
+
+def is_category_compatible(category, deposit):
+    # deposits only go to the "Deposits" categories, withdrawals to all the others
+    if deposit is None or category == OTHER_CATEGORY:
+        return True
+
+    return category.startswith(DEPOSIT_CATEGORY_PREFIX) == deposit
+
+
+class KeywordTrie:
+    """
+    Trie of keywords over the words of the descriptions. A description gets the
+    category of its longest keyword, and no category when its longest keywords
+    belong to different categories.
+    """
+
+    def __init__(self, category_keywords=CATEGORY_KEYWORDS):
+        self._root = {}
+
+        for category, keywords in category_keywords.items():
+            for keyword in keywords:
+                node = self._root
+                for word in normalize_description(keyword).split():
+                    node = node.setdefault(word, {})
+                node.setdefault(None, set()).add(category)
+
+    def match(self, normalized_description, deposit=None):
+        words = normalized_description.split()
+        best_length = 0
+        best_categories = set()
+
+        for start in range(len(words)):
+            node = self._root
+
+            for length, word in enumerate(words[start:], start=1):
+                node = node.get(word)
+                if node is None:
+                    break
+
+                categories = {
+                    category
+                    for category in node.get(None, ())
+                    if is_category_compatible(category, deposit)
+                }
+                if not categories:
+                    continue
+
+                if length > best_length:
+                    best_length, best_categories = length, set(categories)
+                elif length == best_length:
+                    best_categories |= categories
+
+        if len(best_categories) != 1:
+            return None
+
+        return next(iter(best_categories))
+
+
+class CategoryClassifier:
+    """
+    Character n-gram classifier trained on the memo, only trusted above a probability.
+    """
+
+    def __init__(self, min_probability=CATEGORY_CLASSIFIER_MIN_PROBABILITY):
+        self.min_probability = min_probability
+        self._pipeline = None
+
+    @staticmethod
+    def _features(normalized_description, deposit):
+        return f"{'deposit' if deposit else 'withdrawal'} {normalized_description}"
+
+    def fit(self, memo):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+
+        texts, categories, weights = [], [], []
+        for (normalized_description, deposit), category_counts in memo.items():
+            for category, count in category_counts.items():
+                texts.append(self._features(normalized_description, deposit))
+                categories.append(category)
+                weights.append(count)
+
+        if len(set(categories)) < 2:
+            self._pipeline = None
+            return
+
+        pipeline = make_pipeline(
+            TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5)),
+            LogisticRegression(max_iter=1000),
+        )
+        pipeline.fit(texts, categories, logisticregression__sample_weight=weights)
+        self._pipeline = pipeline
+
+    def predict(self, normalized_description, deposit):
+        return self.predict_many([(normalized_description, deposit)])[0]
+
+    def predict_many(self, keys):
+        # keys are (normalized description, deposit), in one predict_proba call
+        if self._pipeline is None or not keys:
+            return [None] * len(keys)
+
+        rows_probabilities = self._pipeline.predict_proba(
+            [self._features(*key) for key in keys]
+        )
+        categories = []
+
+        for (_, deposit), probabilities in zip(keys, rows_probabilities):
+            best = probabilities.argmax()
+            category = self._pipeline.classes_[best]
+
+            if probabilities[best] < self.min_probability or not is_category_compatible(
+                category, deposit
+            ):
+                category = None
+
+            categories.append(category)
+
+        return categories
+
+
+class CategorizationEngine:
+    def __init__(
+        self,
+        category_keywords=CATEGORY_KEYWORDS,
+        classifier_enabled=CATEGORY_CLASSIFIER_ENABLED,
+        classifier_min_samples=CATEGORY_CLASSIFIER_MIN_SAMPLES,
+    ):
+        self.keyword_trie = KeywordTrie(category_keywords)
+        self.classifier = CategoryClassifier() if classifier_enabled else None
+        self.classifier_min_samples = classifier_min_samples
+
+        # (normalized description, deposit) -> {category: confirmed count}
+        self._memo = {}
+        self._classifier_stale = True
+        self._lock = threading.RLock()
+
+    def load(self, memo_entries):
+        with self._lock:
+            self._memo = {
+                (memo_entry["description"], memo_entry["deposit"]): dict(
+                    memo_entry["categories"]
+                )
+                for memo_entry in memo_entries
+            }
+            self._classifier_stale = True
+
+    def learn(self, transactions):
+        # Adds the categories of confirmed transactions to the memo,
+        # returns the updated memo entries so that they can be saved
+        updated_keys = set()
+
+        with self._lock:
+            for transaction in transactions:
+                category = transaction.get("Category")
+                if category not in TRANSACTION_CATEGORIES:
+                    continue
+
+                key = (
+                    normalize_description(transaction.get("Description") or ""),
+                    is_deposit(transaction.get("Deposit")),
+                )
+                if not key[0]:
+                    continue
+
+                category_counts = self._memo.setdefault(key, {})
+                category_counts[category] = category_counts.get(category, 0) + 1
+                updated_keys.add(key)
+
+            self._classifier_stale = self._classifier_stale or bool(updated_keys)
+
+            return [
+                {
+                    "description": description,
+                    "deposit": deposit,
+                    "categories": dict(self._memo[(description, deposit)]),
+                }
+                for description, deposit in updated_keys
+            ]
+
+    def _get_classifier(self):
+        # (re)trained on first use after the memo changed
+        if self.classifier is None:
+            return None
+
+        with self._lock:
+            if self._classifier_stale:
+                if len(self._memo) >= self.classifier_min_samples:
+                    self.classifier.fit(self._memo)
+                self._classifier_stale = False
+
+        return self.classifier
+
+    def categorize(self, description, deposit=None, use_classifier=True):
+        # Returns (category, source), with a None category when not sure.
+        # Without the classifier, only the memo and the keyword lookups run
+        normalized_description = normalize_description(description)
+        if not normalized_description:
+            return None, None
+
+        category_counts = self._memo.get((normalized_description, deposit))
+        if category_counts:
+            return max(category_counts, key=category_counts.get), "memo"
+
+        category = self.keyword_trie.match(normalized_description, deposit)
+        if category is not None:
+            return category, "rules"
+
+        classifier = self._get_classifier() if use_classifier else None
+        if classifier is not None:
+            category = classifier.predict(normalized_description, deposit)
+            if category is not None:
+                return category, "classifier"
+
+        return None, None
+
+    def classify(self, keys):
+        # Classifier categories of (normalized description, deposit) keys, in one
+        # batch, None when the classifier is disabled or not sure
+        classifier = self._get_classifier()
+        if classifier is None:
+            return [None] * len(keys)
+
+        return classifier.predict_many(keys)
+
+    def __len__(self):
+        return len(self._memo)
+
+
+categorization_engine = CategorizationEngine()
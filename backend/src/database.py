@@ -1,51 +1,570 @@
-import json
-from google.cloud import firestore
+import hashlib
 
+import numpy as np
 
-def save_statement_analysis(statement_analysis):
-    db = firestore.Client()
+from metrics import stage_timer
+from training_index import FEATURE_FIELDS
+
+
+# Fields read from a statement when it is used as a training datapoint
+TRAINING_FIELD_PATHS = FEATURE_FIELDS + ["loan_decision"]
+TRAINING_RECORD_FIELDS = TRAINING_FIELD_PATHS + [
+    "country_code",
+    "bank_name",
+    "statement_year",
+]
+TRAINING_FEATURES_SCHEMA_VERSION = 1
+TRAINING_BATCH_SIZE = 300
+FIRESTORE_MAX_BATCH_WRITES = 500
+# Transactions are kept out of the statement doc, in pages of columnar arrays
+# saved in its transaction_pages subcollection
+TRANSACTIONS_PAGE_SIZE = 500
+TRANSACTIONS_PAGES_COLLECTION = "transaction_pages"
+# Fields of the statement doc needed to read its transactions
+TRANSACTIONS_FIELD_PATHS = [
+    "transactions",
+    "transactions_count",
+    "transactions_page_size",
+]
+# Categories of the confirmed transactions, by normalized description and direction
+CATEGORY_MEMO_COLLECTION = "category_memo"
+
+_firestore_client = None
+
+
+def get_firestore_client():
+    # Shared client, it points to the emulator when FIRESTORE_EMULATOR_HOST is set
+    global _firestore_client
+
+    if _firestore_client is None:
+        from google.cloud import firestore
+
+        _firestore_client = firestore.Client()
+
+    return _firestore_client
+
+
+def set_firestore_client(firestore_client):
+    # Replaces the shared client, eg. with a local stand-in when benchmarking
+    global _firestore_client
+    _firestore_client = firestore_client
+
+
+def close_firestore_client():
+    global _firestore_client
+
+    if _firestore_client is not None:
+        _firestore_client.close()
+        _firestore_client = None
+
+
+def commit_batched_writes(db, writes, update=False):
+    # Commits (doc_ref, data) set writes in as few batches as possible, in order,
+    # or updates of existing docs with update=True
+    for start in range(0, len(writes), FIRESTORE_MAX_BATCH_WRITES):
+        batch = db.batch()
+
+        for doc_ref, data in writes[start : start + FIRESTORE_MAX_BATCH_WRITES]:
+            if update:
+                batch.update(doc_ref, data)
+            else:
+                batch.set(doc_ref, data)
+
+        batch.commit()
+
+
+def get_transactions_page_id(page_num):
+    # zero padded so that the pages are listed in order
+    return f"{page_num:05d}"
+
+
+def encode_transactions_page(transactions_columns, start, page_num, page_size):
+    # One array per column instead of one map per transaction
+    page_columns = {
+        column: values[start : start + page_size]
+        for column, values in transactions_columns.items()
+    }
+
+    return {
+        "page": page_num,
+        "page_size": page_size,
+        "total": len(next(iter(transactions_columns.values()), [])),
+        "count": len(next(iter(page_columns.values()), [])),
+        "columns": page_columns,
+    }
+
+
+def decode_transactions_page(transactions_page):
+    columns = transactions_page["columns"]
+
+    return [
+        {column: values[row_num] for column, values in columns.items()}
+        for row_num in range(transactions_page["count"])
+    ]
+
+
+def save_statement_analysis(statement_analysis, page_size=TRANSACTIONS_PAGE_SIZE):
+    # statement_analysis is already json-safe (see serialization.py),
+    # with its transactions encoded as columns
+    db = get_firestore_client()
     doc_ref = db.collection("statements").document()
 
-    # serializing and deserializing statement_analysis
-    # to make sure it can be saved in firestore
-    statement_analysis = json.loads(json.dumps(statement_analysis))
+    # the statement doc only keeps the summaries and the transactions count
+    statement_analysis = dict(statement_analysis)
+    transactions = statement_analysis.pop("transactions")
+    statement_analysis["transactions_count"] = len(transactions)
+    statement_analysis["transactions_page_size"] = page_size
 
-    doc_ref.set(statement_analysis)
+    transactions_pages_collection = doc_ref.collection(TRANSACTIONS_PAGES_COLLECTION)
+    writes = [
+        (
+            transactions_pages_collection.document(get_transactions_page_id(page_num)),
+            encode_transactions_page(transactions.columns, start, page_num, page_size),
+        )
+        for page_num, start in enumerate(range(0, len(transactions), page_size))
+    ]
+    # the statement doc is written last, its transactions are saved once it exists
+    writes.append((doc_ref, statement_analysis))
+
+    with stage_timer("firestore_write"):
+        commit_batched_writes(db, writes)
 
     return doc_ref.id
 
 
+def update_statement_analysis(statement_id, fields):
+    db = get_firestore_client()
+
+    with stage_timer("firestore_write"):
+        db.collection("statements").document(statement_id).update(fields)
+
+
+def build_training_feature_record(statement_id, statement_analysis):
+    # Compact, denormalized copy of the statement fields used for training
+    training_feature_record = {
+        field: statement_analysis.get(field) for field in TRAINING_RECORD_FIELDS
+    }
+    training_feature_record["statement_ref"] = statement_id
+    training_feature_record["schema_version"] = TRAINING_FEATURES_SCHEMA_VERSION
+
+    return training_feature_record
+
+
 def save_training_statement_analysis(statement_id):
-    db = firestore.Client()
-    doc_ref = db.collection("training").document(statement_id)
+    db = get_firestore_client()
+    batch = db.batch()
 
+    doc_ref = db.collection("training").document(statement_id)
     doc_value = {"statement_ref": statement_id}
+    batch.set(doc_ref, doc_value)
 
-    doc_ref.set(doc_value)
+    statement_analysis = get_statement_analysis(
+        statement_id, field_paths=TRAINING_RECORD_FIELDS
+    )
 
+    training_feature_record = None
+    if statement_analysis is not None:
+        training_feature_record = build_training_feature_record(
+            statement_id, statement_analysis
+        )
+        batch.set(
+            db.collection("training_features").document(statement_id),
+            training_feature_record,
+        )
 
-def get_training_statements(log=False):
-    db = firestore.Client()
-    training_collection_ref = db.collection("training")
-    training_docs = training_collection_ref.get()
+    with stage_timer("firestore_write"):
+        batch.commit()
 
-    training_statements = []
+    return training_feature_record
+
+
+def get_statement_analysis(statement_id, field_paths=None):
+    db = get_firestore_client()
+    statement_analysis_doc = (
+        db.collection("statements").document(statement_id).get(field_paths=field_paths)
+    )
+
+    if not statement_analysis_doc.exists:
+        return None
+
+    return statement_analysis_doc.to_dict()
+
+
+def get_statement_transactions(statement_id, page_num=0):
+    # Returns a page of the statement transactions, or None if the statement
+    # does not exist
+    db = get_firestore_client()
+    statement_doc_ref = db.collection("statements").document(statement_id)
+
+    transactions_page_doc = (
+        statement_doc_ref.collection(TRANSACTIONS_PAGES_COLLECTION)
+        .document(get_transactions_page_id(page_num))
+        .get()
+    )
+
+    if transactions_page_doc.exists:
+        transactions_page = transactions_page_doc.to_dict()
+
+        return {
+            "transactions": decode_transactions_page(transactions_page),
+            "page": page_num,
+            "page_size": transactions_page["page_size"],
+            "total": transactions_page["total"],
+        }
+
+    # Past the last page, or a statement saved with its transactions inline
+    statement_analysis_doc = statement_doc_ref.get(field_paths=TRANSACTIONS_FIELD_PATHS)
+
+    if not statement_analysis_doc.exists:
+        return None
+
+    statement_analysis = statement_analysis_doc.to_dict()
+    transactions = statement_analysis.get("transactions") or []
+    page_size = statement_analysis.get("transactions_page_size", TRANSACTIONS_PAGE_SIZE)
+
+    return {
+        "transactions": transactions[page_num * page_size : (page_num + 1) * page_size],
+        "page": page_num,
+        "page_size": page_size,
+        "total": statement_analysis.get("transactions_count", len(transactions)),
+    }
+
+
+def get_all_statement_transactions(statement_id):
+    # All the transactions of a statement, page after page
+    transactions_page = get_statement_transactions(statement_id)
+
+    if transactions_page is None:
+        return None
+
+    transactions = list(transactions_page["transactions"])
+    page_num = 1
+
+    while len(transactions) < transactions_page["total"]:
+        transactions_page = get_statement_transactions(statement_id, page_num)
+        if not transactions_page["transactions"]:
+            break
+
+        transactions += transactions_page["transactions"]
+        page_num += 1
+
+    return transactions
+
+
+def get_statements_transactions(
+    statement_analyses, db=None, batch_size=TRAINING_BATCH_SIZE
+):
+    # All the transactions of several statements, keyed by statement id, with the
+    # pages of every statement read in batched get_all calls. statement_analyses maps
+    # the statement ids to their docs, read with TRANSACTIONS_FIELD_PATHS
+    db = db or get_firestore_client()
+    statements_collection = db.collection("statements")
+
+    statements_transactions = {}
+    page_refs = {}  # page doc path -> (statement id, page number, page doc ref)
+
+    for statement_id, statement_analysis in statement_analyses.items():
+        # statements saved with their transactions inline
+        if "transactions_page_size" not in statement_analysis:
+            statements_transactions[statement_id] = list(
+                statement_analysis.get("transactions") or []
+            )
+            continue
+
+        statements_transactions[statement_id] = []
+        page_size = statement_analysis["transactions_page_size"]
+        num_pages = -(-(statement_analysis.get("transactions_count") or 0) // page_size)
+
+        transactions_pages_collection = statements_collection.document(
+            statement_id
+        ).collection(TRANSACTIONS_PAGES_COLLECTION)
+
+        for page_num in range(num_pages):
+            page_ref = transactions_pages_collection.document(
+                get_transactions_page_id(page_num)
+            )
+            page_refs[page_ref.path] = (statement_id, page_num, page_ref)
+
+    transactions_pages = {}
+    page_refs = list(page_refs.values())
+
+    for start in range(0, len(page_refs), batch_size):
+        batch_page_refs = page_refs[start : start + batch_size]
+        page_keys = {
+            page_ref.path: (statement_id, page_num)
+            for statement_id, page_num, page_ref in batch_page_refs
+        }
 
+        for transactions_page_doc in db.get_all(
+            [page_ref for _, _, page_ref in batch_page_refs]
+        ):
+            if transactions_page_doc.exists:
+                transactions_pages[page_keys[transactions_page_doc.reference.path]] = (
+                    decode_transactions_page(transactions_page_doc.to_dict())
+                )
+
+    # get_all does not keep the order of the refs
+    for statement_id, page_num in sorted(transactions_pages):
+        statements_transactions[statement_id] += transactions_pages[
+            (statement_id, page_num)
+        ]
+
+    return statements_transactions
+
+
+def get_category_memo_entry_id(description, deposit):
+    # the descriptions can contain slashes, which are not allowed in doc ids
+    key = f"{'YES' if deposit else 'NO'}:{description}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_category_memo(db=None):
+    db = db or get_firestore_client()
+
+    return [
+        category_memo_doc.to_dict()
+        for category_memo_doc in db.collection(CATEGORY_MEMO_COLLECTION).stream()
+    ]
+
+
+def save_category_memo_entries(category_memo_entries, db=None):
+    db = db or get_firestore_client()
+    category_memo_collection = db.collection(CATEGORY_MEMO_COLLECTION)
+
+    with stage_timer("firestore_write"):
+        commit_batched_writes(
+            db,
+            [
+                (
+                    category_memo_collection.document(
+                        get_category_memo_entry_id(
+                            category_memo_entry["description"],
+                            category_memo_entry["deposit"],
+                        )
+                    ),
+                    category_memo_entry,
+                )
+                for category_memo_entry in category_memo_entries
+            ],
+        )
+
+
+def get_statement_features(db=None):
+    # Feature vectors and loan decisions of every statement, in one projected scan.
+    # Returns the statement ids, the feature matrix (NaN for the missing features)
+    # and the decisions (NaN when missing)
+    db = db or get_firestore_client()
+
+    statement_docs = (
+        db.collection("statements").select(FEATURE_FIELDS + ["loan_decision"]).stream()
+    )
+
+    statement_ids = []
+    feature_rows = []
+    for statement_doc in statement_docs:
+        statement_analysis = statement_doc.to_dict()
+
+        statement_ids.append(statement_doc.id)
+        feature_rows.append(
+            [statement_analysis.get(field) for field in FEATURE_FIELDS]
+            + [statement_analysis.get("loan_decision")]
+        )
+
+    # None becomes NaN when converted to floats
+    feature_matrix = np.array(feature_rows, dtype=np.float64).reshape(
+        len(feature_rows), len(FEATURE_FIELDS) + 1
+    )
+
+    return statement_ids, feature_matrix[:, :-1], feature_matrix[:, -1]
+
+
+def update_loan_decisions(loan_decisions, db=None):
+    # loan_decisions maps statement ids to their new decision
+    db = db or get_firestore_client()
+    statements_collection = db.collection("statements")
+
+    with stage_timer("firestore_write"):
+        commit_batched_writes(
+            db,
+            [
+                (
+                    statements_collection.document(statement_id),
+                    {"loan_decision": loan_decision},
+                )
+                for statement_id, loan_decision in loan_decisions.items()
+            ],
+            update=True,
+        )
+
+
+def list_statement_ids(db=None):
+    # only the doc ids are read
+    db = db or get_firestore_client()
+
+    return [
+        statement_doc.id
+        for statement_doc in db.collection("statements").select([]).stream()
+    ]
+
+
+def get_statement_analyses(statement_ids, field_paths=None, db=None):
+    # Reads the given statements in one get_all call, keyed by statement id
+    db = db or get_firestore_client()
+    statements_collection = db.collection("statements")
+
+    return {
+        statement_doc.id: statement_doc.to_dict()
+        for statement_doc in db.get_all(
+            [
+                statements_collection.document(statement_id)
+                for statement_id in statement_ids
+            ],
+            field_paths=field_paths,
+        )
+        if statement_doc.exists
+    }
+
+
+def get_statement_analysis_ref_by_blob(statement_pdf_blob):
+    db = get_firestore_client()
+    statement_analysis_docs = (
+        db.collection("statements")
+        .where("statement_pdf_blob", "==", statement_pdf_blob)
+        .select(["statement_pdf_blob"])
+        .limit(1)
+        .get()
+    )
+
+    if not statement_analysis_docs:
+        return None
+
+    return statement_analysis_docs[0].id
+
+
+def get_training_statements(log=False, db=None):
+    # Loads the whole training set in one sequential read of the feature records.
+    # The training docs without a feature record (saved before the feature store,
+    # when the backfill did not run yet) are read from their statements instead
+    db = db or get_firestore_client()
+
+    training_feature_docs = (
+        db.collection("training_features")
+        .where("schema_version", "==", TRAINING_FEATURES_SCHEMA_VERSION)
+        .stream()
+    )
+
+    training_statements = [
+        training_feature_doc.to_dict() for training_feature_doc in training_feature_docs
+    ]
+
+    feature_statement_refs = {
+        training_statement.get("statement_ref")
+        for training_statement in training_statements
+    }
+    missing_statement_refs = [
+        statement_ref
+        for statement_ref in get_training_statement_refs(db)
+        if statement_ref not in feature_statement_refs
+    ]
+
+    if missing_statement_refs:
+        if log:
+            print(
+                f"{len(missing_statement_refs)} training statements have no feature "
+                "record, run backfill_training_features.py"
+            )
+
+        training_statements += get_training_statements_by_refs(
+            missing_statement_refs, db
+        )
+
+    if log:
+        print(f"Training Statements: {training_statements}")
+
+    return training_statements
+
+
+def get_training_statement_refs(db=None):
+    # only the statement_ref field of the training docs is read
+    db = db or get_firestore_client()
+
+    training_docs = db.collection("training").select(["statement_ref"]).stream()
+
+    statement_refs = []
     for training_doc in training_docs:
         if training_doc.exists:
             statement_ref = training_doc.to_dict().get("statement_ref")
 
             if statement_ref:
-                statement_analysis_doc = (
-                    db.collection("statements").document(statement_ref).get()
-                )
+                statement_refs.append(statement_ref)
 
-                if statement_analysis_doc.exists:
-                    statement_analysis_data = statement_analysis_doc.to_dict()
+    return statement_refs
 
-                    training_statements.append(statement_analysis_data)
+
+def get_training_statements_by_refs(
+    statement_refs, db=None, batch_size=TRAINING_BATCH_SIZE
+):
+    # Resolves the statement refs in batched get_all calls instead of one read
+    # per doc, only fetching the training fields
+    db = db or get_firestore_client()
+
+    statements_collection = db.collection("statements")
+    training_statements = []
+
+    for start in range(0, len(statement_refs), batch_size):
+        doc_refs = [
+            statements_collection.document(statement_ref)
+            for statement_ref in statement_refs[start : start + batch_size]
+        ]
+
+        for statement_analysis_doc in db.get_all(
+            doc_refs, field_paths=TRAINING_RECORD_FIELDS
+        ):
+            if statement_analysis_doc.exists:
+                statement_analysis_data = statement_analysis_doc.to_dict()
+                statement_analysis_data["statement_ref"] = statement_analysis_doc.id
+
+                training_statements.append(statement_analysis_data)
+
+    return training_statements
+
+
+def get_training_statements_from_refs(
+    log=False, db=None, batch_size=TRAINING_BATCH_SIZE
+):
+    # Loads the training statements from the refs in the training collection
+    db = db or get_firestore_client()
+
+    training_statements = get_training_statements_by_refs(
+        get_training_statement_refs(db), db, batch_size
+    )
 
     if log:
         print(f"Training Statements: {training_statements}")
 
     return training_statements
+
+
+def backfill_training_features(log=False, db=None):
+    # Writes the feature records of the training docs saved before the feature store existed
+    db = db or get_firestore_client()
+
+    training_statements = get_training_statements_from_refs(log, db)
+    training_features_collection = db.collection("training_features")
+
+    commit_batched_writes(
+        db,
+        [
+            (
+                training_features_collection.document(
+                    statement_analysis["statement_ref"]
+                ),
+                build_training_feature_record(
+                    statement_analysis["statement_ref"], statement_analysis
+                ),
+            )
+            for statement_analysis in training_statements
+        ],
+    )
+
+    return len(training_statements)
@@ -0,0 +1,69 @@
+import asyncio
+import contextvars
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+
+# Bounded pools used to keep blocking work off the event loop:
+# - the thread pool runs blocking I/O (GCS, Firestore) and in-memory work (KNN)
+# - the process pool runs CPU-bound work (PDF parsing, pandas)
+IO_MAX_WORKERS = int(os.environ.get("IO_MAX_WORKERS", 16))
+CPU_MAX_WORKERS = int(os.environ.get("CPU_MAX_WORKERS", os.cpu_count() or 1))
+
+_thread_pool = None
+_process_pool = None
+
+
+def get_thread_pool():
+    global _thread_pool
+
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(
+            max_workers=IO_MAX_WORKERS, thread_name_prefix="io"
+        )
+
+    return _thread_pool
+
+
+def get_process_pool():
+    global _process_pool
+
+    if _process_pool is None:
+        # forkserver avoids forking a process that already holds grpc threads
+        _process_pool = ProcessPoolExecutor(
+            max_workers=CPU_MAX_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+    return _process_pool
+
+
+async def run_blocking(func, *args, **kwargs):
+    # the context is copied so that context variables (eg. request metrics) carry over
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_thread_pool(), partial(context.run, func, *args, **kwargs)
+    )
+
+
+async def run_cpu_bound(func, *args, **kwargs):
+    # func and its arguments have to be picklable (module-level functions)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_process_pool(), partial(func, *args, **kwargs)
+    )
+
+
+def shutdown_executors():
+    global _thread_pool, _process_pool
+
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -0,0 +1,238 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from database import get_statement_analysis_ref_by_blob
+from executors import run_blocking
+from services import get_loan_prediction
+
+
+# In-process queue running the prediction pipeline for batches of statements,
+# with a bounded number of workers and retries with exponential backoff
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+BATCH_MAX_RETRIES = int(os.environ.get("BATCH_MAX_RETRIES", 2))
+BATCH_RETRY_BACKOFF_SECONDS = float(os.environ.get("BATCH_RETRY_BACKOFF_SECONDS", 5))
+# Completed jobs are kept for polling until they expire, or until there are too many
+# of them. The analyses stay in Firestore, a statement submitted again after its
+# job expired reuses its saved analysis
+JOB_RESULT_TTL_SECONDS = float(os.environ.get("JOB_RESULT_TTL_SECONDS", 3600))
+MAX_COMPLETED_JOBS = int(os.environ.get("MAX_COMPLETED_JOBS", 10000))
+
+ITEM_STATUSES = ["queued", "running", "succeeded", "failed"]
+
+
+class BatchJob:
+    def __init__(self, statement_pdf_blobs, reuse_existing=False):
+        self.job_id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.completed_at = None
+        # when set, statements with an already saved analysis are not processed again
+        self.reuse_existing = reuse_existing
+        self.items = [
+            {
+                "statement_pdf_blob": statement_pdf_blob,
+                "status": "queued",
+                "attempts": 0,
+                "statement_analysis_ref": None,
+                "loan_decision": None,
+                "error": None,
+            }
+            for statement_pdf_blob in statement_pdf_blobs
+        ]
+
+    @property
+    def status(self):
+        counts = self.counts()
+
+        if counts["succeeded"] + counts["failed"] == len(self.items):
+            return "completed"
+        if counts["queued"] == len(self.items):
+            return "queued"
+        return "running"
+
+    @property
+    def succeeded(self):
+        return all(item["status"] == "succeeded" for item in self.items)
+
+    def counts(self):
+        counts = {status: 0 for status in ITEM_STATUSES}
+        for item in self.items:
+            counts[item["status"]] += 1
+
+        return counts
+
+    def to_prediction_dict(self):
+        # Status of a single statement job
+        item = self.items[0]
+
+        return {
+            "job_id": self.job_id,
+            "status": item["status"],
+            "statement_analysis_ref": item["statement_analysis_ref"],
+            "error": item["error"],
+        }
+
+    def to_dict(self, include_items=False):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "total": len(self.items),
+            **self.counts(),
+            "items": self.items if include_items else None,
+        }
+
+
+class BatchJobQueue:
+    def __init__(
+        self,
+        concurrency=BATCH_CONCURRENCY,
+        max_retries=BATCH_MAX_RETRIES,
+        retry_backoff_seconds=BATCH_RETRY_BACKOFF_SECONDS,
+        result_ttl_seconds=JOB_RESULT_TTL_SECONDS,
+        max_completed_jobs=MAX_COMPLETED_JOBS,
+    ):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.max_completed_jobs = max_completed_jobs
+        self.jobs = {}
+        self.statement_jobs = {}  # statement pdf blob -> latest single statement job
+        self._completed_jobs = OrderedDict()  # job id -> job, in completion order
+
+        self._queue = None
+        self._workers = []
+
+    @property
+    def started(self):
+        return self._queue is not None
+
+    def start(self):
+        # Has to be called from the running event loop
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+        self._queue = None
+        self._workers = []
+
+    def submit(self, statement_pdf_blobs, reuse_existing=False):
+        if not self.started:
+            self.start()
+
+        self.evict_completed_jobs()
+
+        job = BatchJob(statement_pdf_blobs, reuse_existing)
+        self.jobs[job.job_id] = job
+
+        for item in job.items:
+            self._queue.put_nowait((job, item))
+
+        if not job.items:
+            self._complete_job(job)
+
+        return job
+
+    def submit_statement(self, statement_pdf_blob):
+        # Idempotent on the blob: an in-flight or succeeded job is reused,
+        # only a failed job is submitted again
+        job = self.statement_jobs.get(statement_pdf_blob)
+
+        if job is None or (job.status == "completed" and not job.succeeded):
+            job = self.submit([statement_pdf_blob], reuse_existing=True)
+            self.statement_jobs[statement_pdf_blob] = job
+
+        return job
+
+    def get_job(self, job_id):
+        self.evict_completed_jobs()
+
+        return self.jobs.get(job_id)
+
+    def _complete_job(self, job):
+        job.completed_at = time.time()
+        self._completed_jobs[job.job_id] = job
+
+    def evict_completed_jobs(self):
+        # Drops the completed jobs past their ttl, and the oldest ones over the limit
+        expired_before = time.time() - self.result_ttl_seconds
+
+        while self._completed_jobs:
+            job_id, job = next(iter(self._completed_jobs.items()))
+
+            if (
+                job.completed_at > expired_before
+                and len(self._completed_jobs) <= self.max_completed_jobs
+            ):
+                break
+
+            del self._completed_jobs[job_id]
+            self.jobs.pop(job_id, None)
+
+            for item in job.items:
+                if self.statement_jobs.get(item["statement_pdf_blob"]) is job:
+                    del self.statement_jobs[item["statement_pdf_blob"]]
+
+    async def _worker(self):
+        while True:
+            job, item = await self._queue.get()
+
+            try:
+                await self._process_item(job, item)
+            finally:
+                if job.status == "completed" and job.completed_at is None:
+                    self._complete_job(job)
+
+                self._queue.task_done()
+
+    async def _process_item(self, job, item):
+        item["status"] = "running"
+
+        if job.reuse_existing:
+            try:
+                statement_analysis_ref = await run_blocking(
+                    get_statement_analysis_ref_by_blob, item["statement_pdf_blob"]
+                )
+            except Exception:
+                statement_analysis_ref = None
+
+            if statement_analysis_ref is not None:
+                item["status"] = "succeeded"
+                item["statement_analysis_ref"] = statement_analysis_ref
+                return
+
+        for attempt in range(self.max_retries + 1):
+            item["attempts"] = attempt + 1
+
+            try:
+                statement_analysis, statement_analysis_ref = await get_loan_prediction(
+                    item["statement_pdf_blob"]
+                )
+            except Exception as e:
+                item["error"] = str(e)
+
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.retry_backoff_seconds * 2**attempt)
+
+                continue
+
+            item["status"] = "succeeded"
+            item["statement_analysis_ref"] = statement_analysis_ref
+            item["loan_decision"] = statement_analysis["loan_decision"]
+            item["error"] = None
+            return
+
+        item["status"] = "failed"
+
+
+batch_job_queue = BatchJobQueue()
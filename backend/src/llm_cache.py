@@ -0,0 +1,147 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# Content-addressed cache for LLM responses, keyed by a hash of the model name,
+# the prompt template and the prompt input. Backends only need get/set/stats.
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", "/tmp/loan_originator_llm_cache.sqlite3"
+)
+LLM_CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 10000))
+
+
+def make_cache_key(model_name, prompt_template, prompt_input):
+    key_hash = hashlib.sha256()
+
+    for part in (model_name, prompt_template, prompt_input):
+        encoded_part = part.encode("utf-8")
+        # length-prefixing the parts so that different splits never collide
+        key_hash.update(len(encoded_part).to_bytes(8, "big"))
+        key_hash.update(encoded_part)
+
+    return key_hash.hexdigest()
+
+
+class LLMCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def to_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class NullLLMCache:
+    def __init__(self):
+        self.stats = LLMCacheStats()
+
+    def get(self, key):
+        self.stats.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+class SQLiteLLMCache:
+    def __init__(
+        self,
+        path=LLM_CACHE_PATH,
+        ttl_seconds=LLM_CACHE_TTL_SECONDS,
+        max_entries=LLM_CACHE_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats = LLMCacheStats()
+
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connecting lazily so that importing the module never touches the disk
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)"
+            )
+            self._connection.commit()
+
+        return self._connection
+
+    def get(self, key):
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is not None and now - row[1] > self.ttl_seconds:
+                connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                connection.commit()
+                self.stats.evictions += 1
+                row = None
+
+            if row is None:
+                self.stats.misses += 1
+                return None
+
+            connection.execute(
+                "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            connection.commit()
+            self.stats.hits += 1
+
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+
+            # evicting expired entries, then the least recently used ones above the size limit
+            expired = connection.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,)
+            ).rowcount
+            overflow = connection.execute(
+                """DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            ).rowcount
+            connection.commit()
+
+            self.stats.evictions += expired + overflow
+
+
+llm_cache = SQLiteLLMCache() if LLM_CACHE_ENABLED else NullLLMCache()
+
+
+def get_llm_cache():
+    return llm_cache
+
+
+def set_llm_cache(cache):
+    global llm_cache
+    llm_cache = cache
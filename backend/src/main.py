@@ -1,47 +1,252 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from database import (
-    save_statement_analysis,
+    get_statement_analysis,
+    get_statement_transactions,
     save_training_statement_analysis,
 )
 from models import (
     MonthlySummary,
     Transaction,
     StatementAnalysis,
+    TransactionsPageResponse,
     LoanPredictionResponse,
+    PredictionJobResponse,
+    BatchPredictionRequest,
+    BatchJobResponse,
+    RescoreReportResponse,
 )
 from services import (
-    process_statement_pdf,
-    extract_analysis_from_statement_df,
-    predict_loan_decision,
+    get_loan_prediction,
+    learn_statement_categories,
+    rescore_loan_decisions,
+    run_in_background,
 )
+from categorization import LOCAL_CATEGORIZATION_ENABLED
+from training_index import training_index
+from executors import run_blocking
+from llm_cache import get_llm_cache
+from metrics import metrics_registry, stage_timer, track_request
+from jobs import batch_job_queue
+from pdf_text import list_pdf_blobs
+from resources import resources
+from serialization import dumps
+
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup():
+    await run_blocking(resources.startup)
+    batch_job_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await batch_job_queue.stop()
+    await resources.shutdown()
+
+
 @app.post("/get_loan_prediction_endpoint/")
 async def get_loan_prediction_endpoint(
     statement_pdf_blob: str,
+    defer_for_against: bool = False,
+    include_timings: bool = False,
 ) -> LoanPredictionResponse:
     try:
-        statement_data = process_statement_pdf(statement_pdf_blob)
-        statement_analysis = extract_analysis_from_statement_df(statement_data)
-        prediction = predict_loan_decision(statement_analysis)
-        statement_analysis["loan_decision"] = 1 if prediction else 0
-        statement_analysis_ref = save_statement_analysis(statement_analysis)
-        return {
-            "statement_analysis": statement_analysis,
-            "statement_analysis_ref": statement_analysis_ref,
-        }
+        with track_request() as request_metrics, stage_timer("pipeline_total"):
+            statement_analysis, statement_analysis_ref = await get_loan_prediction(
+                statement_pdf_blob, defer_for_against
+            )
+        # the analysis is already json-safe, it is encoded directly instead of being
+        # validated again, with the transactions embedded as already encoded
+        return Response(
+            content=dumps(
+                {
+                    "statement_analysis": statement_analysis,
+                    "statement_analysis_ref": statement_analysis_ref,
+                    "timings": request_metrics.to_dict() if include_timings else None,
+                }
+            ),
+            media_type="application/json",
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/submit_loan_prediction_endpoint/")
+async def submit_loan_prediction_endpoint(
+    statement_pdf_blob: str,
+) -> PredictionJobResponse:
+    # Returns right away, submitting the same blob again reuses its job
+    job = batch_job_queue.submit_statement(statement_pdf_blob)
+
+    return job.to_prediction_dict()
+
+
+@app.get("/get_loan_prediction_result_endpoint/")
+async def get_loan_prediction_result_endpoint(
+    job_id: str,
+) -> LoanPredictionResponse:
+    job = batch_job_queue.get_job(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Prediction job not found")
+
+    prediction_job = job.to_prediction_dict()
+
+    if prediction_job["status"] == "failed":
+        raise HTTPException(status_code=500, detail=prediction_job["error"])
+
+    if prediction_job["status"] != "succeeded":
+        # the result is not ready yet, the job status is returned instead
+        return JSONResponse(status_code=202, content=prediction_job)
+
+    try:
+        statement_analysis = await run_blocking(
+            get_statement_analysis, prediction_job["statement_analysis_ref"]
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if statement_analysis is None:
+        raise HTTPException(status_code=404, detail="Statement analysis not found")
+
+    return {
+        "statement_analysis": statement_analysis,
+        "statement_analysis_ref": prediction_job["statement_analysis_ref"],
+    }
+
 
 @app.post("/save_training_datapoint_endpoint/")
 async def save_training_datapoint_endpoint(
     statement_analysis_ref: str,
 ) -> dict[str, str]:
     try:
-        save_training_statement_analysis(statement_analysis_ref)
+        training_feature_record = await run_blocking(
+            save_training_statement_analysis, statement_analysis_ref
+        )
+        if training_feature_record is not None:
+            training_index.add_statement(
+                statement_analysis_ref, training_feature_record
+            )
+
+        # the categories of a confirmed statement are reused by the next ones, they
+        # are learned in the background so that a failure does not fail the request
+        # once the datapoint is saved
+        if LOCAL_CATEGORIZATION_ENABLED:
+            run_in_background(
+                learn_statement_categories(statement_analysis_ref),
+                "category_learning",
+            )
+
         return {"message": "Training data point saved successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/rescore_loan_decisions_endpoint/")
+async def rescore_loan_decisions_endpoint(
+    scale_features: bool = False,
+    dry_run: bool = False,
+) -> RescoreReportResponse:
+    # Refreshes the stored decisions after the training set changed
+    try:
+        return await run_blocking(rescore_loan_decisions, scale_features, dry_run)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/get_statement_analysis_endpoint/")
+async def get_statement_analysis_endpoint(
+    statement_analysis_ref: str,
+) -> StatementAnalysis:
+    try:
+        statement_analysis = await run_blocking(
+            get_statement_analysis, statement_analysis_ref
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if statement_analysis is None:
+        raise HTTPException(status_code=404, detail="Statement analysis not found")
+
+    return statement_analysis
+
+
+@app.get("/get_statement_transactions_endpoint/")
+async def get_statement_transactions_endpoint(
+    statement_analysis_ref: str,
+    page: int = 0,
+) -> TransactionsPageResponse:
+    if page < 0:
+        raise HTTPException(status_code=400, detail="Page has to be positive")
+
+    try:
+        transactions_page = await run_blocking(
+            get_statement_transactions, statement_analysis_ref, page
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if transactions_page is None:
+        raise HTTPException(status_code=404, detail="Statement analysis not found")
+
+    next_page_start = (page + 1) * transactions_page["page_size"]
+    if next_page_start < transactions_page["total"]:
+        transactions_page["next_page"] = page + 1
+
+    return transactions_page
+
+
+@app.get("/get_llm_cache_stats_endpoint/")
+async def get_llm_cache_stats_endpoint() -> dict[str, int]:
+    return get_llm_cache().stats.to_dict()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    llm_cache_stats = get_llm_cache().stats.to_dict()
+
+    return metrics_registry.to_prometheus(
+        extra_counters={
+            f"llm_cache_{name}_total": (f"LLM cache {name}", value)
+            for name, value in llm_cache_stats.items()
+        }
+    )
+
+
+@app.post("/batch_loan_prediction_endpoint/")
+async def batch_loan_prediction_endpoint(
+    batch_prediction_request: BatchPredictionRequest,
+) -> BatchJobResponse:
+    statement_pdf_blobs = list(batch_prediction_request.statement_pdf_blobs or [])
+
+    try:
+        if batch_prediction_request.gcs_prefix:
+            statement_pdf_blobs += await run_blocking(
+                list_pdf_blobs, batch_prediction_request.gcs_prefix
+            )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not statement_pdf_blobs:
+        raise HTTPException(status_code=400, detail="No statements to process")
+
+    job = batch_job_queue.submit(statement_pdf_blobs)
+
+    return job.to_dict()
+
+
+@app.get("/get_batch_job_endpoint/")
+async def get_batch_job_endpoint(
+    job_id: str,
+    include_items: bool = False,
+) -> BatchJobResponse:
+    job = batch_job_queue.get_job(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+
+    return job.to_dict(include_items)
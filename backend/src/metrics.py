@@ -0,0 +1,278 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Per-stage instrumentation of the prediction pipeline. Everything is recorded in the
+# process-wide registry (served in the Prometheus text format), and in the metrics of
+# the current request when the request is tracked (see track_request).
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_durations = {}  # stage -> [bucket counts, sum, count]
+        self.llm_tokens = {}  # (stage, token type) -> total
+        self.rows = {}  # (stage, direction) -> total
+        self.errors = {}  # stage -> total
+        self.extraction_chunks = {}  # outcome (total, cached, truncated) -> total
+        self.dropped_rows = {}  # reason -> total
+
+    def observe_stage(self, stage, seconds):
+        with self._lock:
+            histogram = self.stage_durations.setdefault(
+                stage, [[0] * len(DURATION_BUCKETS), 0.0, 0]
+            )
+
+            for bucket_num, upper_bound in enumerate(DURATION_BUCKETS):
+                if seconds <= upper_bound:
+                    histogram[0][bucket_num] += 1
+
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def add_llm_tokens(self, stage, token_counts):
+        # token_counts: token type (prompt, completion, digest) -> tokens
+        with self._lock:
+            for token_type, tokens in token_counts.items():
+                key = (stage, token_type)
+                self.llm_tokens[key] = self.llm_tokens.get(key, 0) + tokens
+
+    def add_rows(self, stage, direction, rows):
+        with self._lock:
+            key = (stage, direction)
+            self.rows[key] = self.rows.get(key, 0) + rows
+
+    def add_error(self, stage):
+        with self._lock:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def add_dropped_rows(self, dropped_rows):
+        with self._lock:
+            for reason, rows in dropped_rows.items():
+                self.dropped_rows[reason] = self.dropped_rows.get(reason, 0) + rows
+
+    def add_extraction_chunk(self, outcomes):
+        with self._lock:
+            for outcome in outcomes:
+                self.extraction_chunks[outcome] = (
+                    self.extraction_chunks.get(outcome, 0) + 1
+                )
+
+    def to_prometheus(self, extra_counters=None):
+        lines = [
+            "# HELP pipeline_stage_duration_seconds Wall-clock time of each pipeline stage",
+            "# TYPE pipeline_stage_duration_seconds histogram",
+        ]
+
+        with self._lock:
+            for stage, (bucket_counts, total, count) in sorted(
+                self.stage_durations.items()
+            ):
+                for upper_bound, bucket_count in zip(DURATION_BUCKETS, bucket_counts):
+                    lines.append(
+                        f'pipeline_stage_duration_seconds_bucket{{stage="{stage}",le="{upper_bound}"}} {bucket_count}'
+                    )
+                lines.append(
+                    f'pipeline_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}'
+                )
+                lines.append(
+                    f'pipeline_stage_duration_seconds_sum{{stage="{stage}"}} {total}'
+                )
+                lines.append(
+                    f'pipeline_stage_duration_seconds_count{{stage="{stage}"}} {count}'
+                )
+
+            lines += [
+                "# HELP llm_tokens_total Tokens sent to and generated by the LLM",
+                "# TYPE llm_tokens_total counter",
+            ]
+            for (stage, token_type), tokens in sorted(self.llm_tokens.items()):
+                lines.append(
+                    f'llm_tokens_total{{stage="{stage}",type="{token_type}"}} {tokens}'
+                )
+
+            lines += [
+                "# HELP pipeline_rows_total Rows going in and out of each pipeline stage",
+                "# TYPE pipeline_rows_total counter",
+            ]
+            for (stage, direction), rows in sorted(self.rows.items()):
+                lines.append(
+                    f'pipeline_rows_total{{stage="{stage}",direction="{direction}"}} {rows}'
+                )
+
+            lines += [
+                "# HELP pipeline_errors_total Failures of the background pipeline stages",
+                "# TYPE pipeline_errors_total counter",
+            ]
+            for stage, errors in sorted(self.errors.items()):
+                lines.append(f'pipeline_errors_total{{stage="{stage}"}} {errors}')
+
+            lines += [
+                "# HELP pipeline_extraction_chunks_total Transaction extraction LLM calls by outcome",
+                "# TYPE pipeline_extraction_chunks_total counter",
+            ]
+            for outcome, chunks in sorted(self.extraction_chunks.items()):
+                lines.append(
+                    f'pipeline_extraction_chunks_total{{outcome="{outcome}"}} {chunks}'
+                )
+
+            lines += [
+                "# HELP pipeline_dropped_rows_total Extracted transaction rows dropped by preprocessing",
+                "# TYPE pipeline_dropped_rows_total counter",
+            ]
+            for reason, rows in sorted(self.dropped_rows.items()):
+                lines.append(f'pipeline_dropped_rows_total{{reason="{reason}"}} {rows}')
+
+        for name, (description, value) in (extra_counters or {}).items():
+            lines += [
+                f"# HELP {name} {description}",
+                f"# TYPE {name} counter",
+                f"{name} {value}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}  # stage -> seconds, summed over the calls of the stage
+        self.llm_tokens = {}  # stage -> {token type: tokens}
+        self.rows = {}  # stage -> {"in": rows, "out": rows}
+        self.extraction_chunks = []  # report of each transaction extraction call
+        self.dropped_rows = {}  # reason -> rows
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_llm_tokens(self, stage, token_counts):
+        with self._lock:
+            stage_tokens = self.llm_tokens.setdefault(stage, {})
+            for token_type, tokens in token_counts.items():
+                stage_tokens[token_type] = stage_tokens.get(token_type, 0) + tokens
+
+    def add_rows(self, stage, direction, rows):
+        with self._lock:
+            stage_rows = self.rows.setdefault(stage, {})
+            stage_rows[direction] = stage_rows.get(direction, 0) + rows
+
+    def add_dropped_rows(self, dropped_rows):
+        with self._lock:
+            for reason, rows in dropped_rows.items():
+                self.dropped_rows[reason] = self.dropped_rows.get(reason, 0) + rows
+
+    def add_extraction_chunk(self, chunk_report):
+        with self._lock:
+            self.extraction_chunks.append(dict(chunk_report))
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "stages": dict(self.stages),
+                "llm_tokens": {k: dict(v) for k, v in self.llm_tokens.items()},
+                "rows": {k: dict(v) for k, v in self.rows.items()},
+                "extraction_chunks": [dict(v) for v in self.extraction_chunks],
+                "dropped_rows": dict(self.dropped_rows),
+            }
+
+
+metrics_registry = MetricsRegistry()
+_request_metrics = contextvars.ContextVar("request_metrics", default=None)
+
+
+@contextmanager
+def track_request():
+    # Collects the metrics of everything run in the current context,
+    # including the tasks and the run_blocking calls started from it
+    request_metrics = RequestMetrics()
+    token = _request_metrics.set(request_metrics)
+
+    try:
+        yield request_metrics
+    finally:
+        _request_metrics.reset(token)
+
+
+def record_stage(stage, seconds):
+    metrics_registry.observe_stage(stage, seconds)
+
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.add_stage(stage, seconds)
+
+
+@contextmanager
+def stage_timer(stage):
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time)
+
+
+def _record_llm_token_counts(stage, token_counts):
+    metrics_registry.add_llm_tokens(stage, token_counts)
+
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.add_llm_tokens(stage, token_counts)
+
+
+def record_llm_tokens(stage, prompt_tokens, completion_tokens):
+    _record_llm_token_counts(
+        stage, {"prompt": prompt_tokens, "completion": completion_tokens}
+    )
+
+
+def record_prompt_digest_tokens(stage, digest_tokens):
+    # Size of the digest inserted in the prompt, as counted before the call
+    _record_llm_token_counts(stage, {"digest": digest_tokens})
+
+
+def record_rows(stage, rows_in=None, rows_out=None):
+    for direction, rows in (("in", rows_in), ("out", rows_out)):
+        if rows is None:
+            continue
+
+        metrics_registry.add_rows(stage, direction, rows)
+
+        request_metrics = _request_metrics.get()
+        if request_metrics is not None:
+            request_metrics.add_rows(stage, direction, rows)
+
+
+def record_error(stage):
+    # Failures that do not reach a response, such as the background tasks
+    metrics_registry.add_error(stage)
+
+
+def record_extraction_chunks(chunk_reports):
+    # Outcome of each transaction extraction call (one per page for the chunked
+    # extraction), truncated chunks lose the transactions past the token limit
+    for chunk_report in chunk_reports:
+        outcomes = ["total"]
+        if chunk_report.get("cached"):
+            outcomes.append("cached")
+        if chunk_report.get("truncated"):
+            outcomes.append("truncated")
+
+        metrics_registry.add_extraction_chunk(outcomes)
+
+        request_metrics = _request_metrics.get()
+        if request_metrics is not None:
+            request_metrics.add_extraction_chunk(chunk_report)
+
+
+def record_dropped_rows(dropped_rows):
+    # Rows of the extracted csv dropped by preprocess_df, by reason
+    metrics_registry.add_dropped_rows(dropped_rows)
+
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.add_dropped_rows(dropped_rows)
@@ -100,6 +100,52 @@ class StatementAnalysis(BaseModel):
     )
 
 
+class TransactionsPageResponse(BaseModel):
+    transactions: List[Transaction] = Field(
+        ..., description="Transactions of the page, in statement order"
+    )
+    page: int = Field(..., description="Number of the page, starting at 0")
+    page_size: int = Field(..., description="Maximum number of transactions per page")
+    total: int = Field(..., description="Total number of transactions in the statement")
+    next_page: Optional[int] = Field(
+        None, description="Number of the next page, if there are more transactions"
+    )
+
+
+class ExtractionChunkReport(BaseModel):
+    chunk: int = Field(..., description="Number of the chunk (page), starting at 0")
+    characters: int = Field(..., description="Characters of statement text sent")
+    rows: int = Field(..., description="Csv rows extracted from the chunk")
+    cached: bool = Field(..., description="Whether the response came from the cache")
+    truncated: bool = Field(
+        ..., description="Whether the response was cut off at the token limit"
+    )
+    prompt_tokens: int = Field(..., description="Prompt tokens of the call")
+    completion_tokens: int = Field(..., description="Completion tokens of the call")
+    latency_seconds: float = Field(..., description="Latency of the call in seconds")
+    first_row_seconds: Optional[float] = Field(
+        None, description="Time to the first parsed row, when streamed"
+    )
+
+
+class PipelineTimings(BaseModel):
+    stages: dict[str, float] = Field(
+        ..., description="Wall-clock time of each pipeline stage in seconds"
+    )
+    llm_tokens: dict[str, dict[str, int]] = Field(
+        ..., description="Prompt and completion tokens of each LLM stage"
+    )
+    rows: dict[str, dict[str, int]] = Field(
+        ..., description="Rows going in and out of each pipeline stage"
+    )
+    extraction_chunks: List[ExtractionChunkReport] = Field(
+        [], description="Report of each transaction extraction LLM call"
+    )
+    dropped_rows: dict[str, int] = Field(
+        {}, description="Extracted rows dropped by preprocessing, by reason"
+    )
+
+
 class LoanPredictionResponse(BaseModel):
     statement_analysis: StatementAnalysis = Field(
         ..., description="The analysis of the statement."
@@ -107,3 +153,86 @@ class LoanPredictionResponse(BaseModel):
     statement_analysis_ref: str = Field(
         ..., description="Reference to the saved statement analysis in the database."
     )
+    timings: Optional[PipelineTimings] = Field(
+        None, description="Per-stage breakdown of the request, when requested"
+    )
+
+
+class PredictionJobResponse(BaseModel):
+    job_id: str = Field(..., description="Identifier of the prediction job")
+    status: str = Field(
+        ..., description="Status of the statement: queued, running, succeeded or failed"
+    )
+    statement_analysis_ref: Optional[str] = Field(
+        None, description="Reference to the saved statement analysis once succeeded"
+    )
+    error: Optional[str] = Field(None, description="Error of the last failed attempt")
+
+
+class RescoreReportResponse(BaseModel):
+    statements: int = Field(..., description="Number of stored statements")
+    scored: int = Field(..., description="Number of statements scored again")
+    skipped_training: int = Field(
+        ..., description="Number of training statements, which keep their decision"
+    )
+    skipped_missing_features: int = Field(
+        ..., description="Number of statements with missing features"
+    )
+    flipped: int = Field(..., description="Number of decisions that changed")
+    flipped_to_approved: int = Field(
+        ..., description="Number of decisions that changed to a loan"
+    )
+    flipped_to_rejected: int = Field(
+        ..., description="Number of decisions that changed to no loan"
+    )
+    newly_decided: int = Field(
+        ..., description="Number of statements that had no decision before"
+    )
+    updated: int = Field(..., description="Number of decisions written back")
+    scale_features: bool = Field(
+        ..., description="Whether the features were standardized"
+    )
+    dry_run: bool = Field(..., description="Whether the decisions were left as is")
+
+
+class BatchPredictionRequest(BaseModel):
+    statement_pdf_blobs: Optional[List[str]] = Field(
+        None, description="List of statement PDF blobs to process"
+    )
+    gcs_prefix: Optional[str] = Field(
+        None,
+        description="Prefix of the Google Cloud Storage blobs to process, used instead of (or along with) the list of blobs",
+    )
+
+
+class BatchJobItem(BaseModel):
+    statement_pdf_blob: str = Field(..., description="The statement PDF blob")
+    status: str = Field(
+        ..., description="Status of the statement: queued, running, succeeded or failed"
+    )
+    attempts: int = Field(..., description="Number of processing attempts so far")
+    statement_analysis_ref: Optional[str] = Field(
+        None, description="Reference to the saved statement analysis once succeeded"
+    )
+    loan_decision: Optional[int] = Field(
+        None, description="The loan decision once succeeded"
+    )
+    error: Optional[str] = Field(None, description="Error of the last failed attempt")
+
+
+class BatchJobResponse(BaseModel):
+    job_id: str = Field(..., description="Identifier of the batch job")
+    status: str = Field(
+        ..., description="Status of the job: queued, running or completed"
+    )
+    created_at: float = Field(..., description="Creation time of the job (unix time)")
+    total: int = Field(..., description="Number of statements in the job")
+    queued: int = Field(..., description="Number of statements waiting to be processed")
+    running: int = Field(..., description="Number of statements being processed")
+    succeeded: int = Field(..., description="Number of statements processed")
+    failed: int = Field(
+        ..., description="Number of statements that failed after all retries"
+    )
+    items: Optional[List[BatchJobItem]] = Field(
+        None, description="Status of each statement in the job"
+    )
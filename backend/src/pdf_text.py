@@ -0,0 +1,177 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+
+from PyPDF2 import PdfReader
+
+from executors import CPU_MAX_WORKERS, get_process_pool, run_blocking
+from metrics import record_stage, stage_timer
+from resources import resources
+
+
+# Streaming text extraction for statement pdfs: the pdf is spooled to a local file
+# in chunks instead of being held in memory, and pages are extracted in the process
+# pool a few at a time, yielding page texts in order as soon as they are ready.
+
+BUCKET_NAME = "loan_originator_bucket"
+PAGE_SEPARATOR = "\f"
+PDF_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # has to be a multiple of 256 KB
+PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", 2))
+# bounds the number of extracted pages held in memory at any time
+MAX_TASKS_IN_FLIGHT = 2 * CPU_MAX_WORKERS
+
+
+class LocalPdfSource:
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        return self.path
+
+    def cleanup(self):
+        pass
+
+
+class GCSPdfSource:
+    def __init__(self, pdf_blob, bucket_name=BUCKET_NAME, storage_client=None):
+        self.pdf_blob = pdf_blob
+        self.bucket_name = bucket_name
+        self.storage_client = storage_client
+        self._temp_path = None
+
+    def fetch(self):
+        # Loading pdf object from gcs storage, chunk by chunk into a temp file
+        storage_client = self.storage_client or resources.storage_client
+        bucket = storage_client.bucket(self.bucket_name)
+        blob = bucket.blob(self.pdf_blob, chunk_size=PDF_DOWNLOAD_CHUNK_SIZE)
+
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
+            self._temp_path = temp_file.name
+            blob.download_to_file(temp_file)
+
+        return self._temp_path
+
+    def cleanup(self):
+        if self._temp_path is not None:
+            os.remove(self._temp_path)
+            self._temp_path = None
+
+
+def list_pdf_blobs(prefix, bucket_name=BUCKET_NAME, storage_client=None):
+    storage_client = storage_client or resources.storage_client
+
+    return [
+        blob.name
+        for blob in storage_client.list_blobs(bucket_name, prefix=prefix)
+        if not blob.name.endswith("/")
+    ]
+
+
+def count_pdf_pages(path):
+    # the file object is passed so that PyPDF2 reads it lazily instead of loading it all
+    with open(path, "rb") as pdf_file_obj:
+        return len(PdfReader(pdf_file_obj).pages)
+
+
+def extract_page_range_text(path, start, stop):
+    # Runs in the process pool, every task opens its own reader
+    with open(path, "rb") as pdf_file_obj:
+        pdf_reader = PdfReader(pdf_file_obj)
+        return [
+            pdf_reader.pages[page_num].extract_text() for page_num in range(start, stop)
+        ]
+
+
+def get_page_ranges(num_pages, pages_per_task=PAGES_PER_TASK):
+    return [
+        (start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+
+
+def iter_pdf_pages(source, pages_per_task=PAGES_PER_TASK, executor=None):
+    executor = executor or get_process_pool()
+    pending = deque()
+
+    try:
+        path = source.fetch()
+
+        for start, stop in get_page_ranges(count_pdf_pages(path), pages_per_task):
+            pending.append(executor.submit(extract_page_range_text, path, start, stop))
+
+            if len(pending) >= MAX_TASKS_IN_FLIGHT:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        source.cleanup()
+
+
+async def aiter_pdf_pages(source, pages_per_task=PAGES_PER_TASK, executor=None):
+    loop = asyncio.get_running_loop()
+    executor = executor or get_process_pool()
+    pending = deque()
+
+    try:
+        with stage_timer("gcs_download"):
+            path = await run_blocking(source.fetch)
+
+        extraction_start_time = time.perf_counter()
+        num_pages = await run_blocking(count_pdf_pages, path)
+
+        for start, stop in get_page_ranges(num_pages, pages_per_task):
+            pending.append(
+                loop.run_in_executor(
+                    executor, extract_page_range_text, path, start, stop
+                )
+            )
+
+            if len(pending) >= MAX_TASKS_IN_FLIGHT:
+                for page_text in await pending.popleft():
+                    yield page_text
+
+        while pending:
+            for page_text in await pending.popleft():
+                yield page_text
+
+        record_stage(
+            "pdf_text_extraction", time.perf_counter() - extraction_start_time
+        )
+    finally:
+        for future in pending:
+            future.cancel()
+        await run_blocking(source.cleanup)
+
+
+def join_pages(page_texts):
+    # pages are separated with a form feed so they can be split again later
+    return PAGE_SEPARATOR.join(page_text + "\n" for page_text in page_texts)
+
+
+def extract_text_from_pdf_source(source):
+    return join_pages(iter_pdf_pages(source))
+
+
+async def aextract_text_from_pdf_source(source):
+    return join_pages([page_text async for page_text in aiter_pdf_pages(source)])
+
+
+if __name__ == "__main__":
+    # Benchmarking the extraction of a local pdf: python pdf_text.py statement.pdf
+    start_time = time.perf_counter()
+    num_pages = 0
+
+    for page_text in iter_pdf_pages(LocalPdfSource(sys.argv[1])):
+        num_pages += 1
+        print(
+            f"Page {num_pages}: {len(page_text)} characters "
+            f"after {time.perf_counter() - start_time:.3f}s"
+        )
+
+    print(f"Extracted {num_pages} pages in {time.perf_counter() - start_time:.3f}s")
@@ -0,0 +1,215 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+# Bounded digest of a statement analysis for the for/against prompt: summary metrics,
+# the monthly summary table, category totals and the largest transactions, with
+# rounded numbers. Its size does not depend on the number of transactions, and it is
+# shrunk step by step until it fits in the token budget, then truncated to the budget.
+# It is built off the event loop (run_blocking), and the token encoders are loaded
+# at startup since tiktoken downloads them on first use.
+
+FOR_AGAINST_PROMPT_TOKEN_BUDGET = int(
+    os.environ.get("FOR_AGAINST_PROMPT_TOKEN_BUDGET", 1500)
+)
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+# (largest transactions of each kind, most recent months), from the fullest digest
+DIGEST_LEVELS = [(5, 24), (3, 12), (1, 6), (0, 3)]
+
+MONTHLY_TABLE_COLUMNS = [
+    ("total_deposits", "deposits"),
+    ("total_withdrawals", "withdrawals"),
+    ("net_savings", "net_savings"),
+    ("average_balance", "avg_balance"),
+    ("rent_mortgage_payments", "rent_mortgage"),
+    ("utility_payments", "utilities"),
+    ("loan_payments", "loans"),
+    ("rent_mortgage_to_income_ratio", "rent_mortgage_ratio"),
+    ("utilities_to_income_ratio", "utilities_ratio"),
+    ("loan_to_income_ratio", "loan_ratio"),
+]
+MONTHLY_MEAN_FIELDS = [
+    ("monthly_deposit_mean", "Deposits"),
+    ("monthly_withdrawal_mean", "Withdrawals"),
+    ("monthly_balance_mean", "Balance"),
+    ("monthly_rent_mean", "Rent/Mortgage"),
+    ("monthly_utilities_mean", "Utilities"),
+    ("monthly_loan_payment_mean", "Loan payments"),
+]
+
+
+@lru_cache(maxsize=None)
+def get_token_encoder(model_name):
+    # None when the encoding can not be loaded (eg. offline), tokens are then estimated
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(model_name)
+    except Exception:
+        return None
+
+
+def count_tokens(text, model_name):
+    token_encoder = get_token_encoder(model_name)
+
+    if token_encoder is None:
+        return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+    return len(token_encoder.encode(text))
+
+
+def truncate_to_tokens(text, model_name, max_tokens):
+    # Keeps the whole lines that fit in max_tokens
+    token_encoder = get_token_encoder(model_name)
+
+    if token_encoder is None:
+        truncated_text = text[: max(max_tokens - 1, 0) * CHARS_PER_TOKEN_ESTIMATE]
+    else:
+        truncated_text = token_encoder.decode(token_encoder.encode(text)[:max_tokens])
+
+    if truncated_text != text and "\n" in truncated_text:
+        truncated_text = truncated_text.rsplit("\n", 1)[0]
+
+    return truncated_text
+
+
+def format_amount(value):
+    return "n/a" if value is None or pd.isna(value) else f"{value:.0f}"
+
+
+def format_ratio(value):
+    return "n/a" if value is None or pd.isna(value) else f"{value:.2f}"
+
+
+def get_transactions_frame(statement_analysis):
+    # Only the columns needed by the digest, from the encoded transactions
+    transactions = statement_analysis.get("transactions")
+
+    if transactions is None or not len(transactions):
+        return pd.DataFrame(
+            {"Date": [], "Description": [], "Amount": [], "Category": []}
+        )
+
+    columns = transactions.columns
+
+    return pd.DataFrame(
+        {
+            "Date": columns.get("Date", [None] * len(transactions)),
+            "Description": columns.get("Description", [None] * len(transactions)),
+            "Amount": np.asarray(columns.get("Amount"), dtype=np.float64),
+            "Category": columns.get("Category", [None] * len(transactions)),
+        }
+    )
+
+
+def format_overview(statement_analysis, transactions_df):
+    lines = [
+        f"Bank: {statement_analysis.get('bank_name')}, "
+        f"country: {statement_analysis.get('country_code')}, "
+        f"year: {statement_analysis.get('statement_year')}, "
+        f"months: {len(statement_analysis.get('monthly_summary') or [])}, "
+        f"transactions: {len(transactions_df)}",
+        "Monthly means: "
+        + ", ".join(
+            f"{label} {format_amount(statement_analysis.get(field))}"
+            for field, label in MONTHLY_MEAN_FIELDS
+        ),
+    ]
+
+    return "\n".join(lines)
+
+
+def format_monthly_table(statement_analysis, max_months):
+    monthly_summary = (statement_analysis.get("monthly_summary") or [])[-max_months:]
+
+    if not monthly_summary:
+        return ""
+
+    lines = [
+        f"Monthly summary (last {len(monthly_summary)} months, oldest first):",
+        ",".join(label for _, label in MONTHLY_TABLE_COLUMNS),
+    ]
+    for month_summary in monthly_summary:
+        lines.append(
+            ",".join(
+                (
+                    format_ratio(month_summary.get(field))
+                    if field.endswith("_ratio")
+                    else format_amount(month_summary.get(field))
+                )
+                for field, _ in MONTHLY_TABLE_COLUMNS
+            )
+        )
+
+    return "\n".join(lines)
+
+
+def format_category_totals(transactions_df):
+    if transactions_df.empty:
+        return ""
+
+    category_totals = (
+        transactions_df.groupby(transactions_df["Category"].fillna("Other"))["Amount"]
+        .agg(["sum", "count"])
+        .sort_values("sum", key=np.abs, ascending=False)
+    )
+
+    return "Category totals (total, count):\n" + "\n".join(
+        f"{category}: {format_amount(total)}, {count}"
+        for category, total, count in category_totals.itertuples()
+    )
+
+
+def format_top_transactions(transactions_df, top_n):
+    if top_n == 0 or transactions_df.empty:
+        return ""
+
+    amounts = transactions_df["Amount"]
+    deposits = transactions_df[amounts > 0].nlargest(top_n, "Amount")
+    withdrawals = transactions_df[amounts < 0].nsmallest(top_n, "Amount")
+
+    lines = []
+    for label, transactions in (("deposits", deposits), ("withdrawals", withdrawals)):
+        if transactions.empty:
+            continue
+
+        lines.append(f"Largest {label} (month, description, amount, category):")
+        lines += [
+            f"{transaction.Date}, {transaction.Description}, "
+            f"{format_amount(transaction.Amount)}, {transaction.Category}"
+            for transaction in transactions.itertuples()
+        ]
+
+    return "\n".join(lines)
+
+
+def build_for_against_digest(
+    statement_analysis, model_name, token_budget=FOR_AGAINST_PROMPT_TOKEN_BUDGET
+):
+    # Returns the digest and its token count, using the fullest level within the budget
+    transactions_df = get_transactions_frame(statement_analysis)
+    overview = format_overview(statement_analysis, transactions_df)
+    category_totals = format_category_totals(transactions_df)
+
+    for top_n, max_months in DIGEST_LEVELS:
+        sections = [
+            overview,
+            format_monthly_table(statement_analysis, max_months),
+            category_totals,
+            format_top_transactions(transactions_df, top_n),
+        ]
+        digest = "\n\n".join(section for section in sections if section)
+        num_tokens = count_tokens(digest, model_name)
+
+        if num_tokens <= token_budget:
+            return digest, num_tokens
+
+    # even the smallest level is over the budget (eg. a very long bank name or
+    # category names), the end of the digest is cut
+    digest = truncate_to_tokens(digest, model_name, token_budget)
+
+    return digest, count_tokens(digest, model_name)
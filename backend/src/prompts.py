@@ -0,0 +1,83 @@
+# Prompts, schemas and models of the LLM chains
+
+
+TRANSACTION_EXTRACTION_MODEL_NAME = "gpt-4-1106-preview"
+TRANSACTION_EXTRACTION_MAX_TOKENS = 1054
+METADATA_EXTRACTION_MODEL_NAME = "gpt-3.5-turbo"
+FOR_AGAINST_MODEL_NAME = "gpt-4-1106-preview"
+FOR_AGAINST_MAX_TOKENS = 1054
+
+TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE = """You are an experienced loan originator and financial analyst. 
+  You will help with extracting information from bank statements."""
+TRANSACTION_CATEGORIES = [
+    "Deposits - Salary Paycheck",
+    "Deposits - Transfers In",
+    "Withdrawals - Cash Withdrawals ATM",
+    "Withdrawals - Transfers Out",
+    "Payments - Mortgage",
+    "Payments - Rent",
+    "Payments - Utility Bills",
+    "Payments - Loan Payments",
+    "Payments - Credit Card Payments",
+    "Payments - Insurance Premiums",
+    "Purchases - Groceries Food",
+    "Purchases - Dining Restaurants",
+    "Purchases - Retail Clothing",
+    "Purchases - Gas Fuel",
+    "Investments - Stock Bond Purchases",
+    "Investments - Retirement Account Contributions",
+    "Fees Charges - Account Maintenance Fees",
+    "Fees Charges - Overdraft Fees",
+    "Other",
+]
+TRANSACTION_CATEGORIES_LIST = (
+    "[\n"
+    + ",\n".join(f'      "{category}"' for category in TRANSACTION_CATEGORIES)
+    + "\n  ]"
+)
+
+TRANSACTION_FIELDS_INSTRUCTIONS = """For Date, convert the date into the 
+  format "YYYY-MM". For description, do not include any commas that exist in the description. For Value, put a positive number and make sure it has a number format (only one dot).
+  For Deposit, put YES if the transaction is a deposit and NO if it is a withdrawal."""
+TRANSACTION_EXTRACTION_HUMAN_TEMPLATE = (
+    """Here is a bank statement, for each bank transaction, give the following information
+  in comma-separated format (Date, Description, Value, Deposit, Category). """
+    + TRANSACTION_FIELDS_INSTRUCTIONS
+    + """
+  For category, try to predict the category from the transaction description from the following list """
+    + TRANSACTION_CATEGORIES_LIST
+    + """. Only respond with the list of comma-separated values for all transactions in the bank statement, and do not include any other text in the response. Here is the statement: {bank_statement}"""
+)
+# Same extraction without the categories, when they are predicted locally (see categorization.py)
+TRANSACTION_ROWS_HUMAN_TEMPLATE = (
+    """Here is a bank statement, for each bank transaction, give the following information
+  in comma-separated format (Date, Description, Value, Deposit). """
+    + TRANSACTION_FIELDS_INSTRUCTIONS
+    + """
+  Only respond with the list of comma-separated values for all transactions in the bank statement, and do not include any other text in the response. Here is the statement: {bank_statement}"""
+)
+
+# Categories of the transactions the local categorization is not sure of
+CATEGORIZATION_MODEL_NAME = "gpt-4-1106-preview"
+CATEGORIZATION_MAX_TOKENS = 1054
+CATEGORIZATION_HUMAN_TEMPLATE = (
+    """Here is a numbered list of bank transaction descriptions, each followed by (deposit) or (withdrawal).
+  For each transaction, predict the category from the following list """
+    + TRANSACTION_CATEGORIES_LIST
+    + """. Only respond with one line per transaction in the format: number,category and do not include any other text in the response. Here are the transactions:
+{transactions}"""
+)
+
+METADATA_SCHEMA = {
+    "properties": {
+        "country_code_iso_3166_standard": {"type": "string"},
+        "bank_name": {"type": "string"},
+        "statement_year": {"type": "integer"},
+    },
+    "required": ["country_code", "bank_name", "statement_year"],
+}
+
+
+FOR_AGAINST_SYSTEM_TEMPLATE = """You are an experienced loan originator and financial analyst. You will help with creating decisions of whether or not to give a loan based on a bank statement data"""
+FOR_AGAINST_HUMAN_TEMPLATE = """Here is a bank statement analysis for a client. Use this data to provide a bullet-point list of reasons to provide a loan then a list of reason for not providing a loan. 
+  Only include relevant, strong and useful reasons and back each reason with numerical data from the analysis. Include headers for each list ("Reasons for:" and "Reasons against") but no other text and do not make up facts. Here is the statement analysis: {statement_analysis}"""
@@ -0,0 +1,52 @@
+import asyncio
+import os
+
+
+class AsyncRateLimiter:
+    """
+    Spaces out calls evenly so that at most `requests_per_minute` calls start per minute.
+    A limiter without a rate never waits.
+    """
+
+    def __init__(self, requests_per_minute=None):
+        self.set_rate(requests_per_minute)
+        self._next_time = 0.0
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+
+    async def acquire(self):
+        if not self.interval:
+            return
+
+        loop = asyncio.get_running_loop()
+
+        async with self._lock:
+            now = loop.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
+def _rate_from_env(name):
+    rate = os.environ.get(name)
+    return float(rate) if rate else None
+
+
+# Per-stage limits on the LLM calls, shared by the api and the batch jobs
+llm_rate_limiters = {
+    "transaction_extraction": AsyncRateLimiter(
+        _rate_from_env("TRANSACTION_EXTRACTION_RPM")
+    ),
+    "metadata_extraction": AsyncRateLimiter(_rate_from_env("METADATA_EXTRACTION_RPM")),
+    "for_against": AsyncRateLimiter(_rate_from_env("FOR_AGAINST_RPM")),
+    "categorization": AsyncRateLimiter(_rate_from_env("CATEGORIZATION_RPM")),
+}
+
+
+async def acquire_llm_rate_limit(stage):
+    await llm_rate_limiters[stage].acquire()
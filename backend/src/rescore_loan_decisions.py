@@ -0,0 +1,20 @@
+import argparse
+
+from services import rescore_loan_decisions
+
+
+# Command scoring all the stored statements again with the current training set,
+# and writing back the decisions that changed
+# Usage: python rescore_loan_decisions.py [--scale-features] [--dry-run]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk re-scoring of the statements")
+    parser.add_argument("--scale-features", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    rescore_report = rescore_loan_decisions(args.scale_features, args.dry_run)
+    print(
+        f"Scored {rescore_report['scored']} of {rescore_report['statements']} "
+        f"statements, {rescore_report['flipped']} decisions flipped"
+    )
@@ -0,0 +1,220 @@
+import os
+import threading
+
+from categorization import LOCAL_CATEGORIZATION_ENABLED, categorization_engine
+from database import (
+    close_firestore_client,
+    get_category_memo,
+    get_firestore_client,
+    get_training_statements,
+)
+from executors import shutdown_executors
+from metrics import stage_timer
+from prompt_digest import get_token_encoder
+from prompts import (
+    CATEGORIZATION_HUMAN_TEMPLATE,
+    CATEGORIZATION_MAX_TOKENS,
+    CATEGORIZATION_MODEL_NAME,
+    FOR_AGAINST_HUMAN_TEMPLATE,
+    FOR_AGAINST_MAX_TOKENS,
+    FOR_AGAINST_MODEL_NAME,
+    FOR_AGAINST_SYSTEM_TEMPLATE,
+    METADATA_EXTRACTION_MODEL_NAME,
+    METADATA_SCHEMA,
+    TRANSACTION_EXTRACTION_HUMAN_TEMPLATE,
+    TRANSACTION_EXTRACTION_MAX_TOKENS,
+    TRANSACTION_EXTRACTION_MODEL_NAME,
+    TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE,
+    TRANSACTION_ROWS_HUMAN_TEMPLATE,
+)
+from statement_templates import STATEMENT_TEMPLATES_PATH, statement_template_registry
+from training_index import training_index
+
+
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 32))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", 120))
+
+
+class Resources:
+    """
+    Clients and LLM chains shared by every request. They are created on startup when
+    running the api, and lazily on first use otherwise, so importing the modules that
+    use them (including in the process pool workers) stays cheap.
+    """
+
+    def __init__(self):
+        self._resources = {}
+        self._lock = threading.RLock()
+
+    def _get_or_create(self, name, factory):
+        resource = self._resources.get(name)
+
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(name)
+
+                if resource is None:
+                    resource = factory()
+                    self._resources[name] = resource
+
+        return resource
+
+    def override(self, **resources):
+        # Replaces shared resources by name, eg. with local stand-ins when benchmarking
+        with self._lock:
+            self._resources.update(resources)
+
+    @property
+    def storage_client(self):
+        def create_storage_client():
+            from google.cloud import storage
+
+            return storage.Client()
+
+        return self._get_or_create("storage_client", create_storage_client)
+
+    @property
+    def http_async_client(self):
+        # Connection pool shared by all the chat models
+        def create_http_async_client():
+            import httpx
+
+            return httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                ),
+                timeout=LLM_TIMEOUT_SECONDS,
+            )
+
+        return self._get_or_create("http_async_client", create_http_async_client)
+
+    def _create_chat_model(self, model_name, max_tokens=None):
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(
+            model_name=model_name,
+            temperature=0,
+            max_tokens=max_tokens,
+            http_async_client=self.http_async_client,
+        )
+
+    def _create_chat_chain(self, system_template, human_template, llm_model):
+        from langchain.prompts import ChatPromptTemplate
+
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system_template),
+                ("human", human_template),
+            ]
+        )
+
+        return prompt | llm_model
+
+    @property
+    def transactions_chain(self):
+        return self._get_or_create(
+            "transactions_chain",
+            lambda: self._create_chat_chain(
+                TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE,
+                TRANSACTION_EXTRACTION_HUMAN_TEMPLATE,
+                self._create_chat_model(
+                    TRANSACTION_EXTRACTION_MODEL_NAME, TRANSACTION_EXTRACTION_MAX_TOKENS
+                ),
+            ),
+        )
+
+    @property
+    def transaction_rows_chain(self):
+        # extraction without the categories, they are predicted locally
+        return self._get_or_create(
+            "transaction_rows_chain",
+            lambda: self._create_chat_chain(
+                TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE,
+                TRANSACTION_ROWS_HUMAN_TEMPLATE,
+                self._create_chat_model(
+                    TRANSACTION_EXTRACTION_MODEL_NAME, TRANSACTION_EXTRACTION_MAX_TOKENS
+                ),
+            ),
+        )
+
+    @property
+    def categorization_chain(self):
+        return self._get_or_create(
+            "categorization_chain",
+            lambda: self._create_chat_chain(
+                TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE,
+                CATEGORIZATION_HUMAN_TEMPLATE,
+                self._create_chat_model(
+                    CATEGORIZATION_MODEL_NAME, CATEGORIZATION_MAX_TOKENS
+                ),
+            ),
+        )
+
+    @property
+    def metadata_chain(self):
+        def create_metadata_chain():
+            from langchain.chains import create_extraction_chain
+
+            return create_extraction_chain(
+                METADATA_SCHEMA,
+                self._create_chat_model(METADATA_EXTRACTION_MODEL_NAME),
+            )
+
+        return self._get_or_create("metadata_chain", create_metadata_chain)
+
+    @property
+    def for_against_chain(self):
+        return self._get_or_create(
+            "for_against_chain",
+            lambda: self._create_chat_chain(
+                FOR_AGAINST_SYSTEM_TEMPLATE,
+                FOR_AGAINST_HUMAN_TEMPLATE,
+                self._create_chat_model(FOR_AGAINST_MODEL_NAME, FOR_AGAINST_MAX_TOKENS),
+            ),
+        )
+
+    def startup(self):
+        # Creating the clients and chains before the first request
+        get_firestore_client()
+        self.storage_client
+        if LOCAL_CATEGORIZATION_ENABLED:
+            self.transaction_rows_chain
+            self.categorization_chain
+        else:
+            self.transactions_chain
+        self.metadata_chain
+        self.for_against_chain
+
+        # tiktoken downloads the encoding on first use, it is not done in a request
+        get_token_encoder(FOR_AGAINST_MODEL_NAME)
+        get_token_encoder(TRANSACTION_EXTRACTION_MODEL_NAME)
+
+        # Loading the training data once and fitting the classifier,
+        # new datapoints are added in place
+        with stage_timer("training_load"):
+            training_index.load(get_training_statements())
+        training_index.warm()
+
+        # the layouts of the known banks, parsed without the LLM
+        if STATEMENT_TEMPLATES_PATH:
+            statement_template_registry.load_file(STATEMENT_TEMPLATES_PATH)
+
+        # the categories confirmed on previous statements
+        if LOCAL_CATEGORIZATION_ENABLED:
+            with stage_timer("category_memo_load"):
+                categorization_engine.load(get_category_memo())
+
+    async def shutdown(self):
+        http_async_client = self._resources.pop("http_async_client", None)
+        if http_async_client is not None:
+            await http_async_client.aclose()
+
+        self._resources.clear()
+
+        close_firestore_client()
+
+        shutdown_executors()
+
+
+resources = Resources()
@@ -0,0 +1,94 @@
+import numpy as np
+import orjson
+import pandas as pd
+
+
+# Single serialization stage of the statement analysis: the dataframes are converted
+# to json-safe values column by column once, and the encoded transactions are reused
+# as is by the prompt, the Firestore write and the http response.
+
+MONTH_DATE_FORMAT = "%Y-%m"
+
+
+def format_dates(dates, date_format=MONTH_DATE_FORMAT):
+    # Statement dates repeat a lot, so only the distinct dates are formatted
+    codes, unique_dates = pd.factorize(dates)
+
+    # NaT dates have the code -1, which picks the trailing None
+    formatted_dates = np.append(
+        np.asarray(unique_dates.strftime(date_format), dtype=object), None
+    )
+
+    return pd.Series(formatted_dates[codes], index=dates.index, dtype=object)
+
+
+def to_json_safe_frame(df, date_format=MONTH_DATE_FORMAT):
+    # dates are formatted and missing values (NaN, NaT) become None, one column at a time
+    json_safe_columns = {}
+
+    for column, values in df.items():
+        if pd.api.types.is_datetime64_any_dtype(values):
+            json_safe_columns[column] = format_dates(values, date_format)
+        else:
+            json_safe_columns[column] = values.astype(object).where(
+                values.notna(), None
+            )
+
+    return pd.DataFrame(json_safe_columns, index=df.index)
+
+
+def to_json_safe_records(df):
+    json_safe_df = to_json_safe_frame(df)
+    return json_safe_df.to_dict(orient="records")
+
+
+def to_json_safe_values(series):
+    # eg. the monthly means, as python floats or None keyed by the series index
+    return series.astype(object).where(series.notna(), None).to_dict()
+
+
+class EncodedTransactions:
+    """
+    Transactions of a statement, converted once from the dataframe: as json-safe
+    columns for the Firestore pages, and as json records embedded without being
+    encoded again in the prompt and the http response.
+    """
+
+    def __init__(self, columns, records_json):
+        self.columns = columns
+        self.records_json = records_json
+
+    @classmethod
+    def from_df(cls, df):
+        json_safe_df = to_json_safe_frame(df)
+
+        return cls(
+            columns={
+                column: values.tolist() for column, values in json_safe_df.items()
+            },
+            records_json=json_safe_df.to_json(
+                orient="records", double_precision=15
+            ).encode(),
+        )
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), []))
+
+    def to_records(self):
+        return orjson.loads(self.records_json)
+
+
+def _encode_default(obj):
+    if isinstance(obj, EncodedTransactions):
+        return orjson.Fragment(obj.records_json)
+
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj):
+    # numpy scalars are serialized natively, the encoded transactions are embedded
+    return orjson.dumps(obj, default=_encode_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def loads(data):
+    return orjson.loads(data)
@@ -1,66 +1,130 @@
-import io
+import asyncio
+import csv
+import os
+import time
 from io import StringIO
 import pandas as pd
 import numpy as np
 import json
-from datetime import datetime
-from google.cloud import storage
-from PyPDF2 import PdfReader
-from sklearn.neighbors import KNeighborsClassifier
-from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain.chains import LLMChain, create_extraction_chain
-from langchain.prompts import ChatPromptTemplate
 
-from database import get_training_statements
+from categorization import (
+    LOCAL_CATEGORIZATION_ENABLED,
+    OTHER_CATEGORY,
+    categorization_engine,
+    is_deposit,
+    normalize_description,
+)
+from database import (
+    get_all_statement_transactions,
+    get_statement_features,
+    get_training_statements,
+    save_category_memo_entries,
+    save_statement_analysis,
+    update_loan_decisions,
+    update_statement_analysis,
+)
+from executors import run_blocking, run_cpu_bound
+from llm_cache import get_llm_cache, make_cache_key
+from metrics import (
+    record_dropped_rows,
+    record_error,
+    record_extraction_chunks,
+    record_llm_tokens,
+    record_prompt_digest_tokens,
+    record_rows,
+    record_stage,
+    stage_timer,
+)
+from pdf_text import (
+    PAGE_SEPARATOR,
+    GCSPdfSource,
+    aextract_text_from_pdf_source,
+    extract_text_from_pdf_source,
+)
+from prompt_digest import build_for_against_digest, count_tokens
+from prompts import (
+    CATEGORIZATION_HUMAN_TEMPLATE,
+    CATEGORIZATION_MODEL_NAME,
+    FOR_AGAINST_MODEL_NAME,
+    METADATA_EXTRACTION_MODEL_NAME,
+    METADATA_SCHEMA,
+    TRANSACTION_CATEGORIES,
+    TRANSACTION_EXTRACTION_HUMAN_TEMPLATE,
+    TRANSACTION_EXTRACTION_MODEL_NAME,
+    TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE,
+    TRANSACTION_ROWS_HUMAN_TEMPLATE,
+)
+from rate_limits import acquire_llm_rate_limit
+from resources import resources
+from serialization import (
+    EncodedTransactions,
+    to_json_safe_records,
+    to_json_safe_values,
+)
+from statement_templates import statement_template_registry
+from training_index import training_index, extract_feature_vector
+from transaction_rows import (
+    StreamingTransactionsParser,
+    build_transactions_df_from_entries,
+    parse_date_fallback,
+)
 
 
 # PART 1: Generating bank statement analysis
 
+METADATA_TEXT_MAX_CHARS = 12000
 
-def extract_text_from_pdf_bucket(pdf_blob):
-    # Loading pdf object from gcs storage
-    storage_client = storage.Client()
+# Multi-page statements are extracted page by page, with a limit on concurrent llm calls
+CHUNKED_EXTRACTION_ENABLED = os.environ.get("CHUNKED_EXTRACTION", "1") == "1"
+EXTRACTION_CHUNK_CONCURRENCY = int(os.environ.get("EXTRACTION_CHUNK_CONCURRENCY", 4))
 
-    bucket_name = "loan_originator_bucket"
-    source_blob_name = pdf_blob
+# The LLM responses are parsed as they stream in, instead of once they are complete
+STREAMING_EXTRACTION_ENABLED = os.environ.get("STREAMING_EXTRACTION", "0") == "1"
 
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
+# Fields of the metadata used by the pipeline, the metadata is only cached with all of them
+METADATA_FIELDS = ["country_code_iso_3166_standard", "bank_name", "statement_year"]
 
-    pdf_bytes = blob.download_as_bytes()
-    pdf_file_obj = io.BytesIO(pdf_bytes)
+# Transactions the local categorization is not sure of, per llm call
+CATEGORIZATION_BATCH_SIZE = int(os.environ.get("CATEGORIZATION_BATCH_SIZE", 100))
 
-    # Extracting text
-    pdf_reader = PdfReader(pdf_file_obj)
 
-    extracted_text = ""
+def extract_text_from_pdf_bucket(pdf_blob):
+    return extract_text_from_pdf_source(GCSPdfSource(pdf_blob))
 
-    for page_num in range(len(pdf_reader.pages)):
-        page = pdf_reader.pages[page_num]
-        extracted_text += page.extract_text() + "\n"
 
-    pdf_file_obj.close()
+def split_statement_pages(statement_text):
+    return [page for page in statement_text.split(PAGE_SEPARATOR) if page.strip()]
 
-    return extracted_text
 
+def parse_dates(dates):
+    # First, try parsing the whole column with the 'YYYY-MM' format
+    parsed_dates = pd.to_datetime(dates, format="%Y-%m", errors="coerce")
 
-def preprocess_df(df):
-    def parse_date(date_str):
-        # First, try parsing with the 'YYYY-MM' format
-        parsed_date = pd.to_datetime(date_str, format="%Y-%m", errors="coerce")
+    # Then try to infer the format, only for the rows that failed
+    failed = parsed_dates.isna() & dates.notna()
+    if failed.any():
+        parsed_dates[failed] = pd.to_datetime(
+            dates[failed].map(parse_date_fallback), errors="coerce"
+        )
 
-        # If parsing failed (resulted in NaT), try to infer the datetime format
-        if pd.isna(parsed_date):
-            parsed_date = pd.to_datetime(
-                date_str, infer_datetime_format=True, errors="coerce"
-            )
+    return parsed_dates
 
-        return parsed_date
 
-    df["Date"] = df["Date"].apply(parse_date)
+def preprocess_df(df, log=False):
+    df["Date"] = parse_dates(df["Date"])
     df["Amount"] = pd.to_numeric(df["Amount"])
     df["Category"] = df["Category"].str.strip()
+
+    # counting the rows that are dropped below, by the first reason that applies
+    invalid_date = df["Date"].isna()
+    missing_amount = ~invalid_date & df["Amount"].isna()
+    missing_deposit = ~invalid_date & ~missing_amount & df["Deposit"].isna()
+    dropped_rows = {
+        "invalid_date": int(invalid_date.sum()),
+        "missing_amount": int(missing_amount.sum()),
+        "missing_deposit": int(missing_deposit.sum()),
+    }
+
     df["Amount"] = np.where(
         df["Deposit"] == "YES", df["Amount"].abs(), -df["Amount"].abs()
     )
@@ -69,97 +133,683 @@ def preprocess_df(df):
 
     df.dropna(subset=["Date", "Amount", "Deposit"], inplace=True)
 
+    df.attrs["dropped_rows"] = dropped_rows
+    if log:
+        print(f"Dropped Rows", dropped_rows)
+
     # TODO: remove months without complete data
     return df
 
 
-def get_transactions_text(statement_text, log=False):
+def get_token_usage(response):
+    token_usage = response.response_metadata.get("token_usage") or {}
+
+    return {
+        "prompt_tokens": token_usage.get("prompt_tokens", 0),
+        "completion_tokens": token_usage.get("completion_tokens", 0),
+    }
+
+
+def get_transactions_chain():
+    # With the local categorization, the LLM only extracts the transaction rows
+    if LOCAL_CATEGORIZATION_ENABLED:
+        return resources.transaction_rows_chain, TRANSACTION_ROWS_HUMAN_TEMPLATE
+
+    return resources.transactions_chain, TRANSACTION_EXTRACTION_HUMAN_TEMPLATE
+
+
+async def run_transaction_extraction(statement_text):
+    # Returns the raw csv text along with a report of the llm call
+    start_time = time.perf_counter()
+    transactions_chain, human_template = get_transactions_chain()
+
+    # Identical statements are served from the cache and never hit the LLM twice
+    cache_key = make_cache_key(
+        TRANSACTION_EXTRACTION_MODEL_NAME,
+        TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE + human_template,
+        statement_text,
+    )
+    cached_transactions_text = await run_blocking(get_llm_cache().get, cache_key)
+
+    if cached_transactions_text is not None:
+        return cached_transactions_text, {
+            "cached": True,
+            "truncated": False,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "latency_seconds": time.perf_counter() - start_time,
+        }
+
     # Running transaction extraction LLM Chain
-    llm_model = ChatOpenAI(
-        model_name="gpt-4-1106-preview", temperature=0, max_tokens=1054
+    await acquire_llm_rate_limit("transaction_extraction")
+    with stage_timer("llm_extraction"):
+        response = await transactions_chain.ainvoke({"bank_statement": statement_text})
+
+    token_usage = get_token_usage(response)
+    record_llm_tokens("llm_extraction", **token_usage)
+
+    truncated = response.response_metadata.get("finish_reason") == "length"
+    if is_cacheable_extraction(response.content, truncated):
+        await run_blocking(get_llm_cache().set, cache_key, response.content)
+
+    return response.content, {
+        "cached": False,
+        "truncated": truncated,
+        **token_usage,
+        "latency_seconds": time.perf_counter() - start_time,
+    }
+
+
+def is_cacheable_extraction(transactions_text, truncated):
+    # Only complete responses with transaction rows are cached, so that a truncated
+    # or empty extraction is retried instead of being replayed (the cache hits are
+    # reported as not truncated)
+    return not truncated and bool(split_csv_rows(transactions_text))
+
+
+def estimate_token_usage(prompt_text, response_text, model_name):
+    return {
+        "prompt_tokens": count_tokens(prompt_text, model_name),
+        "completion_tokens": count_tokens(response_text, model_name),
+    }
+
+
+async def stream_transaction_extraction(statement_text, parser):
+    # Same as run_transaction_extraction, with the csv lines fed to the parser
+    # as soon as they are complete. Returns the report of the llm call
+    start_time = time.perf_counter()
+    transactions_chain, human_template = get_transactions_chain()
+
+    cache_key = make_cache_key(
+        TRANSACTION_EXTRACTION_MODEL_NAME,
+        TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE + human_template,
+        statement_text,
     )
+    cached_transactions_text = await run_blocking(get_llm_cache().get, cache_key)
+
+    if cached_transactions_text is not None:
+        parser.feed(cached_transactions_text)
+        parser.close()
+
+        return {
+            "cached": True,
+            "truncated": False,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "latency_seconds": time.perf_counter() - start_time,
+        }
+
+    await acquire_llm_rate_limit("transaction_extraction")
+
+    response_parts = []
+    finish_reason = None
+    first_row_seconds = None
+
+    with stage_timer("llm_extraction"):
+        async for chunk in transactions_chain.astream(
+            {"bank_statement": statement_text}
+        ):
+            response_parts.append(chunk.content)
+            finish_reason = chunk.response_metadata.get("finish_reason", finish_reason)
+
+            if parser.feed(chunk.content) and first_row_seconds is None:
+                first_row_seconds = time.perf_counter() - start_time
+                record_stage("llm_first_row", first_row_seconds)
+
+        parser.close()
+
+    response_text = "".join(response_parts)
+
+    # the streamed responses have no token usage, so it is estimated
+    token_usage = await run_blocking(
+        estimate_token_usage,
+        TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE + human_template + statement_text,
+        response_text,
+        TRANSACTION_EXTRACTION_MODEL_NAME,
+    )
+    record_llm_tokens("llm_extraction", **token_usage)
+
+    truncated = finish_reason == "length"
+    if is_cacheable_extraction(response_text, truncated):
+        await run_blocking(get_llm_cache().set, cache_key, response_text)
+
+    return {
+        "cached": False,
+        "truncated": truncated,
+        **token_usage,
+        "first_row_seconds": first_row_seconds,
+        "latency_seconds": time.perf_counter() - start_time,
+    }
+
+
+async def get_transactions_text(statement_text, log=False):
+    # Returns the csv text and the report of the single extraction chunk
+    transactions_text, report = await run_transaction_extraction(statement_text)
+
+    chunk_reports = [
+        {
+            "chunk": 0,
+            "characters": len(statement_text),
+            "rows": len(split_csv_rows(transactions_text)),
+            **report,
+        }
+    ]
+
+    if log:
+        print(f"Transactions Text", transactions_text)
+
+    return transactions_text, chunk_reports
+
+
+def split_csv_rows(transactions_text):
+    # dropping empty lines and markdown code fences around the csv
+    return [
+        row.strip()
+        for row in transactions_text.splitlines()
+        if row.strip() and not row.strip().startswith("```")
+    ]
+
+
+def merge_chunk_rows(chunks_rows):
+    # The pages do not overlap, so the rows of the chunks are kept as they are:
+    # identical rows on both sides of a page break are distinct transactions
+    # (the dates only have the month), and are not deduplicated
+    return [row for chunk_rows in chunks_rows for row in chunk_rows]
+
+
+def merge_chunk_entries(chunks_entries):
+    # Same as merge_chunk_rows, for the (line, row, drop_reason) entries of the
+    # streaming parsers
+    return [entry for chunk_entries in chunks_entries for entry in chunk_entries]
+
+
+async def get_transactions_text_chunked(statement_text, log=False):
+    # Extracts the transactions of each page concurrently, so that the latency
+    # depends on the longest page and long statements are not truncated
+    pages = split_statement_pages(statement_text)
+    semaphore = asyncio.Semaphore(EXTRACTION_CHUNK_CONCURRENCY)
+
+    async def extract_chunk(page_text):
+        async with semaphore:
+            return await run_transaction_extraction(page_text)
+
+    chunk_results = await asyncio.gather(*[extract_chunk(page) for page in pages])
+
+    chunks_rows = [split_csv_rows(chunk_text) for chunk_text, _ in chunk_results]
+    transactions_text = "\n".join(merge_chunk_rows(chunks_rows))
+
+    chunk_reports = [
+        {"chunk": chunk_num, "characters": len(page), "rows": len(rows), **report}
+        for chunk_num, (page, rows, (_, report)) in enumerate(
+            zip(pages, chunks_rows, chunk_results)
+        )
+    ]
+
+    if log:
+        print(f"Transactions Text", transactions_text)
+        print(f"Extraction Chunks", chunk_reports)
+
+    return transactions_text, chunk_reports
+
+
+def categorize_transaction_rows(csv_rows):
+    # Parses the csv rows and fills in the categories that are missing or invalid
+    # with the local categorization. Returns the rows, with a None category when
+    # the local categorization is not sure, and the (description, deposit) of these
+    transaction_rows = []
+    unsure_transactions = {}
+    num_categorized = 0
+
+    for fields in csv.reader(csv_rows, skipinitialspace=True):
+        # malformed rows are left as they are, and skipped when reading the csv
+        if len(fields) not in (4, 5):
+            transaction_rows.append(fields)
+            continue
+
+        date, description, amount, deposit = fields[:4]
+        category = fields[4].strip() if len(fields) == 5 else None
+
+        if category not in TRANSACTION_CATEGORIES:
+            deposit_key = is_deposit(deposit)
+            category, _ = categorization_engine.categorize(description, deposit_key)
+
+            description_key = normalize_description(description)
+
+            if category is not None:
+                num_categorized += 1
+            elif description_key:
+                unsure_transactions.setdefault(
+                    (description_key, deposit_key), description
+                )
+            else:
+                category = OTHER_CATEGORY
+
+        transaction_rows.append([date, description, amount, deposit, category])
+
+    return transaction_rows, unsure_transactions, num_categorized
+
+
+def format_csv_rows(rows):
+    csv_buffer = StringIO()
+    csv.writer(csv_buffer, lineterminator="\n").writerows(rows)
+
+    return csv_buffer.getvalue()
+
+
+def parse_categorization_response(response_text, num_transactions):
+    # "number,category" lines, the invalid lines and categories are ignored
+    categories = {}
 
-    transaction_extraction_system_template = """You are an experienced loan originator and financial analyst. 
-  You will help with extracting information from bank statements."""
-    transaction_extraction_human_template = """Here is a bank statement, for each bank transaction, give the following information
-  in comma-separated format (Date, Description, Value, Deposit, Category). For Date, convert the date into the 
-  format "YYYY-MM". For description, do not include any commas that exist in the description. For Value, put a positive number and make sure it has a number format (only one dot).
-  For Deposit, put YES if the transaction is a deposit and NO if it is a withdrawal.
-  For category, try to predict the category from the transaction description from the following list [
-      "Deposits - Salary Paycheck",
-      "Deposits - Transfers In",
-      "Withdrawals - Cash Withdrawals ATM",
-      "Withdrawals - Transfers Out",
-      "Payments - Mortgage",
-      "Payments - Rent",
-      "Payments - Utility Bills",
-      "Payments - Loan Payments",
-      "Payments - Credit Card Payments",
-      "Payments - Insurance Premiums",
-      "Purchases - Groceries Food",
-      "Purchases - Dining Restaurants",
-      "Purchases - Retail Clothing",
-      "Purchases - Gas Fuel",
-      "Investments - Stock Bond Purchases",
-      "Investments - Retirement Account Contributions",
-      "Fees Charges - Account Maintenance Fees",
-      "Fees Charges - Overdraft Fees",
-      "Other"
-  ]. Only respond with the list of comma-separated values for all transactions in the bank statement, and do not include any other text in the response. Here is the statement: {bank_statement}"""
-
-    transaction_extraction_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", transaction_extraction_system_template),
-            ("human", transaction_extraction_human_template),
+    for line in split_csv_rows(response_text):
+        number, _, category = line.partition(",")
+        category = category.strip().strip('"')
+
+        try:
+            transaction_num = int(number.strip()) - 1
+        except ValueError:
+            continue
+
+        if 0 <= transaction_num < num_transactions and category in (
+            TRANSACTION_CATEGORIES
+        ):
+            categories[transaction_num] = category
+
+    return categories
+
+
+async def run_llm_categorization(transactions):
+    # transactions is a list of (description, deposit), returns their categories
+    # in the same order, "Other" when the LLM does not give a valid one
+    transactions_text = "\n".join(
+        f"{transaction_num},{description} ({'deposit' if deposit else 'withdrawal'})"
+        for transaction_num, (description, deposit) in enumerate(transactions, start=1)
+    )
+
+    cache_key = make_cache_key(
+        CATEGORIZATION_MODEL_NAME,
+        TRANSACTION_EXTRACTION_SYSTEM_TEMPLATE + CATEGORIZATION_HUMAN_TEMPLATE,
+        transactions_text,
+    )
+    response_text = await run_blocking(get_llm_cache().get, cache_key)
+
+    if response_text is None:
+        await acquire_llm_rate_limit("categorization")
+        with stage_timer("llm_categorization"):
+            response = await resources.categorization_chain.ainvoke(
+                {"transactions": transactions_text}
+            )
+
+        record_llm_tokens("llm_categorization", **get_token_usage(response))
+
+        response_text = response.content
+        await run_blocking(get_llm_cache().set, cache_key, response_text)
+
+    categories = parse_categorization_response(response_text, len(transactions))
+
+    return [
+        categories.get(transaction_num, OTHER_CATEGORY)
+        for transaction_num in range(len(transactions))
+    ]
+
+
+async def categorize_transactions_text(transactions_text):
+    # The categories are predicted locally, the LLM is only asked about the
+    # distinct descriptions the local categorization is not sure of
+    csv_rows = split_csv_rows(transactions_text)
+
+    with stage_timer("local_categorization"):
+        transaction_rows, unsure_transactions, num_categorized = await run_blocking(
+            categorize_transaction_rows, csv_rows
+        )
+
+    record_rows("local_categorization", rows_in=len(csv_rows), rows_out=num_categorized)
+
+    llm_categories = await categorize_unsure_transactions(unsure_transactions)
+
+    for fields in transaction_rows:
+        if len(fields) == 5 and fields[4] is None:
+            fields[4] = llm_categories[
+                (normalize_description(fields[1]), is_deposit(fields[3]))
+            ]
+
+    return format_csv_rows(transaction_rows)
+
+
+async def categorize_unsure_transactions(unsure_transactions):
+    # unsure_transactions maps (normalized description, deposit) to a description,
+    # they are sent to the LLM in concurrent batches
+    unsure_keys = list(unsure_transactions)
+    semaphore = asyncio.Semaphore(EXTRACTION_CHUNK_CONCURRENCY)
+
+    async def categorize_batch(batch_keys):
+        async with semaphore:
+            return await run_llm_categorization(
+                [(unsure_transactions[key], key[1]) for key in batch_keys]
+            )
+
+    batches_categories = await asyncio.gather(
+        *[
+            categorize_batch(unsure_keys[start : start + CATEGORIZATION_BATCH_SIZE])
+            for start in range(0, len(unsure_keys), CATEGORIZATION_BATCH_SIZE)
         ]
     )
 
-    transactions_chain = transaction_extraction_prompt | llm_model
+    return dict(
+        zip(
+            unsure_keys,
+            [category for categories in batches_categories for category in categories],
+        )
+    )
 
-    response = transactions_chain.invoke({"bank_statement": statement_text})
 
-    if log:
-        print(f"Transactions Text", response.content)
+def categorize_streamed_row(row):
+    # Local categorization of a row as soon as it is parsed, None when not sure.
+    # It runs on the event loop, so only the memo and keyword lookups are done here,
+    # the classifier runs once for all the unsure rows in categorize_unsure_rows
+    if row["Category"] in TRANSACTION_CATEGORIES:
+        return
 
-    return response.content
+    row["Category"], _ = categorization_engine.categorize(
+        row["Description"] or "", is_deposit(row["Deposit"]), use_classifier=False
+    )
 
 
-def process_statement_pdf(statement_pdf_blob, log=False):
-    # Uploads the pdf to firebase storage and saves the url
-    # Creates a dataframe of transactions extracted using the LLM model
-    # Saves other metadata such as "country" and "bank name" of the statement
+async def categorize_unsure_rows(rows):
+    # The rows the local lookups were not sure of go to the classifier in one batch
+    # off the event loop, then the ones it is not sure of get the LLM categories
+    unsure_transactions = {}
+    for row in rows:
+        if row["Category"] is None:
+            description_key = normalize_description(row["Description"] or "")
+
+            if description_key:
+                unsure_transactions.setdefault(
+                    (description_key, is_deposit(row["Deposit"])), row["Description"]
+                )
+
+    if unsure_transactions and categorization_engine.classifier is not None:
+        unsure_keys = list(unsure_transactions)
+        classifier_categories = dict(
+            zip(
+                unsure_keys,
+                await run_blocking(categorization_engine.classify, unsure_keys),
+            )
+        )
 
-    # pulling pdf into langchain
-    statement_text = extract_text_from_pdf_bucket(statement_pdf_blob)
+        for row in rows:
+            if row["Category"] is None:
+                row["Category"] = classifier_categories.get(
+                    (
+                        normalize_description(row["Description"] or ""),
+                        is_deposit(row["Deposit"]),
+                    )
+                )
+
+        unsure_transactions = {
+            key: description
+            for key, description in unsure_transactions.items()
+            if classifier_categories[key] is None
+        }
+
+    record_rows(
+        "local_categorization",
+        rows_in=len(rows),
+        rows_out=sum(row["Category"] is not None for row in rows),
+    )
 
-    transactions_text = get_transactions_text(statement_text, log)
+    llm_categories = await categorize_unsure_transactions(unsure_transactions)
+
+    for row in rows:
+        if row["Category"] is None:
+            row["Category"] = llm_categories.get(
+                (
+                    normalize_description(row["Description"] or ""),
+                    is_deposit(row["Deposit"]),
+                ),
+                OTHER_CATEGORY,
+            )
 
-    # Creating dataframe
 
-    df = pd.read_csv(
+def read_transactions_csv(transactions_text):
+    return pd.read_csv(
         StringIO(transactions_text),
         header=None,
         names=["Date", "Description", "Amount", "Deposit", "Category"],
         on_bad_lines="skip",
     )
 
+
+def build_transactions_df(transactions_text):
+    # Runs in the process pool, so the stage timings and row counts
+    # are passed back in the dataframe attrs
+    start_time = time.perf_counter()
+
+    # Creating dataframe
+    df = read_transactions_csv(transactions_text)
+
+    csv_parse_seconds = time.perf_counter() - start_time
+    csv_rows = len(df)
+
     # Pre-process and clean dataframe
     df = preprocess_df(df)
 
-    # Extracting metadata
-    metadata_schema = {
-        "properties": {
-            "country_code_iso_3166_standard": {"type": "string"},
-            "bank_name": {"type": "string"},
-            "statement_year": {"type": "integer"},
-        },
-        "required": ["country_code", "bank_name", "statement_year"],
+    df.attrs["csv_rows"] = csv_rows
+    df.attrs["stage_timings"] = {
+        "csv_parse": csv_parse_seconds,
+        "preprocess_df": time.perf_counter() - start_time - csv_parse_seconds,
     }
 
+    return df
+
+
+def parse_transactions_text_with_template(statement_text, template):
+    # None when the statement does not parse with the template
+    transaction_rows = template.parse_rows(statement_text)
+
+    if transaction_rows is None:
+        return None
+
+    return format_csv_rows(transaction_rows)
+
+
+async def extract_transactions_df_streaming(statement_text, log=False):
+    # The rows are parsed, converted and categorized locally while the LLM
+    # responses stream in, page by page for the multi-page statements
+    if CHUNKED_EXTRACTION_ENABLED and len(split_statement_pages(statement_text)) > 1:
+        pages = split_statement_pages(statement_text)
+    else:
+        pages = [statement_text]
+
+    parsers = [
+        StreamingTransactionsParser(
+            categorize_streamed_row if LOCAL_CATEGORIZATION_ENABLED else None
+        )
+        for _ in pages
+    ]
+    semaphore = asyncio.Semaphore(EXTRACTION_CHUNK_CONCURRENCY)
+
+    async def extract_chunk(page_text, parser):
+        async with semaphore:
+            return await stream_transaction_extraction(page_text, parser)
+
+    chunk_reports = await asyncio.gather(
+        *[extract_chunk(page, parser) for page, parser in zip(pages, parsers)]
+    )
+
+    entries = merge_chunk_entries([parser.entries for parser in parsers])
+
+    if LOCAL_CATEGORIZATION_ENABLED:
+        await categorize_unsure_rows([row for _, row, _ in entries if row is not None])
+
+    df = await run_blocking(build_transactions_df_from_entries, entries)
+
+    record_rows("csv_parse", rows_in=len(entries), rows_out=df.attrs["csv_rows"])
+    record_rows("preprocess_df", rows_in=df.attrs["csv_rows"], rows_out=len(df))
+
+    extraction_chunks = [
+        {
+            "chunk": chunk_num,
+            "characters": len(page),
+            "rows": len(parser.entries),
+            **report,
+        }
+        for chunk_num, (page, parser, report) in enumerate(
+            zip(pages, parsers, chunk_reports)
+        )
+    ]
+
+    if log:
+        print(f"Transactions", df)
+        print(f"Extraction Chunks", extraction_chunks)
+
+    return df, extraction_chunks
+
+
+async def extract_transactions_df(statement_text, log=False, template=None):
+    extraction_chunks = None
+    transactions_text = None
+
+    # Known layouts are parsed directly, without the LLM
+    if template is not None:
+        with stage_timer("template_parse"):
+            transactions_text = await run_blocking(
+                parse_transactions_text_with_template, statement_text, template
+            )
+
+        if transactions_text is None:
+            if log:
+                print(
+                    f"Statement did not parse with template {template.name}, "
+                    "using the LLM"
+                )
+        else:
+            record_rows(
+                "template_parse",
+                rows_in=statement_text.count("\n"),
+                rows_out=transactions_text.count("\n"),
+            )
+
+        if log:
+            print(f"Template {template.name} Transactions Text", transactions_text)
+
+    if transactions_text is None and STREAMING_EXTRACTION_ENABLED:
+        return await extract_transactions_df_streaming(statement_text, log)
+
+    # the template rows have no categories, like the rows of the local categorization
+    categorize = LOCAL_CATEGORIZATION_ENABLED or transactions_text is not None
+
+    if transactions_text is None:
+        if (
+            CHUNKED_EXTRACTION_ENABLED
+            and len(split_statement_pages(statement_text)) > 1
+        ):
+            transactions_text, extraction_chunks = await get_transactions_text_chunked(
+                statement_text, log
+            )
+        else:
+            transactions_text, extraction_chunks = await get_transactions_text(
+                statement_text, log
+            )
+
+    if categorize:
+        transactions_text = await categorize_transactions_text(transactions_text)
+
+    df = await run_cpu_bound(build_transactions_df, transactions_text)
+
+    for stage, seconds in df.attrs["stage_timings"].items():
+        record_stage(stage, seconds)
+    record_rows(
+        "csv_parse",
+        rows_in=len(split_csv_rows(transactions_text)),
+        rows_out=df.attrs["csv_rows"],
+    )
+    record_rows("preprocess_df", rows_in=df.attrs["csv_rows"], rows_out=len(df))
+
+    return df, extraction_chunks
+
+
+def make_token_usage_handler():
+    # Callback summing the token usage of the llm calls of a chain that only
+    # returns its parsed output (the metadata extraction chain)
+    # imported here so that the process pool workers never load langchain
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TokenUsageHandler(BaseCallbackHandler):
+        def __init__(self):
+            self.token_usage = {"prompt_tokens": 0, "completion_tokens": 0}
+
+        def on_llm_end(self, response, **kwargs):
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+
+            for token_type in self.token_usage:
+                self.token_usage[token_type] += token_usage.get(token_type, 0)
+
+    return TokenUsageHandler()
+
+
+async def extract_statement_metadata(statement_text, template=None):
+    # Known layouts give the bank name and country, and the year is read from the text
+    if template is not None:
+        meta_data = template.extract_metadata(statement_text)
+
+        if meta_data is not None:
+            return meta_data
+
+    # the bank name, country and year are found in the first part of the statement
+    metadata_text = statement_text[:METADATA_TEXT_MAX_CHARS]
+
+    cache_key = make_cache_key(
+        METADATA_EXTRACTION_MODEL_NAME, json.dumps(METADATA_SCHEMA), metadata_text
+    )
+    cached_meta_data = await run_blocking(get_llm_cache().get, cache_key)
+
+    if cached_meta_data is not None:
+        return json.loads(cached_meta_data)
+
+    token_usage_handler = make_token_usage_handler()
+
     # Run metadata extraction llm chain
-    llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-    chain = create_extraction_chain(metadata_schema, llm)
-    meta_data = chain.run(transactions_text)[0]
+    await acquire_llm_rate_limit("metadata_extraction")
+    with stage_timer("metadata_chain"):
+        meta_data = (
+            await resources.metadata_chain.arun(
+                metadata_text, callbacks=[token_usage_handler]
+            )
+        )[0]
+
+    record_llm_tokens("metadata_chain", **token_usage_handler.token_usage)
+
+    # incomplete metadata is not cached, the next request asks again
+    if all(meta_data.get(field) is not None for field in METADATA_FIELDS):
+        await run_blocking(get_llm_cache().set, cache_key, json.dumps(meta_data))
+
+    return meta_data
+
+
+async def process_statement_pdf(statement_pdf_blob, log=False):
+    # Uploads the pdf to firebase storage and saves the url
+    # Creates a dataframe of transactions extracted using the LLM model
+    # Saves other metadata such as "country" and "bank name" of the statement
+
+    # pulling pdf into langchain
+    statement_text = await aextract_text_from_pdf_source(
+        GCSPdfSource(statement_pdf_blob)
+    )
+
+    # statements from a known layout are parsed without the LLM
+    template = statement_template_registry.match(statement_text)
+
+    # the metadata only needs the statement text, so it runs
+    # concurrently with the transaction extraction
+    (df, extraction_chunks), meta_data = await asyncio.gather(
+        extract_transactions_df(statement_text, log, template),
+        extract_statement_metadata(statement_text, template),
+    )
+
+    # None for the statements parsed with a template
+    if extraction_chunks is not None:
+        record_extraction_chunks(extraction_chunks)
+    record_dropped_rows(df.attrs.get("dropped_rows") or {})
 
     statement_data = {
         "country_code": meta_data["country_code_iso_3166_standard"],
@@ -167,6 +817,8 @@ def process_statement_pdf(statement_pdf_blob, log=False):
         "statement_year": meta_data["statement_year"],
         "statement_pdf_blob": statement_pdf_blob,
         "transactions_df": df,
+        "extraction_chunks": extraction_chunks,
+        "dropped_rows": df.attrs.get("dropped_rows"),
     }
 
     if log:
@@ -177,42 +829,24 @@ def process_statement_pdf(statement_pdf_blob, log=False):
     return statement_data
 
 
-def replace_nat_with_none(obj):
-    if isinstance(obj, dict):
-        return {k: replace_nat_with_none(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [replace_nat_with_none(v) for v in obj]
-    elif isinstance(obj, pd.Timestamp):
-        return obj.strftime("%Y-%m")
-    elif pd.isna(obj):
-        return None
-    else:
-        return obj
-
-
-def generate_for_against_loan_reasons(statement_analysis, log=False):
-    # Asks llm to provide reasons for and against giving a loan
-    # Running transaction extraction LLM Chain
-    llm_model = ChatOpenAI(
-        model_name="gpt-4-1106-preview", temperature=0, max_tokens=1054
+async def generate_for_against_loan_reasons(statement_analysis, log=False):
+    # Asks llm to provide reasons for and against giving a loan,
+    # from a digest of the analysis of bounded size
+    statement_digest, digest_tokens = await run_blocking(
+        build_for_against_digest, statement_analysis, FOR_AGAINST_MODEL_NAME
     )
+    record_prompt_digest_tokens("for_against_chain", digest_tokens)
 
-    transaction_extraction_system_template = """You are an experienced loan originator and financial analyst. You will help with creating decisions of whether or not to give a loan based on a bank statement data"""
-    transaction_extraction_human_template = """Here is a bank statement analysis for a client. Use this data to provide a bullet-point list of reasons to provide a loan then a list of reason for not providing a loan. 
-  Only include relevant, strong and useful reasons and back each reason with numerical data from the analysis. Include headers for each list ("Reasons for:" and "Reasons against") but no other text and do not make up facts. Here is the statement analysis: {statement_analysis}"""
-
-    transaction_extraction_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", transaction_extraction_system_template),
-            ("human", transaction_extraction_human_template),
-        ]
-    )
+    if log:
+        print(f"For/Against Digest ({digest_tokens} tokens)", statement_digest)
 
-    transactions_chain = transaction_extraction_prompt | llm_model
+    await acquire_llm_rate_limit("for_against")
+    with stage_timer("for_against_chain"):
+        response = await resources.for_against_chain.ainvoke(
+            {"statement_analysis": statement_digest}
+        )
 
-    response = transactions_chain.invoke(
-        {"statement_analysis": json.dumps(statement_analysis)}
-    )
+    record_llm_tokens("for_against_chain", **get_token_usage(response))
 
     if log:
         print(f"Transactions Text", response.content)
@@ -220,80 +854,81 @@ def generate_for_against_loan_reasons(statement_analysis, log=False):
     return response.content
 
 
-def extract_analysis_from_statement_df(statement_data, log=False):
-    df = statement_data["transactions_df"]
-    # Calculating monthly summaries
-    monthly_summary = df.groupby([df["Date"].dt.year, df["Date"].dt.month]).agg(
-        total_deposits=pd.NamedAgg(column="Amount", aggfunc=lambda x: x[x > 0].sum()),
-        total_withdrawals=pd.NamedAgg(
-            column="Amount", aggfunc=lambda x: x[x < 0].sum()
-        ),
-        average_balance=pd.NamedAgg(column="Amount", aggfunc="mean"),
+def summarize_monthly_transactions(df):
+    # Single pass monthly aggregation: the per-month deposits, withdrawals and
+    # category payments are precomputed as columns and summed in one groupby
+    amount = df["Amount"]
+    category = df["Category"].astype("category")
+
+    monthly_columns = pd.DataFrame(
+        {
+            "total_deposits": amount.clip(lower=0),
+            "total_withdrawals": amount.clip(upper=0),
+            "average_balance": amount,
+            "rent_payments": amount.where(category == "Payments - Rent", 0),
+            "mortgage_payments": amount.where(category == "Payments - Mortgage", 0),
+            "utility_payments": amount.where(category == "Payments - Utility Bills", 0),
+            "loan_payments": amount.where(category == "Payments - Loan Payments", 0),
+        },
+        index=df.index,
     )
 
-    monthly_summary["net_savings"] = (
-        monthly_summary["total_deposits"] + monthly_summary["total_withdrawals"]
+    monthly_groups = monthly_columns.groupby(
+        df["Date"].dt.to_period("M").rename("YearMonth"), sort=True
     )
-
-    # calculating monthly payments by category
-    specific_payments = (
-        df.groupby([df["Date"].dt.year, df["Date"].dt.month, "Category"])["Amount"]
-        .sum()
-        .unstack(fill_value=0)
+    monthly_sums = monthly_groups.sum()
+
+    monthly_summary = pd.DataFrame(
+        {
+            "total_deposits": monthly_sums["total_deposits"],
+            "total_withdrawals": monthly_sums["total_withdrawals"],
+            "average_balance": monthly_groups["average_balance"].mean(),
+            "net_savings": monthly_sums["total_deposits"]
+            + monthly_sums["total_withdrawals"],
+            "rent_mortgage_payments": monthly_sums["rent_payments"]
+            + monthly_sums["mortgage_payments"],
+            "utility_payments": monthly_sums["utility_payments"],
+            "loan_payments": monthly_sums["loan_payments"],
+        }
     )
 
-    monthly_utility_payments = specific_payments.get("Payments - Utility Bills", 0)
-    monthly_loan_payments = specific_payments.get("Payments - Loan Payments", 0)
-    monthly_mortgage_payments = specific_payments.get("Payments - Mortgage", 0)
-    monthly_rent_payments = specific_payments.get("Payments - Rent", 0)
-    monthly_rent_mortgage_payments = monthly_rent_payments + monthly_mortgage_payments
-
-    # extending monthly_summary with other data
-    monthly_summary["rent_mortgage_payments"] = monthly_rent_mortgage_payments
-    monthly_summary["utility_payments"] = monthly_utility_payments
-    monthly_summary["loan_payments"] = monthly_loan_payments
-
-    monthly_summary["rent_mortgage_to_income_ratio"] = np.where(
-        (monthly_summary["total_deposits"] > 0)
-        & (monthly_summary["total_deposits"].notna()),
-        monthly_summary["rent_mortgage_payments"].abs()
-        / monthly_summary["total_deposits"],
-        np.nan,
+    # ratios of the payments to the income, for the months with deposits
+    monthly_income = monthly_summary["total_deposits"].where(
+        monthly_summary["total_deposits"] > 0
     )
-
-    monthly_summary["utilities_to_income_ratio"] = np.where(
-        (monthly_summary["total_deposits"] > 0)
-        & (monthly_summary["total_deposits"].notna()),
-        monthly_summary["utility_payments"].abs() / monthly_summary["total_deposits"],
-        np.nan,
+    monthly_ratios = (
+        monthly_summary[["rent_mortgage_payments", "utility_payments", "loan_payments"]]
+        .abs()
+        .div(monthly_income, axis=0)
     )
+    monthly_summary["rent_mortgage_to_income_ratio"] = monthly_ratios[
+        "rent_mortgage_payments"
+    ]
+    monthly_summary["utilities_to_income_ratio"] = monthly_ratios["utility_payments"]
+    monthly_summary["loan_to_income_ratio"] = monthly_ratios["loan_payments"]
 
-    monthly_summary["loan_to_income_ratio"] = np.where(
-        (monthly_summary["total_deposits"] > 0)
-        & (monthly_summary["total_deposits"].notna()),
-        monthly_summary["loan_payments"].abs() / monthly_summary["total_deposits"],
-        np.nan,
-    )
+    monthly_summary.index = monthly_summary.index.strftime("%Y-%m")
 
-    # calculating means accross all months
+    return monthly_summary
 
-    monthly_deposit_mean = monthly_summary["total_deposits"].mean()
-    monthly_withdrawal_mean = monthly_summary["total_withdrawals"].mean()
-    monthly_rent_mean = monthly_summary["rent_mortgage_payments"].mean()
-    monthly_utilities_mean = monthly_summary["utility_payments"].mean()
-    monthly_loan_payment_mean = monthly_summary["loan_payments"].mean()
-    monthly_balance_mean = monthly_summary["average_balance"].mean()
 
-    # formatting monthly_summary for json
-    monthly_summary["YearMonth"] = monthly_summary.index.map(
-        lambda x: datetime(int(x[0]), int(x[1]), 1)
-    ).map(lambda x: x.strftime("%Y-%m"))
+def summarize_statement_df(statement_data):
+    df = statement_data["transactions_df"]
+    # Calculating monthly summaries
+    monthly_summary = summarize_monthly_transactions(df)
+
+    # calculating means accross all months
+    monthly_means = to_json_safe_values(monthly_summary.mean())
 
-    monthly_summary = monthly_summary.set_index("YearMonth")
+    monthly_deposit_mean = monthly_means["total_deposits"]
+    monthly_withdrawal_mean = monthly_means["total_withdrawals"]
+    monthly_rent_mean = monthly_means["rent_mortgage_payments"]
+    monthly_utilities_mean = monthly_means["utility_payments"]
+    monthly_loan_payment_mean = monthly_means["loan_payments"]
+    monthly_balance_mean = monthly_means["average_balance"]
 
-    monthly_summary_list = monthly_summary.to_dict(
-        orient="records"
-    )  # formatted for the json
+    # formatted for the json, the YearMonth index is left out of the records
+    monthly_summary_list = to_json_safe_records(monthly_summary)
 
     # TODO: find average salary data for the country/year, compare with current statement and add to data
 
@@ -309,13 +944,30 @@ def extract_analysis_from_statement_df(statement_data, log=False):
         "monthly_loan_payment_mean": monthly_loan_payment_mean,
         "monthly_balance_mean": monthly_balance_mean,
         "monthly_summary": monthly_summary_list,
-        "transactions": statement_data["transactions_df"].to_dict(orient="records"),
+        # converted once, then reused by the prompt, the database and the response
+        "transactions": EncodedTransactions.from_df(statement_data["transactions_df"]),
     }
 
-    # cleaning statement analysis from NaT values for json serialization to work
-    statement_analysis = replace_nat_with_none(statement_analysis)
+    return statement_analysis
+
+
+async def aggregate_statement_df(statement_data):
+    with stage_timer("aggregation"):
+        statement_analysis = await run_cpu_bound(summarize_statement_df, statement_data)
 
-    statement_analysis["for_against"] = generate_for_against_loan_reasons(
+    record_rows(
+        "aggregation",
+        rows_in=len(statement_data["transactions_df"]),
+        rows_out=len(statement_analysis["monthly_summary"]),
+    )
+
+    return statement_analysis
+
+
+async def extract_analysis_from_statement_df(statement_data, log=False):
+    statement_analysis = await aggregate_statement_df(statement_data)
+
+    statement_analysis["for_against"] = await generate_for_against_loan_reasons(
         statement_analysis
     )
 
@@ -328,60 +980,169 @@ def extract_analysis_from_statement_df(statement_data, log=False):
     return statement_analysis
 
 
-# Part 2: Running Classification into Loan / No Loan
-
+async def learn_statement_categories(statement_analysis_ref):
+    # The categories of a confirmed statement are added to the local categorization
+    transactions = await run_blocking(
+        get_all_statement_transactions, statement_analysis_ref
+    )
 
-def extract_training_features_labels(training_statements):
-    features = []
-    target_labels = []
+    if not transactions:
+        return 0
 
-    for statement in training_statements:
-        # Extract features (order should match for all statements)
-        feature_vector = [
-            statement["monthly_deposit_mean"],
-            statement["monthly_withdrawal_mean"],
-            statement["monthly_rent_mean"],
-            statement["monthly_utilities_mean"],
-            statement["monthly_loan_payment_mean"],
-            statement["monthly_balance_mean"],
-        ]
+    category_memo_entries = categorization_engine.learn(transactions)
+    await run_blocking(save_category_memo_entries, category_memo_entries)
 
-        # Append the feature vector to the features list
-        features.append(feature_vector)
+    return len(category_memo_entries)
 
-        # Append the loan decision to the target labels list
-        target_labels.append(statement["loan_decision"])
 
-    # Convert lists to numpy arrays
-    X = np.array(features)
-    y = np.array(target_labels)
-    return X, y
+# Part 2: Running Classification into Loan / No Loan
 
 
 def predict_loan_decision(statement_analysis, log=True):
     # Extract features
-    feature_vector = [
-        [
-            statement_analysis["monthly_deposit_mean"],
-            statement_analysis["monthly_withdrawal_mean"],
-            statement_analysis["monthly_rent_mean"],
-            statement_analysis["monthly_utilities_mean"],
-            statement_analysis["monthly_loan_payment_mean"],
-            statement_analysis["monthly_balance_mean"],
-        ]
-    ]
+    feature_vector = [extract_feature_vector(statement_analysis)]
 
-    training_statements = get_training_statements(log)
+    # The training index is normally loaded on startup, this only happens
+    # when the services are used outside of the api
+    if not training_index.loaded:
+        with stage_timer("training_load"):
+            training_index.load(get_training_statements(log))
 
-    knn = KNeighborsClassifier(n_neighbors=3)  # Adjust n_neighbors as needed
+    # Predict on the test data
+    y_pred = training_index.predict(feature_vector)
 
-    # Extract features and labels from training data
-    X, y = extract_training_features_labels(training_statements)
+    return y_pred[0]
 
-    # Fit the model
-    knn.fit(X, y)
 
-    # Predict on the test data
-    y_pred = knn.predict(feature_vector)
+def rescore_loan_decisions(scale_features=False, dry_run=False, log=False):
+    # Scores every stored statement against the current training set in one batched
+    # neighbour query, and only writes back the decisions that changed. The training
+    # statements keep their confirmed decisions
+    if not training_index.loaded:
+        with stage_timer("training_load"):
+            training_index.load(get_training_statements(log))
 
-    return y_pred[0]
+    with stage_timer("rescore_load"):
+        statement_ids, feature_matrix, loan_decisions = get_statement_features()
+
+    training_refs = training_index.statement_refs
+    is_training = np.array(
+        [statement_id in training_refs for statement_id in statement_ids], dtype=bool
+    )
+    has_features = ~np.isnan(feature_matrix).any(axis=1)
+    scored = has_features & ~is_training
+
+    new_decisions = np.full(len(statement_ids), -1, dtype=np.int64)
+    if scored.any():
+        new_decisions[scored] = training_index.predict(
+            feature_matrix[scored], scale_features
+        )
+
+    # statements without a decision yet are counted apart from the flips
+    changed = scored & (new_decisions != loan_decisions)
+    flipped = changed & ~np.isnan(loan_decisions)
+
+    changed_ids = np.asarray(statement_ids, dtype=object)[changed]
+    if not dry_run and len(changed_ids):
+        update_loan_decisions(
+            dict(zip(changed_ids.tolist(), new_decisions[changed].tolist()))
+        )
+
+    rescore_report = {
+        "statements": len(statement_ids),
+        "scored": int(scored.sum()),
+        "skipped_training": int(is_training.sum()),
+        "skipped_missing_features": int((~has_features & ~is_training).sum()),
+        "flipped": int(flipped.sum()),
+        "flipped_to_approved": int((flipped & (new_decisions == 1)).sum()),
+        "flipped_to_rejected": int((flipped & (new_decisions == 0)).sum()),
+        "newly_decided": int((changed & ~flipped).sum()),
+        "updated": 0 if dry_run else len(changed_ids),
+        "scale_features": scale_features,
+        "dry_run": dry_run,
+    }
+
+    if log:
+        print(f"Rescore Report", rescore_report)
+
+    return rescore_report
+
+
+# Part 3: Running the full pipeline
+
+# keeps a reference to the fire-and-forget tasks until they are done
+_background_tasks = set()
+
+
+def run_in_background(coroutine, stage=None):
+    # Fire-and-forget task, its failure is counted in the errors of the stage
+    async def run():
+        try:
+            return await coroutine
+        except Exception:
+            if stage is None:
+                raise
+
+            record_error(stage)
+
+    background_task = asyncio.create_task(run())
+    _background_tasks.add(background_task)
+    background_task.add_done_callback(_background_tasks.discard)
+
+    return background_task
+
+
+async def backfill_for_against(statement_analysis_ref, for_against_task, log=False):
+    try:
+        for_against = await for_against_task
+        await run_blocking(
+            update_statement_analysis,
+            statement_analysis_ref,
+            {"for_against": for_against},
+        )
+    except Exception as e:
+        record_error("for_against_backfill")
+
+        if log:
+            print(f"Failed to backfill for/against for {statement_analysis_ref}: {e}")
+
+
+async def get_loan_prediction(statement_pdf_blob, defer_for_against=False, log=False):
+    # The for/against reasons and the loan decision both only depend on the
+    # statement summaries, so they run concurrently. When defer_for_against is set,
+    # the decision is returned right away and the reasons are saved once ready
+    statement_data = await process_statement_pdf(statement_pdf_blob, log)
+    statement_analysis = await aggregate_statement_df(statement_data)
+
+    for_against_task = asyncio.create_task(
+        generate_for_against_loan_reasons(dict(statement_analysis))
+    )
+
+    try:
+        prediction = await run_blocking(predict_loan_decision, statement_analysis)
+        statement_analysis["loan_decision"] = 1 if prediction else 0
+
+        if defer_for_against:
+            statement_analysis["for_against"] = None
+        else:
+            statement_analysis["for_against"] = await for_against_task
+
+        statement_analysis_ref = await run_blocking(
+            save_statement_analysis, statement_analysis
+        )
+    except BaseException:
+        for_against_task.cancel()
+        raise
+
+    if defer_for_against:
+        run_in_background(
+            backfill_for_against(statement_analysis_ref, for_against_task, log)
+        )
+
+    if log:
+        print(
+            f"Statement Analysis for {statement_analysis['statement_pdf_blob']}",
+            statement_analysis,
+        )
+
+    return statement_analysis, statement_analysis_ref
@@ -0,0 +1,214 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime
+
+
+# Parsers for known statement layouts: a template recognizes the text of a statement
+# from its bank and parses the transaction lines with regexes into the same csv rows
+# as the LLM extraction (Date, Description, Value, Deposit), so that recurring banks
+# skip the LLM. Statements that no template recognizes still go to the LLM.
+# Templates are registered in code, or loaded from the json file at
+# STATEMENT_TEMPLATES_PATH (a list of RegexStatementTemplate arguments).
+
+STATEMENT_TEMPLATES_PATH = os.environ.get("STATEMENT_TEMPLATES_PATH")
+# the layout is recognized from the first part of the statement
+TEMPLATE_DETECT_MAX_CHARS = 4000
+# the statement year is a year in a date or after a header word ("Statement period",
+# "for the year"), so that an account or branch number is not taken for the year
+MONTH_NAMES = "jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec"
+STATEMENT_YEAR_PATTERN = re.compile(
+    rf"""
+    (?:
+        \b(?:statement|period|year|as\ of|ending|date[ds]?)\b[^\d\n]{{0,20}}
+        | \b(?:{MONTH_NAMES})[a-z]*\.?\s+(?:\d{{1,2}}(?:st|nd|rd|th)?,?\s+)?
+        | \b\d{{1,2}}\s+(?:{MONTH_NAMES})[a-z]*\.?,?\s+
+        | (?<![\d.\-/])\d{{1,2}}[\-/.]\d{{1,2}}[\-/.]
+    )
+    (?P<year>(?:19|20)\d{{2}})(?![\d\-/.]\d)
+    | (?<![\d.\-/])(?P<iso_year>(?:19|20)\d{{2}})[\-/.](?:0?[1-9]|1[0-2])(?!\d)
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+
+class RegexStatementTemplate:
+    """
+    Statement layout of a bank. detect_pattern is searched in the first part of the
+    statement, and line_pattern matched against every stripped line, with the named
+    groups: date, description, amount and either direction (one of credit_markers for
+    the deposits), or separate debit and credit amounts, or else a signed amount.
+    A statement with more lines that match but do not convert than
+    max_failed_rows_ratio is left to the LLM. year_pattern (with a year group) reads
+    the statement year from the header of the layout.
+    """
+
+    def __init__(
+        self,
+        name,
+        detect_pattern,
+        line_pattern,
+        date_format="%Y-%m-%d",
+        credit_markers=("CR",),
+        decimal_separator=".",
+        bank_name=None,
+        country_code=None,
+        min_rows=1,
+        max_failed_rows_ratio=0.0,
+        year_pattern=None,
+    ):
+        self.name = name
+        self.detect_pattern = re.compile(detect_pattern)
+        self.line_pattern = re.compile(line_pattern)
+        self.date_format = date_format
+        self.credit_markers = {marker.upper() for marker in credit_markers}
+        self.decimal_separator = decimal_separator
+        self.bank_name = bank_name
+        self.country_code = country_code
+        self.min_rows = min_rows
+        self.max_failed_rows_ratio = max_failed_rows_ratio
+        self.year_pattern = re.compile(year_pattern) if year_pattern else None
+
+    def matches(self, statement_text):
+        return (
+            self.detect_pattern.search(statement_text[:TEMPLATE_DETECT_MAX_CHARS])
+            is not None
+        )
+
+    def extract_statement_year(self, statement_text):
+        year_match = (self.year_pattern or STATEMENT_YEAR_PATTERN).search(
+            statement_text[:TEMPLATE_DETECT_MAX_CHARS]
+        )
+
+        if year_match is None:
+            return None
+
+        year_groups = year_match.groupdict()
+        return int(year_groups.get("year") or year_groups.get("iso_year"))
+
+    def extract_metadata(self, statement_text):
+        # Same fields as the metadata chain, None when the template does not know them
+        statement_year = self.extract_statement_year(statement_text)
+
+        if self.bank_name is None or self.country_code is None or not statement_year:
+            return None
+
+        return {
+            "country_code_iso_3166_standard": self.country_code,
+            "bank_name": self.bank_name,
+            "statement_year": statement_year,
+        }
+
+    def parse_amount(self, amount):
+        # keeps the digits, the sign and the decimal separator (as a dot)
+        amount = re.sub(rf"[^\d\-{re.escape(self.decimal_separator)}]", "", amount)
+        return float(amount.replace(self.decimal_separator, "."))
+
+    @property
+    def dates_have_year(self):
+        # date formats without the year, eg. "05 Jan", take the statement year
+        return "%Y" in self.date_format or "%y" in self.date_format
+
+    def parse_date(self, date, statement_year):
+        parsed_date = datetime.strptime(date.strip(), self.date_format)
+
+        if not self.dates_have_year:
+            parsed_date = parsed_date.replace(year=statement_year)
+
+        return parsed_date.strftime("%Y-%m")
+
+    def parse_row(self, line_match, statement_year):
+        groups = line_match.groupdict()
+
+        if groups.get("direction") is not None:
+            amount = abs(self.parse_amount(groups["amount"]))
+            deposit = groups["direction"].strip().upper() in self.credit_markers
+        elif groups.get("credit"):
+            amount, deposit = abs(self.parse_amount(groups["credit"])), True
+        elif groups.get("debit"):
+            amount, deposit = abs(self.parse_amount(groups["debit"])), False
+        else:
+            signed_amount = self.parse_amount(groups["amount"])
+            amount, deposit = abs(signed_amount), signed_amount >= 0
+
+        return [
+            self.parse_date(groups["date"], statement_year),
+            # same as the LLM extraction, the descriptions have no commas
+            " ".join(groups["description"].replace(",", " ").split()),
+            f"{amount:.2f}",
+            "YES" if deposit else "NO",
+        ]
+
+    def parse_rows(self, statement_text):
+        # Returns the csv rows, or None when the statement does not parse
+        # (eg. a new version of the layout), so that it goes to the LLM instead
+        statement_year = self.extract_statement_year(statement_text)
+        if statement_year is None and not self.dates_have_year:
+            return None
+
+        rows = []
+        num_failed_rows = 0
+
+        # splitlines also splits on the form feeds between the pages
+        for line in statement_text.splitlines():
+            line_match = self.line_pattern.match(line.strip())
+            if line_match is None:
+                continue
+
+            try:
+                rows.append(self.parse_row(line_match, statement_year))
+            except (ValueError, TypeError, KeyError):
+                num_failed_rows += 1
+
+        # transaction lines that do not convert would be lost
+        if len(rows) < self.min_rows or num_failed_rows > self.max_failed_rows_ratio * (
+            len(rows) + num_failed_rows
+        ):
+            return None
+
+        return rows
+
+
+class StatementTemplateRegistry:
+    def __init__(self):
+        self._templates = []
+        self._lock = threading.Lock()
+
+    def register(self, template):
+        # a template registered again under the same name replaces the previous one
+        with self._lock:
+            self._templates = [
+                registered_template
+                for registered_template in self._templates
+                if registered_template.name != template.name
+            ] + [template]
+
+        return template
+
+    def unregister(self, name):
+        with self._lock:
+            self._templates = [
+                template for template in self._templates if template.name != name
+            ]
+
+    def load_file(self, path):
+        with open(path) as templates_file:
+            templates_config = json.load(templates_file)
+
+        for template_config in templates_config:
+            self.register(RegexStatementTemplate(**template_config))
+
+    def match(self, statement_text):
+        # First template that recognizes the statement, in registration order
+        for template in self._templates:
+            if template.matches(statement_text):
+                return template
+
+        return None
+
+    def __len__(self):
+        return len(self._templates)
+
+
+statement_template_registry = StatementTemplateRegistry()
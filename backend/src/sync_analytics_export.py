@@ -0,0 +1,41 @@
+import argparse
+
+from analytics_export import AnalyticsStore, sync_analytics_export
+
+
+# Command exporting the new statements to the parquet analytics datasets,
+# then printing the portfolio reports computed on them
+# Usage: python sync_analytics_export.py [--full] [--country-code US] [--statement-year 2023]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analytics export of the statements")
+    parser.add_argument("--full", action="store_true", help="export everything again")
+    parser.add_argument("--country-code")
+    parser.add_argument("--statement-year", type=int)
+    args = parser.parse_args()
+
+    export_report = sync_analytics_export(full=args.full)
+    print(
+        f"Exported {export_report['statements']} statements "
+        f"({export_report['already_exported']} already exported): "
+        f"{export_report['rows']}"
+    )
+
+    filters = {}
+    if args.country_code:
+        filters["country_code"] = args.country_code
+    if args.statement_year:
+        filters["statement_year"] = args.statement_year
+
+    analytics_store = AnalyticsStore()
+    print(
+        "Approval rate by bank",
+        analytics_store.approval_rate_by_bank(filters),
+        sep="\n",
+    )
+    print(
+        "Rent to income ratio by country",
+        analytics_store.rent_to_income_by_country(filters),
+        sep="\n",
+    )
+    print("Category totals", analytics_store.category_totals(filters), sep="\n")
@@ -0,0 +1,188 @@
+import threading
+import numpy as np
+
+from metrics import stage_timer
+
+
+# Features used by the loan decision classifier (order should match for all statements)
+FEATURE_FIELDS = [
+    "monthly_deposit_mean",
+    "monthly_withdrawal_mean",
+    "monthly_rent_mean",
+    "monthly_utilities_mean",
+    "monthly_loan_payment_mean",
+    "monthly_balance_mean",
+]
+
+
+def extract_feature_vector(statement):
+    return [statement[field] for field in FEATURE_FIELDS]
+
+
+class TrainingIndex:
+    """
+    Process-wide index of the labelled training statements used by the KNN classifier.
+
+    The feature matrix is kept in a preallocated contiguous array so that newly confirmed
+    statements are appended in place, and the classifier is only refit when the data changed.
+    Once the training set grows past `tree_threshold`, a KD-tree/ball-tree is used instead of
+    a brute-force neighbour search. A second classifier on standardized features is fit on
+    demand, for the bulk re-scoring.
+    """
+
+    def __init__(
+        self,
+        n_neighbors=3,
+        tree_threshold=1000,
+        tree_algorithm="kd_tree",
+        initial_capacity=256,
+    ):
+        self.n_neighbors = n_neighbors
+        self.tree_threshold = tree_threshold
+        self.tree_algorithm = tree_algorithm
+
+        self._X = np.empty((initial_capacity, len(FEATURE_FIELDS)), dtype=np.float64)
+        self._y = np.empty(initial_capacity, dtype=np.int64)
+        self._size = 0
+        self._rows = {}  # statement ref -> row in the feature matrix
+
+        self._knn = None
+        self._scaled_knn = None
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def algorithm(self):
+        return "brute" if self._size < self.tree_threshold else self.tree_algorithm
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def statement_refs(self):
+        with self._lock:
+            return set(self._rows)
+
+    def _ensure_capacity(self, capacity):
+        if capacity <= len(self._X):
+            return
+
+        new_capacity = max(capacity, 2 * len(self._X))
+
+        X = np.empty((new_capacity, self._X.shape[1]), dtype=self._X.dtype)
+        X[: self._size] = self._X[: self._size]
+        y = np.empty(new_capacity, dtype=self._y.dtype)
+        y[: self._size] = self._y[: self._size]
+
+        self._X, self._y = X, y
+
+    def load(self, training_statements):
+        # Replaces the whole index with the given training statements
+        with self._lock:
+            self._size = 0
+            self._rows = {}
+            self._ensure_capacity(len(training_statements))
+
+            for statement in training_statements:
+                self._add(
+                    statement.get("statement_ref"),
+                    extract_feature_vector(statement),
+                    statement["loan_decision"],
+                )
+
+            self._knn = None
+            self._scaled_knn = None
+            self._loaded = True
+
+    def _add(self, statement_ref, feature_vector, label):
+        row = self._rows.get(statement_ref) if statement_ref is not None else None
+
+        if row is None:
+            self._ensure_capacity(self._size + 1)
+            row = self._size
+            self._size += 1
+
+            if statement_ref is not None:
+                self._rows[statement_ref] = row
+
+        self._X[row] = feature_vector
+        self._y[row] = label
+
+    def add(self, statement_ref, feature_vector, label):
+        # Adds (or updates, if the statement was already confirmed) a labelled datapoint
+        with self._lock:
+            self._add(statement_ref, feature_vector, label)
+            self._knn = None
+            self._scaled_knn = None
+
+    def add_statement(self, statement_ref, statement):
+        self.add(
+            statement_ref, extract_feature_vector(statement), statement["loan_decision"]
+        )
+
+    def _fitted_classifier(self):
+        if self._size == 0:
+            raise ValueError("The training set is empty")
+
+        if self._knn is None:
+            # imported here so that the process pool workers never load scikit-learn
+            from sklearn.neighbors import KNeighborsClassifier
+
+            knn = KNeighborsClassifier(
+                n_neighbors=min(self.n_neighbors, self._size),
+                algorithm=self.algorithm,
+            )
+            # fitting on a copy so that in place updates never touch a fitted tree
+            with stage_timer("knn_fit"):
+                knn.fit(self._X[: self._size].copy(), self._y[: self._size].copy())
+            self._knn = knn
+
+        return self._knn
+
+    def _fitted_scaled_classifier(self):
+        if self._size == 0:
+            raise ValueError("The training set is empty")
+
+        if self._scaled_knn is None:
+            from sklearn.neighbors import KNeighborsClassifier
+            from sklearn.pipeline import make_pipeline
+            from sklearn.preprocessing import StandardScaler
+
+            scaled_knn = make_pipeline(
+                StandardScaler(),
+                KNeighborsClassifier(
+                    n_neighbors=min(self.n_neighbors, self._size),
+                    algorithm=self.algorithm,
+                ),
+            )
+            with stage_timer("knn_fit"):
+                scaled_knn.fit(
+                    self._X[: self._size].copy(), self._y[: self._size].copy()
+                )
+            self._scaled_knn = scaled_knn
+
+        return self._scaled_knn
+
+    def warm(self):
+        # Fits the classifier ahead of the first prediction
+        with self._lock:
+            if self._size:
+                self._fitted_classifier()
+
+    def predict(self, feature_vectors, scale_features=False):
+        # scale_features standardizes the features with the training set statistics
+        with self._lock:
+            if scale_features:
+                knn = self._fitted_scaled_classifier()
+            else:
+                knn = self._fitted_classifier()
+
+        with stage_timer("knn_predict"):
+            return knn.predict(np.asarray(feature_vectors, dtype=np.float64))
+
+
+training_index = TrainingIndex()
@@ -0,0 +1,160 @@
+import csv
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+# Row by row version of the csv parsing and preprocess_df, for the streamed
+# transaction extraction: the csv lines are parsed, validated and converted as soon
+# as they are complete, with the same rules as preprocess_df, instead of waiting
+# for the whole response.
+
+TRANSACTION_COLUMNS = ["Date", "Description", "Amount", "Deposit", "Category"]
+
+
+@lru_cache(maxsize=4096)
+def parse_date_fallback(date_str):
+    # Parses a date that is not in the 'YYYY-MM' format, memoized across statements
+    return pd.to_datetime(date_str, errors="coerce")
+
+
+def parse_date(date_str):
+    # 'YYYY-MM' first, then the inferred format, NaT when the date does not parse
+    if date_str is None:
+        return pd.NaT
+
+    try:
+        return pd.Timestamp(datetime.strptime(date_str, "%Y-%m"))
+    except ValueError:
+        return parse_date_fallback(date_str)
+
+
+def parse_amount(amount_str):
+    try:
+        return float(amount_str)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def is_csv_row(line):
+    # empty lines and markdown code fences around the csv are not rows
+    return bool(line) and not line.startswith("```")
+
+
+DROP_REASONS = ["invalid_date", "missing_amount", "missing_deposit"]
+# lines with too many fields, skipped like read_csv does, not counted as csv rows
+SKIPPED_LINE = "skipped"
+
+
+class StreamingTransactionsParser:
+    """
+    Parses the transaction csv as it is streamed. Every complete line is kept in
+    `entries` as (line, row, drop_reason): row is the converted transaction, or None
+    when the line is dropped by the preprocess_df rules. `categorize_row` can set
+    the category of the rows as they are parsed.
+    """
+
+    def __init__(self, categorize_row=None):
+        self.categorize_row = categorize_row
+        self.entries = []
+        self._buffer = ""
+
+    @property
+    def rows(self):
+        # running list of the valid transactions
+        return [row for _, row, _ in self.entries if row is not None]
+
+    def feed(self, text):
+        # Returns the valid rows completed by this piece of the stream
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+
+        return self._parse_lines(lines)
+
+    def close(self):
+        # the last line has no line break
+        lines, self._buffer = [self._buffer], ""
+
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines):
+        new_rows = []
+
+        for line in lines:
+            line = line.strip()
+            if not is_csv_row(line):
+                continue
+
+            row, drop_reason = self._parse_row(line)
+            self.entries.append((line, row, drop_reason))
+
+            if row is not None:
+                new_rows.append(row)
+
+        return new_rows
+
+    def _parse_row(self, line):
+        fields = next(csv.reader([line]))
+
+        if len(fields) > len(TRANSACTION_COLUMNS):
+            return None, SKIPPED_LINE
+
+        # empty fields are missing values, like in read_csv
+        date_str, description, amount_str, deposit, category = [
+            field or None for field in fields
+        ] + [None] * (len(TRANSACTION_COLUMNS) - len(fields))
+
+        # dropped for the first reason that applies, as in preprocess_df
+        date = parse_date(date_str)
+        if pd.isna(date):
+            return None, "invalid_date"
+
+        amount = parse_amount(amount_str)
+        if np.isnan(amount):
+            return None, "missing_amount"
+
+        if deposit is None:
+            return None, "missing_deposit"
+
+        row = {
+            "Date": date,
+            "Description": description,
+            "Amount": abs(amount) if deposit == "YES" else -abs(amount),
+            "Deposit": deposit,
+            "Category": category.strip() if category else None,
+        }
+
+        if self.categorize_row is not None:
+            self.categorize_row(row)
+
+        return row, None
+
+
+def build_transactions_df_from_entries(entries):
+    # Same dataframe and attrs as read_transactions_csv followed by preprocess_df
+    rows = [row for _, row, _ in entries if row is not None]
+
+    df = pd.DataFrame(
+        {
+            "Date": pd.to_datetime([row["Date"] for row in rows]),
+            "Description": pd.Series(
+                [row["Description"] for row in rows], dtype=object
+            ),
+            "Amount": np.array([row["Amount"] for row in rows], dtype=np.float64),
+            "Deposit": pd.Series([row["Deposit"] for row in rows], dtype=object),
+            "Category": pd.Series(
+                [row["Category"] or "Other" for row in rows], dtype=object
+            ),
+        },
+        columns=TRANSACTION_COLUMNS,
+    )
+
+    drop_reasons = [drop_reason for _, _, drop_reason in entries]
+    df.attrs["csv_rows"] = len(drop_reasons) - drop_reasons.count(SKIPPED_LINE)
+    df.attrs["dropped_rows"] = {
+        drop_reason: drop_reasons.count(drop_reason) for drop_reason in DROP_REASONS
+    }
+
+    return df
@@ -31,7 +31,9 @@ interface StatementAnalysis {
   monthly_loan_payment_mean: number;
   monthly_balance_mean: number;
   monthly_summary: MonthlySummary[];
-  transactions: Transaction[];
+  // only set on statements saved with their transactions inline
+  transactions?: Transaction[];
+  transactions_count?: number;
   for_against: string;
   loan_decision: number;
 }
@@ -41,9 +43,26 @@ interface StatementAnalysisEndpointResponse {
   statement_analysis_ref: string;
 }
 
+interface TransactionsPageResponse {
+  transactions: Transaction[];
+  page: number;
+  page_size: number;
+  total: number;
+  next_page: number | null;
+}
+
+interface PredictionJobResponse {
+  job_id: string;
+  status: string;
+  statement_analysis_ref: string | null;
+  error: string | null;
+}
+
 export type {
   MonthlySummary,
   Transaction,
   StatementAnalysis,
   StatementAnalysisEndpointResponse,
+  TransactionsPageResponse,
+  PredictionJobResponse,
 };
@@ -1,24 +1,60 @@
 "use server";
 
+import {
+  PredictionJobResponse,
+  TransactionsPageResponse,
+} from "@/Models/BackendModels";
+
+const POLL_INTERVAL_MS = 3000;
+const MAX_POLL_ATTEMPTS = 200;
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
 const getLoanPrediction = async (statement_id: string) => {
   try {
-    const endpoint = `${process.env.BACKEND_URL}/get_loan_prediction_endpoint/?statement_pdf_blob=statements/${statement_id}`;
+    // Submitting returns a job right away, submitting the same statement again reuses its job
+    const submitEndpoint = `${process.env.BACKEND_URL}/submit_loan_prediction_endpoint/?statement_pdf_blob=statements/${statement_id}`;
 
-    const response = await fetch(endpoint, {
-      method: "POST", // Consider if POST is appropriate for your use case or if it should be GET.
-      next: { tags: ["get_loan_prediction_endpoint"], revalidate: 3600 },
+    const submitResponse = await fetch(submitEndpoint, {
+      method: "POST",
+      cache: "no-store",
     });
 
-    if (!response.ok) {
-      const errorText = await response.text(); // Get the error detail from the response
+    if (!submitResponse.ok) {
+      const errorText = await submitResponse.text(); // Get the error detail from the response
       return {
         error: `Failed to get loan prediction: ${errorText}`,
-        status: response.status,
+        status: submitResponse.status,
       };
     }
 
-    const data = await response.json();
-    return { data, status: 200 };
+    const job: PredictionJobResponse = await submitResponse.json();
+    const resultEndpoint = `${process.env.BACKEND_URL}/get_loan_prediction_result_endpoint/?job_id=${job.job_id}`;
+
+    for (let attempt = 0; attempt < MAX_POLL_ATTEMPTS; attempt++) {
+      const response = await fetch(resultEndpoint, {
+        next: { tags: ["get_loan_prediction_endpoint"], revalidate: 0 },
+      });
+
+      // 202 means the prediction is still running
+      if (response.status === 202) {
+        await sleep(POLL_INTERVAL_MS);
+        continue;
+      }
+
+      if (!response.ok) {
+        const errorText = await response.text(); // Get the error detail from the response
+        return {
+          error: `Failed to get loan prediction: ${errorText}`,
+          status: response.status,
+        };
+      }
+
+      const data = await response.json();
+      return { data, status: 200 };
+    }
+
+    return { error: "Timed out waiting for the loan prediction", status: 504 };
   } catch (error) {
     return { error: "Get Loan Prediction Server Error", status: 500 };
   }
@@ -47,4 +83,29 @@ const saveTrainingDatapoint = async (statement_analysis_ref: string) => {
   }
 };
 
-export { getLoanPrediction, saveTrainingDatapoint };
+const getStatementTransactions = async (
+  statement_analysis_ref: string,
+  page: number
+) => {
+  try {
+    const endpoint = `${process.env.BACKEND_URL}/get_statement_transactions_endpoint/?statement_analysis_ref=${statement_analysis_ref}&page=${page}`;
+    const response = await fetch(endpoint, {
+      next: { tags: [statement_analysis_ref] },
+    });
+
+    if (!response.ok) {
+      const errorText = await response.text(); // Get the error detail from the response
+      return {
+        error: `Failed to get statement transactions: ${errorText}`,
+        status: response.status,
+      };
+    }
+
+    const data: TransactionsPageResponse = await response.json();
+    return { data, status: 200 };
+  } catch (error) {
+    return { error: "Get Statement Transactions Server Error", status: 500 };
+  }
+};
+
+export { getLoanPrediction, saveTrainingDatapoint, getStatementTransactions };
@@ -8,6 +8,7 @@ import {
 } from "@/Models/BackendModels";
 import {
   getLoanPrediction,
+  getStatementTransactions,
   saveTrainingDatapoint,
 } from "@/app/actions/backend";
 import { helix } from "ldrs";
@@ -236,15 +237,51 @@ const MonthlyExpensesBarList: React.FC<MonthlyExpensesBarListProps> = ({
 };
 
 interface TransactionDetailsTableProps {
-  transactionList: Transaction[];
+  statementAnalysisRef: string;
 }
 
 const TransactionDetailsTable: React.FC<TransactionDetailsTableProps> = ({
-  transactionList,
+  statementAnalysisRef,
 }) => {
   const [showTransactions, setShowTransactions] = useState(false);
+  // Transactions are fetched page by page, the first time they are shown
+  const [transactionList, setTransactionList] = useState<Transaction[]>([]);
+  const [nextPage, setNextPage] = useState<number | null>(0);
+  const [totalTransactions, setTotalTransactions] = useState<number | null>(
+    null
+  );
+  const [loadingTransactions, setLoadingTransactions] = useState(false);
+
+  const loadNextPage = async () => {
+    if (nextPage === null || loadingTransactions) {
+      return;
+    }
+
+    setLoadingTransactions(true);
+    const response = await getStatementTransactions(
+      statementAnalysisRef,
+      nextPage
+    );
+    setLoadingTransactions(false);
+
+    if (response.status !== 200 || !response.data) {
+      alert(`Failed to load transactions: ${response.error}`);
+      return;
+    }
+
+    const transactionsPage = response.data;
+    setTransactionList((transactions) => [
+      ...transactions,
+      ...transactionsPage.transactions,
+    ]);
+    setTotalTransactions(transactionsPage.total);
+    setNextPage(transactionsPage.next_page);
+  };
 
   const handleToggleTransactions = () => {
+    if (!showTransactions && totalTransactions === null) {
+      loadNextPage();
+    }
     setShowTransactions(!showTransactions);
   };
 
@@ -288,6 +325,19 @@ const TransactionDetailsTable: React.FC<TransactionDetailsTableProps> = ({
           </Table>
         </TableContainer>
       )}
+      {showTransactions && nextPage !== null && (
+        <button
+          onClick={loadNextPage}
+          disabled={loadingTransactions}
+          className="text-[#121218] hover:text-[#0145A7] mt-6"
+        >
+          {loadingTransactions
+            ? "Loading Transactions..."
+            : `Load More Transactions (${transactionList.length} of ${
+                totalTransactions ?? "..."
+              })`}
+        </button>
+      )}
     </div>
   );
 };
@@ -298,6 +348,9 @@ const ResultsPage: React.FC<{ statementId: string }> = ({ statementId }) => {
   const [analysisData, setAnalysisData] = useState<StatementAnalysis | null>(
     null
   );
+  const [statementAnalysisRef, setStatementAnalysisRef] = useState<
+    string | null
+  >(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
   const router = useRouter();
@@ -353,6 +406,7 @@ const ResultsPage: React.FC<{ statementId: string }> = ({ statementId }) => {
           setLoading(false);
         } else {
           setAnalysisData(response.data.statement_analysis);
+          setStatementAnalysisRef(response.data.statement_analysis_ref);
           setLoading(false);
         }
       } catch (err) {
@@ -540,9 +594,9 @@ const ResultsPage: React.FC<{ statementId: string }> = ({ statementId }) => {
           </div>
         </div>
 
-        {analysisData?.transactions && (
+        {statementAnalysisRef && (
           <TransactionDetailsTable
-            transactionList={analysisData?.transactions}
+            statementAnalysisRef={statementAnalysisRef}
           ></TransactionDetailsTable>
         )}
         <div className="flex justify-end">